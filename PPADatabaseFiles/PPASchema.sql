@@ -22,9 +22,14 @@ CREATE TABLE CANDLESTICK
 
 CREATE TABLE MODELINSTANCES
 (
-	Model_id		INT(8) NOT NULL,
+	Model_id		INT(8) NOT NULL AUTO_INCREMENT PRIMARY KEY,
     Model_type		VARCHAR(9) NOT NULL,
-    Date_trained	VARCHAR(14) NOT NULL
+    Date_trained	VARCHAR(14) NOT NULL,
+    Symbol			VARCHAR(20),			-- TABLE PREFIX OF THE DATA THE MODEL WAS TRAINED ON
+    Version			INT(8),					-- INCREASES WITH EVERY TRAINING RUN SAVING TO MODEL_PATH (COUNTED PER MODEL FILE), INCLUDING INCREMENTAL RUNS
+    Last_trade_id	BIGINT,					-- TRAINING WATERMARK: LAST TRADE THE MODEL WAS TRAINED ON
+    Last_time		DOUBLE,					-- TIME OF THAT TRADE (UNIX SECONDS)
+    Model_path		VARCHAR(255)
 );
 
 CREATE TABLE USERINFO
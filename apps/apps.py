@@ -1,9 +1,53 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import mysql.connector
+import argparse
+import json
+import os
+import re
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Shared instrumentation of the scripts in database-applications
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database-applications"))
+import instrumentation
+
 app = Flask(__name__)
 CORS(app)  # create bridge to react native 
 
+# Address of the LSTM inference service (database-applications/inference-service.py)
+INFERENCE_SERVICE_URL = "http://127.0.0.1:8500"
+
+# Symbols are table prefixes such as ETHUSDC
+SYMBOL_PATTERN = re.compile(r"[A-Z0-9]+")
+
+# Every request is a span, with the time of its database statements
+@app.before_request
+def start_request_span():
+    g.request_span = instrumentation.start_span("request", method=request.method, endpoint=request.endpoint, url=request.path)
+
+@app.after_request
+def record_status(response):
+    if "request_span" in g:
+        g.request_span.fields["status"] = response.status_code
+    return response
+
+# An exception of the view, or else a server error status, is recorded in the error field as by instrumentation.span
+@app.teardown_request
+def finish_request_span(error):
+    request_span = g.pop("request_span", None)
+    if request_span is None:
+        return
+    status = request_span.fields.get("status")
+    if error is not None:
+        request_span.finish(error=type(error).__name__)
+    elif status is not None and status >= 500:
+        request_span.finish(error=f"HTTP {status}")
+    else:
+        request_span.finish()
+
 # LOGIN page
 @app.route("/login", methods=["POST"])
 def login():
@@ -16,13 +60,13 @@ def login():
 
     try:
         # Connect to MySQL database
-        db = mysql.connector.connect(
+        db = instrumentation.instrument_connection(mysql.connector.connect(
             host="localhost",
             port=3306,
             user="",
             password="",  # your MySQL password 
             database="PROJECT_4560"
-        )
+        ))
         cursor = db.cursor(dictionary=True)
 
         # Query USERINFO table to find the user based on Username and Pword
@@ -64,13 +108,13 @@ def create_account():
         return jsonify({"error": "All fields are required."}),400
     try:
         # Connect to MySQL database
-        db = mysql.connector.connect(
+        db = instrumentation.instrument_connection(mysql.connector.connect(
             host="localhost",
             port=3306,
             user="",
             password="",  #my MySQL password??
             database="PROJECT_4560"
-        )
+        ))
         cursor= db.cursor()
         count_query="SELECT COUNT(*) AS user_count FROM USERINFO"
         cursor.execute(count_query)
@@ -99,13 +143,13 @@ def create_account():
 def get_dropdown_options():
 
     try:
-        db = mysql.connector.connect(
+        db = instrumentation.instrument_connection(mysql.connector.connect(
             host="localhost",
             port=3306,
             user="",
             password="",
             database="PROJECT_4560"
-        )
+        ))
         cursor = db.cursor(dictionary=True)
 
         # tables
@@ -138,13 +182,13 @@ def displayHomeScreen():
     print(f"Selected Table: {selected_table}, Limit: {limit}, Offset: {offset}")  # Debug log
 
     try:
-        db = mysql.connector.connect(
+        db = instrumentation.instrument_connection(mysql.connector.connect(
             host="localhost",
             port=3306,
             user="",
             password="",
             database="PROJECT_4560"
-        )
+        ))
         cursor = db.cursor(dictionary=True)
 
         # Use LIMIT and OFFSET
@@ -165,8 +209,49 @@ def displayHomeScreen():
         return jsonify({"error": "Database connection failed"}), 500
 
 
+# Forecast of the next price of a symbol from the inference service
+@app.route("/forecast/<symbol>", methods=["GET"])
+def forecast(symbol):
+    if not SYMBOL_PATTERN.fullmatch(symbol):
+        return jsonify({"error": "Invalid symbol"}), 400
+
+    url = f"{INFERENCE_SERVICE_URL}/predict?symbol={urllib.parse.quote(symbol)}"
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return jsonify(json.loads(response.read())), 200
+    except urllib.error.HTTPError as err:
+        # The service answers errors (e.g. too few ticks of the symbol) with JSON as well, a proxy in between may not
+        try:
+            return jsonify(json.loads(err.read())), err.code
+        except ValueError:
+            return jsonify({"error": err.reason}), err.code
+    except (urllib.error.URLError, TimeoutError, ValueError) as err:
+        print("Inference service error:", err)
+        return jsonify({"error": "Inference service unavailable"}), 502
+
+# Latency and throughput of the inference service
+@app.route("/forecast-stats", methods=["GET"])
+def forecast_stats():
+    try:
+        with urllib.request.urlopen(f"{INFERENCE_SERVICE_URL}/stats", timeout=10) as response:
+            return jsonify(json.loads(response.read())), 200
+    except (urllib.error.URLError, TimeoutError, ValueError) as err:
+        print("Inference service error:", err)
+        return jsonify({"error": "Inference service unavailable"}), 502
+
     
     
 # Run the Flask app
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flask backend of the app.")
+    parser.add_argument("--metrics-log", type=str, default=None, help="Append the time and database time of every request to this file as JSON lines ('-' for stderr)")
+    parser.add_argument("--profile", type=str, default=None, help="Write a cProfile stats file of every request to this directory")
+    args = parser.parse_args()
+
+    instrumentation.configure(args.metrics_log)
+    if args.profile:
+        from werkzeug.middleware.profiler import ProfilerMiddleware
+        os.makedirs(args.profile, exist_ok=True)
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, stream=None, profile_dir=args.profile)
+
     app.run(host="0.0.0.0", port=5001, debug=True)
@@ -0,0 +1,196 @@
+# Microbenchmarks for the data importer.
+# Compares the vectorized timestamp normalization and candle aggregation against the original implementations on the example data.
+
+import os
+import sys
+import argparse
+import importlib.util
+from timeit import default_timer as timer
+from zipfile import ZipFile
+import numpy as np
+import pandas as pd
+from pyarrow import csv as pv
+
+IMPORTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data-importer-release.py')
+
+# Load the importer as a module (its file name is not a valid module name)
+def load_importer():
+	spec = importlib.util.spec_from_file_location('data_importer', IMPORTER_PATH)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[spec.name] = module
+	spec.loader.exec_module(module)
+	return module
+
+# Original per-element conversion to float seconds, kept as the baseline for the benchmark
+def legacy_convert_float(timestamp):
+	num_digits = len(str(timestamp).split('.')[0])
+
+	if num_digits == 19:
+		return float(timestamp) / 1e9
+	elif num_digits == 16:
+		return float(timestamp) / 1e6
+	elif num_digits == 13:
+		return float(timestamp) / 1e3
+	elif num_digits == 10:
+		return float(timestamp)
+	else:
+		raise ValueError("Unsupported timestamp precision.")
+
+# Original per-element conversion to nanosecond precision ints, kept as the baseline for the benchmark
+def legacy_convert_int(timestamp):
+	num_digits = len(str(timestamp).split('.')[0])
+
+	if num_digits == 19:
+		return int(timestamp)
+	elif num_digits == 16:
+		return int(timestamp * 10**3)
+	elif num_digits == 13:
+		return int(timestamp * 10**6)
+	elif num_digits == 10:
+		return int(timestamp * 10**9)
+	else:
+		raise ValueError("Unsupported timestamp precision.")
+
+# Original pandas resample based candle aggregation, kept as the baseline for the benchmark
+def legacy_convert_tick_data_to_ohlc(df):
+	# Convert 'time' column to datetime
+	df['datetime'] = pd.to_datetime(df['time'], unit='ns')
+	
+	# Set the datetime as the index
+	df.set_index('datetime', inplace=True)
+	
+	# Drop the unnecessary 'side' column and 'time' column
+	df.drop(['trade_id', 'side', 'time'], axis=1, inplace=True)
+
+	# Create a 1-minute OHLCV dataframe
+	ohlc_1min = df.resample('min').agg({
+		'price': ['first', 'max', 'min', 'last'],
+		'volume': 'sum'
+	})
+	
+	ohlc_1min.columns = ['open', 'high', 'low', 'close', 'volume']
+	ohlc_1min['start_time'] = (ohlc_1min.index - pd.Timedelta(seconds=60) + pd.Timedelta(nanoseconds=1)).astype('int64')
+	ohlc_1min['end_time'] = ohlc_1min.index.astype('int64')
+	
+	# Define higher timeframes and their corresponding resampling rules
+	timeframes = {
+		'2min': 2,
+		'3min': 3,
+		'5min': 5,
+		'15min': 15,
+		'30min': 30,
+		'h': 60,
+		'4h': 240,
+		'D': 1440,
+		'7D': 10080
+	}
+	
+	ohlc_dataframes = {'1min': ohlc_1min}
+	
+	for rule, multiplier in timeframes.items():
+		ohlc_prev_df = ohlc_dataframes[f'{multiplier // timeframes[rule]}min']
+		
+		# Resample the previous timeframe to the current one
+		ohlc_df = ohlc_prev_df.resample(rule).agg({
+			'open': 'first',
+			'high': 'max',
+			'low': 'min',
+			'close': 'last',
+			'volume': 'sum'
+		}).dropna()
+		
+		ohlc_df['start_time'] = (ohlc_df.index - pd.Timedelta(minutes=multiplier) + pd.Timedelta(nanoseconds=1)).astype('int64')
+		ohlc_df['end_time'] = ohlc_df.index.astype('int64')
+		
+		ohlc_dataframes[rule] = ohlc_df
+
+	return ohlc_dataframes
+
+# Read the raw time column of the csv file inside a zip archive
+def read_time_column(zip_file):
+	with ZipFile(zip_file, "r") as zf:
+		csv_file = [f for f in zf.namelist() if f.endswith(".csv")][0]
+		with zf.open(csv_file) as f:
+			table = pv.read_csv(f, read_options=pv.ReadOptions(autogenerate_column_names=True))
+
+	return table.column(4).to_numpy()
+
+# Return the best wall-clock time of several runs of a function
+def best_of(func, repeat):
+	best = None
+	for _ in range(repeat):
+		start = timer()
+		func()
+		elapsed = timer() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def benchmark_timestamps(importer, zip_files, repeat):
+	print(f"{'archive':<36} {'rows':>10} {'legacy (s)':>12} {'vectorized (s)':>16} {'speedup':>10}")
+
+	for zip_file in zip_files:
+		time_column = read_time_column(zip_file)
+
+		def legacy():
+			return [legacy_convert_float(ts) for ts in time_column], [legacy_convert_int(ts) for ts in time_column]
+
+		def vectorized():
+			return importer.normalize_timestamps(time_column)
+
+		# Both implementations must produce identical columns
+		legacy_s, legacy_ns = legacy()
+		time_s, time_ns = vectorized()
+		if not (np.array_equal(legacy_s, time_s) and np.array_equal(legacy_ns, time_ns)):
+			print(f"Timestamp mismatch for {zip_file}")
+			sys.exit(1)
+
+		legacy_time = best_of(legacy, repeat)
+		vectorized_time = best_of(vectorized, repeat)
+
+		print(f"{os.path.basename(zip_file):<36} {len(time_column):>10} {legacy_time:>12.4f} {vectorized_time:>16.6f} {legacy_time / vectorized_time:>9.1f}x")
+
+def benchmark_ohlc(importer, zip_files, repeat):
+	print(f"{'archive':<36} {'rows':>10} {'resample (s)':>14} {'vectorized (s)':>16} {'speedup':>10}")
+
+	for zip_file in zip_files:
+		_, pa_candle_table = importer.read_archive(zip_file)
+		time_ns = pa_candle_table.column("time").to_numpy()
+		price = pa_candle_table.column("price").to_numpy()
+		volume = pa_candle_table.column("volume").to_numpy()
+
+		def legacy():
+			return legacy_convert_tick_data_to_ohlc(pa_candle_table.to_pandas())
+
+		def vectorized():
+			return importer.convert_tick_data_to_ohlc(time_ns, price, volume)
+
+		# Both implementations must produce identical candles for every timeframe
+		legacy_ohlc = legacy()
+		vectorized_ohlc = vectorized()
+		for tf in importer.TIMEFRAMES:
+			try:
+				pd.testing.assert_frame_equal(legacy_ohlc[tf], vectorized_ohlc[tf], check_exact=True, check_freq=False)
+			except AssertionError as e:
+				print(f"Candle mismatch for {zip_file} ({tf}): {e}")
+				sys.exit(1)
+
+		legacy_time = best_of(legacy, repeat)
+		vectorized_time = best_of(vectorized, repeat)
+
+		print(f"{os.path.basename(zip_file):<36} {len(time_ns):>10} {legacy_time:>14.4f} {vectorized_time:>16.4f} {legacy_time / vectorized_time:>9.1f}x")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the data importer on the example data.")
+	parser.add_argument("--directory", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example-data'), help="Directory containing the zip archives")
+	parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement (the best run is reported)")
+
+	args = parser.parse_args()
+
+	importer = load_importer()
+	zip_files = sorted(importer.list_files_in_directory(args.directory))
+
+	print("Timestamp normalization")
+	benchmark_timestamps(importer, zip_files, args.repeat)
+
+	print("\nCandle aggregation")
+	benchmark_ohlc(importer, zip_files, args.repeat)
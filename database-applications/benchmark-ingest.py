@@ -0,0 +1,493 @@
+# End-to-end benchmark of the data importer.
+# Imports the example archives and synthetic archives of 1M, 10M or 100M trades into MySQL or an in-process SQLite stand-in,
+# and reports per-stage timings, rows/sec and peak RSS as JSON that can be compared between runs to catch regressions.
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+from zipfile import ZipFile, ZIP_DEFLATED
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pv
+from schema import create_tables
+
+try:
+	import resource
+except ImportError:
+	# Peak RSS is only reported on Unix systems
+	resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORTER_PATH = os.path.join(SCRIPT_DIR, 'data-importer-release.py')
+EXAMPLE_DATA_DIR = os.path.join(SCRIPT_DIR, '..', 'example-data')
+
+# Archive that the synthetic archives are tiled from
+TEMPLATE_ARCHIVE = os.path.join(EXAMPLE_DATA_DIR, 'ETHBTC-trades-2022-05-31.zip')
+SYNTHETIC_SYMBOL = "SYN"
+SYNTHETIC_START_DATE = datetime(2022, 1, 1, tzinfo=timezone.utc)
+TICKS_PER_ARCHIVE = 1_000_000
+MS_PER_DAY = 86_400_000
+
+# Database connection parameters (MySQL only), the benchmark uses its own database which is dropped before every run
+DB_CONFIG = {
+	"host": "localhost",
+	"user": "",
+	"password": ""
+}
+BENCHMARK_DATABASE = "BENCHMARK_4560"
+
+# Stages reported for every dataset, in pipeline order
+# The CSV reader inflates and parses the archives ahead on its own threads, so decompress overlaps with the other stages
+# and parse is the time the importer waits for parsed blocks
+STAGES = ["decompress", "parse", "timestamps", "ohlc", "checksum", "db_write"]
+
+# Load the importer as a module (its file name is not a valid module name)
+def load_importer():
+	sys.path.insert(0, SCRIPT_DIR)
+	spec = importlib.util.spec_from_file_location('data_importer', IMPORTER_PATH)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[spec.name] = module
+	spec.loader.exec_module(module)
+	return module
+
+# Loaded on import, so the decoder processes of the importer (spawned from the benchmark processes) can find its functions
+importer = load_importer()
+
+# Parse a number of trades such as 1M, 500k or 100000
+def parse_count(value):
+	match = re.fullmatch(r"(\d+)([kKmM]?)", value)
+	if not match:
+		raise argparse.ArgumentTypeError(f"Invalid number of trades: {value}")
+
+	return int(match.group(1)) * {"": 1, "k": 1000, "m": 1_000_000}[match.group(2).lower()]
+
+# Label of a number of trades, e.g. 10000000 -> 10M
+def count_label(count):
+	if count % 1_000_000 == 0:
+		return f"{count // 1_000_000}M"
+	if count % 1000 == 0:
+		return f"{count // 1000}k"
+	return str(count)
+
+# Read the raw columns of an archive, keeping the decimal columns as text so the synthetic files use the same formatting
+def read_template(zip_file):
+	column_types = {name: pa.string() for name in importer.CSV_COLUMN_NAMES}
+	column_types[importer.CSV_COLUMN_NAMES[0]] = pa.int64()
+	column_types[importer.CSV_COLUMN_NAMES[4]] = pa.int64()
+
+	with ZipFile(zip_file, "r") as zf:
+		csv_file = [f for f in zf.namelist() if f.endswith(".csv")][0]
+		with zf.open(csv_file) as f:
+			return pv.read_csv(f, read_options=pv.ReadOptions(column_names=importer.CSV_COLUMN_NAMES), convert_options=pv.ConvertOptions(column_types=column_types))
+
+# Write one synthetic day archive: the template day repeated until it has the requested number of trades,
+# with consecutive trade ids and the repetitions squeezed into the day (millisecond timestamps like the Binance files)
+def write_synthetic_archive(path, template, trade_count, day, first_trade_id):
+	repeats = -(-trade_count // template.num_rows)
+	rows = np.arange(trade_count) % template.num_rows
+	repetition = np.arange(trade_count) // template.num_rows
+
+	template_time = template.column(4).to_numpy()
+	offsets = np.minimum(template_time - template_time[0], MS_PER_DAY - 1)
+	day_start = int((SYNTHETIC_START_DATE + timedelta(days=day)).timestamp() * 1000)
+	time_ms = day_start + (offsets[rows] + repetition * MS_PER_DAY) // repeats
+
+	columns = [pa.array(first_trade_id + np.arange(trade_count))]
+	columns += [template.column(i).take(pa.array(rows)) for i in (1, 2, 3)]
+	columns += [pa.array(time_ms)] + [template.column(i).take(pa.array(rows)) for i in (5, 6)]
+	table = pa.table(columns, names=template.column_names)
+
+	csv_name = os.path.basename(path).replace(".zip", ".csv")
+	csv_path = path + ".csv.tmp"
+	try:
+		pv.write_csv(table, csv_path, write_options=pv.WriteOptions(include_header=False, quoting_style="none"))
+		with ZipFile(path + ".tmp", "w", ZIP_DEFLATED) as zf:
+			zf.write(csv_path, csv_name)
+		os.replace(path + ".tmp", path)
+	finally:
+		os.remove(csv_path)
+
+# Synthetic archives with a total number of trades, generated once and reused by later runs
+# Archives hold up to ticks_per_archive trades each (one per day), so larger datasets extend the smaller ones
+def synthetic_archives(work_dir, trade_count, ticks_per_archive):
+	archive_size = min(trade_count, ticks_per_archive)
+	archive_dir = os.path.join(work_dir, f"synthetic-{count_label(archive_size)}")
+	os.makedirs(archive_dir, exist_ok=True)
+
+	template = None
+	zip_files = []
+	for day in range(-(-trade_count // archive_size)):
+		date = (SYNTHETIC_START_DATE + timedelta(days=day)).strftime("%Y-%m-%d")
+		path = os.path.join(archive_dir, f"{SYNTHETIC_SYMBOL}-trades-{date}.zip")
+
+		if not os.path.exists(path):
+			if template is None:
+				template = read_template(TEMPLATE_ARCHIVE)
+			print(f"Generating {os.path.basename(path)} ({archive_size} trades)")
+			write_synthetic_archive(path, template, archive_size, day, 1 + day * archive_size)
+		zip_files.append(path)
+
+	return zip_files
+
+# Accumulated time per pipeline stage, over all threads
+# Calls made from within another stage of the same thread are counted by the outer stage, except for nested stages
+class StageTimer:
+	def __init__(self):
+		self.totals = defaultdict(float)
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def add(self, stage, elapsed):
+		with self.lock:
+			self.totals[stage] += elapsed
+
+	def timed(self, func, stage, nested=False):
+		def wrapper(*args, **kwargs):
+			outer = getattr(self.local, "stage", None)
+			if outer is not None and not nested:
+				return func(*args, **kwargs)
+
+			self.local.stage = stage
+			start = timer()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.add(stage, timer() - start)
+				self.local.stage = outer
+		return wrapper
+
+	# Time every step of an iterator, not the time the caller spends on the items
+	def timed_iter(self, func, stage):
+		def wrapper(*args, **kwargs):
+			iterator = iter(func(*args, **kwargs))
+			step = self.timed(lambda: next(iterator, StopIteration), stage)
+			while True:
+				item = step()
+				if item is StopIteration:
+					return
+				yield item
+		return wrapper
+
+# File of a zip archive whose reads are timed as decompression (the CSV reader reads ahead on its own threads)
+class TimedReader:
+	def __init__(self, file, stages):
+		self.file = file
+		for name in ["read", "read1", "readinto", "peek"]:
+			setattr(self, name, stages.timed(getattr(file, name), "decompress", nested=True))
+
+	def __getattr__(self, name):
+		return getattr(self.file, name)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.file.close()
+
+def timed_zip_file(stages):
+	class TimedZipFile(ZipFile):
+		def open(self, *args, **kwargs):
+			return TimedReader(super().open(*args, **kwargs), stages)
+
+	return TimedZipFile
+
+# Database connection whose commits are timed as database writes
+class TimedConnection:
+	def __init__(self, connection, stages):
+		self.connection = connection
+		self.commit = stages.timed(connection.commit, "db_write")
+
+	def __getattr__(self, name):
+		return getattr(self.connection, name)
+
+# Translate a MySQL statement of the importer to SQLite, returns the statements to run
+def translate_statement(query, params=None):
+	if query.startswith("LOAD DATA"):
+		raise sqlite3.NotSupportedError("LOAD DATA LOCAL INFILE is not supported by the SQLite stand-in")
+	if params is not None:
+		query = query.replace("%s", "?")
+
+	if " ON DUPLICATE KEY UPDATE " in query:
+		insert, clause = query.split(" ON DUPLICATE KEY UPDATE ", 1)
+		clause = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", clause)
+		clause = re.sub(r"\bIF\(", "IIF(", clause.replace("GREATEST(", "MAX(").replace("LEAST(", "MIN("))
+		return [f"{insert} ON CONFLICT DO UPDATE SET {clause}"]
+
+	match = re.match(r"CREATE TABLE IF NOT EXISTS (\w+)", query)
+	if match:
+		# Indexes are created separately, and tables with a primary key are clustered on it like InnoDB tables
+		table_name = match.group(1)
+		indexes = re.findall(r", INDEX (\w+) \((\w+)\)", query)
+		query = re.sub(r", INDEX \w+ \(\w+\)", "", query).replace(" ON UPDATE CURRENT_TIMESTAMP", "")
+		if "PRIMARY KEY" in query:
+			query += " WITHOUT ROWID"
+		return [query] + [f"CREATE INDEX IF NOT EXISTS {table_name}_{name} ON {table_name} ({column})" for name, column in indexes]
+
+	return [query]
+
+# In-process SQLite stand-in for MySQL, understands the statements the importer uses
+class SQLiteConnection:
+	def __init__(self, path):
+		self.connection = sqlite3.connect(path, timeout=600, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+
+	def cursor(self):
+		return SQLiteCursor(self.connection.cursor())
+
+	def commit(self):
+		self.connection.commit()
+
+	def rollback(self):
+		self.connection.rollback()
+
+	def close(self):
+		self.connection.close()
+
+class SQLiteCursor:
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	def execute(self, query, params=None):
+		for statement in translate_statement(query, params):
+			self.cursor.execute(statement, params or ())
+
+	def fetchall(self):
+		return self.cursor.fetchall()
+
+	def fetchone(self):
+		return self.cursor.fetchone()
+
+	def close(self):
+		self.cursor.close()
+
+# Connection parameters of the benchmark database
+def benchmark_db_config(options):
+	if options["database"] == "sqlite":
+		return {"path": os.path.join(options["work_dir"], "ingest-benchmark.db")}
+
+	return {**DB_CONFIG, "database": BENCHMARK_DATABASE, "allow_local_infile": options["load_method"] == "infile"}
+
+def connect(db_config):
+	if "path" in db_config:
+		return SQLiteConnection(db_config["path"])
+
+	return importer.mysql.connector.connect(**db_config)
+
+# Start every dataset with an empty database
+def reset_database(options):
+	db_config = benchmark_db_config(options)
+
+	if options["database"] == "sqlite":
+		for suffix in ["", "-wal", "-shm"]:
+			if os.path.exists(db_config["path"] + suffix):
+				os.remove(db_config["path"] + suffix)
+		return
+
+	db_connector = importer.mysql.connector.connect(**DB_CONFIG)
+	db_cursor = db_connector.cursor()
+	db_cursor.execute(f"DROP DATABASE IF EXISTS {BENCHMARK_DATABASE}")
+	db_cursor.execute(f"CREATE DATABASE {BENCHMARK_DATABASE}")
+	db_connector.close()
+
+# Time the stages of the importer by wrapping its functions (decoders in other processes are not covered, see --workers)
+def instrument(stages):
+	importer.ZipFile = timed_zip_file(stages)
+	importer.read_trade_batches = stages.timed_iter(importer.read_trade_batches, "parse")
+	importer.normalize_timestamps = stages.timed(importer.normalize_timestamps, "timestamps")
+	importer.convert_tick_data_to_ohlc = stages.timed(importer.convert_tick_data_to_ohlc, "ohlc")
+	importer.CandleRollup.update = stages.timed(importer.CandleRollup.update, "ohlc")
+	importer.file_checksum = stages.timed(importer.file_checksum, "checksum")
+	for name in ["bulk_load", "write_candles", "begin_manifest_entry", "update_manifest_progress", "complete_manifest_entry"]:
+		setattr(importer, name, stages.timed(getattr(importer, name), "db_write"))
+
+	importer.get_db_connection = lambda db_config: TimedConnection(connect(db_config), stages)
+
+# Peak resident set size in MiB of this process and of its finished child processes
+def peak_rss():
+	if resource is None:
+		return None, None
+
+	# ru_maxrss is in KiB on Linux and in bytes on macOS
+	unit = 1 if sys.platform == "darwin" else 1024
+	return tuple(round(resource.getrusage(who).ru_maxrss * unit / (1024 * 1024), 1) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+# Import one dataset (archives grouped by symbol, each symbol into its own tables) and measure it, runs in its own process
+def run_dataset(name, groups, options, result_pipe):
+	stages = StageTimer()
+	instrument(stages)
+
+	reset_database(options)
+	db_config = benchmark_db_config(options)
+	rows = 0
+
+	start = timer()
+	for symbol, zip_files in groups.items():
+		table_name = f"{symbol}_TICK_DATA"
+
+		db_connector = connect(db_config)
+		db_cursor = db_connector.cursor()
+		create_tables(db_cursor, table_name, importer.TIMEFRAMES)
+		importer.create_manifest_table(db_cursor)
+		db_connector.commit()
+
+		importer.import_csv(zip_files, db_config, table_name, {}, workers=options["workers"], writers=options["writers"], load_method=options["load_method"], rows_per_statement=options["rows_per_statement"], memory_budget=options["memory_budget"])
+
+		db_cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+		rows += db_cursor.fetchone()[0]
+		db_connector.close()
+	wall = timer() - start
+
+	stage_times = {stage: round(stages.totals[stage], 4) for stage in STAGES}
+	peak_rss_mib, peak_child_rss_mib = peak_rss()
+
+	result_pipe.send({
+		"name": name,
+		"archives": sum(len(zip_files) for zip_files in groups.values()),
+		"compressed_bytes": sum(os.path.getsize(file) for zip_files in groups.values() for file in zip_files),
+		"rows": rows,
+		"wall_s": round(wall, 4),
+		"rows_per_s": round(rows / wall, 1),
+		"peak_rss_mib": peak_rss_mib,
+		"peak_child_rss_mib": peak_child_rss_mib,
+		"stages_s": stage_times,
+		"stage_rows_per_s": {stage: round(rows / seconds, 1) for stage, seconds in stage_times.items() if seconds > 0}
+	})
+
+# Run a dataset in a fresh interpreter, so its peak RSS is not inflated by the datasets before it
+def run_isolated(name, groups, options):
+	context = multiprocessing.get_context("spawn")
+	receiver, sender = context.Pipe(duplex=False)
+
+	process = context.Process(target=run_dataset, args=(name, groups, options, sender))
+	process.start()
+	sender.close()
+
+	result = receiver.recv() if receiver.poll(None) else None
+	process.join()
+	return result
+
+# Commit of the working tree, to tell the runs in a comparison apart
+def git_revision():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+	except Exception:
+		return None
+
+def print_results(results):
+	print(f"\n{'dataset':<10} {'rows':>11} {'wall (s)':>10} {'rows/s':>11} {'peak RSS':>10} " + " ".join(f"{stage:>11}" for stage in STAGES))
+	for result in results:
+		rss = f"{result['peak_rss_mib']:.0f} MiB" if result["peak_rss_mib"] is not None else "n/a"
+		print(f"{result['name']:<10} {result['rows']:>11} {result['wall_s']:>10.2f} {result['rows_per_s']:>11.0f} {rss:>10} " + " ".join(f"{result['stages_s'][stage]:>11.3f}" for stage in STAGES))
+
+# Compare the results with a baseline report, returns the regressions beyond the tolerance (a fraction, e.g. 0.1 for 10%)
+def compare_results(results, baseline, tolerance):
+	regressions = []
+	baseline_results = {result["name"]: result for result in baseline["datasets"]}
+
+	print(f"\n{'dataset':<10} {'rows/s':>11} {'baseline':>11} {'change':>9} {'peak RSS':>10} {'baseline':>10} {'change':>9}")
+	for result in results:
+		previous = baseline_results.get(result["name"])
+		if previous is None:
+			continue
+
+		throughput_change = result["rows_per_s"] / previous["rows_per_s"] - 1
+		rss_change = result["peak_rss_mib"] / previous["peak_rss_mib"] - 1 if result["peak_rss_mib"] and previous["peak_rss_mib"] else 0.0
+		print(f"{result['name']:<10} {result['rows_per_s']:>11.0f} {previous['rows_per_s']:>11.0f} {throughput_change:>+9.1%} {result['peak_rss_mib'] or 0:>10.0f} {previous['peak_rss_mib'] or 0:>10.0f} {rss_change:>+9.1%}")
+
+		if throughput_change < -tolerance:
+			regressions.append(f"{result['name']}: throughput {throughput_change:+.1%}")
+		if rss_change > tolerance:
+			regressions.append(f"{result['name']}: peak RSS {rss_change:+.1%}")
+
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the data importer end to end on the example data and on synthetic archives.")
+	parser.add_argument("--database", type=str, choices=["sqlite", "mysql"], default="sqlite", help="Import into an in-process SQLite stand-in or into a local MySQL/MariaDB server")
+	parser.add_argument("--scales", type=parse_count, nargs="*", default=[1_000_000, 10_000_000], help="Numbers of trades of the synthetic datasets (e.g. 1M 10M 100M)")
+	parser.add_argument("--skip-example", action="store_true", help="Do not benchmark the archives in example-data")
+	parser.add_argument("--ticks-per-archive", type=parse_count, default=TICKS_PER_ARCHIVE, help="Trades per synthetic (daily) archive")
+	parser.add_argument("--workers", type=int, default=1, help="Importer decoder processes (stages of other processes than the writers are not timed)")
+	parser.add_argument("--writers", type=int, default=1, help="Importer database writer threads")
+	parser.add_argument("--load-method", type=str, choices=["infile", "insert"], default=None, help="Bulk-load backend (defaults to infile for MySQL, insert for SQLite)")
+	parser.add_argument("--rows-per-statement", type=int, default=10_000, help="Rows per multi-row INSERT statement")
+	parser.add_argument("--memory-budget", type=int, default=None, help="Benchmark the streaming import with this memory budget in MiB")
+	parser.add_argument("--work-dir", type=str, default=os.path.join(tempfile.gettempdir(), "ingest-benchmark"), help="Directory for the synthetic archives and the SQLite database")
+	parser.add_argument("--output", type=str, default="benchmark-ingest.json", help="JSON file the results are written to")
+	parser.add_argument("--compare", type=str, default=None, help="JSON results of a previous run to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change that counts as a regression when comparing (default: 0.1)")
+
+	args = parser.parse_args()
+
+	if args.database == "sqlite" and args.load_method == "infile":
+		parser.error("The SQLite stand-in only supports the insert load method")
+
+	os.makedirs(args.work_dir, exist_ok=True)
+	options = {
+		"database": args.database,
+		"work_dir": args.work_dir,
+		"workers": args.workers,
+		"writers": args.writers,
+		"load_method": args.load_method or ("infile" if args.database == "mysql" else "insert"),
+		"rows_per_statement": args.rows_per_statement,
+		"memory_budget": args.memory_budget
+	}
+
+	# Datasets to import, each a mapping of symbol to its archives
+	datasets = []
+	if not args.skip_example:
+		example_groups = defaultdict(list)
+		for file in sorted(importer.list_files_in_directory(EXAMPLE_DATA_DIR)):
+			example_groups[importer.archive_symbol(file)].append(file)
+		datasets.append(("example", dict(example_groups)))
+	for trade_count in args.scales:
+		datasets.append((count_label(trade_count), {SYNTHETIC_SYMBOL: synthetic_archives(args.work_dir, trade_count, args.ticks_per_archive)}))
+
+	results = []
+	for name, groups in datasets:
+		print(f"Benchmarking {name}")
+		result = run_isolated(name, groups, options)
+		if result is None:
+			print(f"The import of {name} failed")
+			sys.exit(1)
+		results.append(result)
+
+	report = {
+		"created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+		"revision": git_revision(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpu_count": os.cpu_count(),
+		"versions": {"numpy": np.__version__, "pyarrow": pa.__version__, "pandas": importer.pd.__version__},
+		"options": {key: value for key, value in options.items() if key != "work_dir"},
+		"datasets": results
+	}
+
+	print_results(results)
+	with open(args.output, "w") as f:
+		json.dump(report, f, indent=2)
+	print(f"\nResults written to {args.output}")
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+
+		regressions = compare_results(results, baseline, args.tolerance)
+		if regressions:
+			print("\nRegressions:")
+			for regression in regressions:
+				print(f"  {regression}")
+			sys.exit(1)
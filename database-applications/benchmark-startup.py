@@ -0,0 +1,64 @@
+# Benchmark of the startup time of the command line scripts.
+# Runs every script with --help (and with --plan for a symbol, if one is given) in fresh interpreters and reports the median and
+# fastest wall time, together with the import time of the frameworks the scripts only load in the stages that need them.
+
+import os
+import sys
+import argparse
+import subprocess
+from statistics import median
+from timeit import default_timer as timer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = ['data-importer-release.py', 'preprocess-release.py', 'lstm-release.py', 'inference-service.py']
+
+# Frameworks that are imported lazily
+FRAMEWORKS = ['tensorflow', 'sklearn.preprocessing', 'pandas', 'pyarrow.parquet']
+
+# Wall times of a command run repeat times in fresh processes, fails if the command fails
+def run_times(command, repeat, cwd=None):
+	times = []
+	for _ in range(repeat):
+		start = timer()
+		result = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+		times.append(timer() - start)
+		if result.returncode != 0:
+			raise RuntimeError(f"failed: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+	return times
+
+def report(name, times):
+	print(f"  {name:<48} median {median(times):6.2f}s  fastest {min(times):6.2f}s")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the startup time of the command line scripts.")
+	parser.add_argument("--directory", type=str, default=SCRIPT_DIR, help="Directory of the scripts (e.g. a checkout of an earlier version)")
+	parser.add_argument("--repeat", type=int, default=5, help="Runs per command")
+	parser.add_argument("--table-prefix", type=str, default=None, help="Also time the --plan runs of the preprocessing and LSTM scripts for this symbol")
+	parser.add_argument("--tick-store", type=str, default=None, help="Plan the preprocessing from this Parquet tick store instead of the database")
+	parser.add_argument("--work-dir", type=str, default=".", help="Directory of the preprocessed data and scaler for the LSTM --plan run")
+
+	args = parser.parse_args()
+
+	print("Startup (--help)")
+	for script in SCRIPTS:
+		path = os.path.join(args.directory, script)
+		if os.path.exists(path):
+			report(script, run_times([sys.executable, path, "--help"], args.repeat))
+
+	if args.table_prefix:
+		print("\nPlan (--plan)")
+		commands = [
+			("preprocess-release.py", ["--tick-store", args.tick_store] if args.tick_store else [], None),
+			("lstm-release.py", [], args.work_dir)
+		]
+		for script, options, cwd in commands:
+			command = [sys.executable, os.path.join(os.path.abspath(args.directory), script), "--table-prefix", args.table_prefix, "--plan"] + options
+			try:
+				report(script, run_times(command, args.repeat, cwd))
+			except RuntimeError as e:
+				print(f"  {script:<48} {e}")
+
+	print("\nFramework imports")
+	for framework in FRAMEWORKS:
+		report(f"import {framework}", run_times([sys.executable, "-c", f"import {framework}"], args.repeat))
@@ -0,0 +1,116 @@
+# Benchmark of the LSTM training and inference.
+# Compares the tf.data pipeline with one fit over all sequences against the previous schedule of one fit per block of sequences,
+# reporting training steps/sec, and the batches/sec each input pipeline delivers on its own.
+# Also reports the predictions/sec of the trained model in every inference precision, and their largest difference to float32.
+
+import os
+import sys
+import argparse
+import importlib.util
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+LSTM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lstm-release.py')
+
+# Load the LSTM script as a module (its file name is not a valid module name)
+def load_lstm():
+	sys.path.insert(0, os.path.dirname(LSTM_PATH))
+	spec = importlib.util.spec_from_file_location('lstm_release', LSTM_PATH)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[spec.name] = module
+	spec.loader.exec_module(module)
+	return module
+
+# Features of a preprocessed Parquet file, or a random walk scaled to [0, 1] like the preprocessed data
+def load_features(lstm, data_file, ticks):
+	if data_file:
+		return lstm.load_features(pd.read_parquet(data_file).iloc[:ticks])
+
+	rng = np.random.default_rng(0)
+	price = np.cumsum(rng.normal(size=ticks))
+	features = np.column_stack([price, rng.exponential(size=ticks), np.arange(ticks), rng.integers(0, 2, ticks)]).astype(np.float32)
+	return (features - features.min(axis=0)) / np.ptp(features, axis=0)
+
+# Previous schedule: one fit per block of sequences (as arrays), validating on the last 20% of every block
+def train_blocks(lstm, model, features, block_size, batch_size, epochs):
+	samples = len(features) - lstm.SEQUENCE_LENGTH
+	steps = 0
+	for block_start in range(0, samples, block_size):
+		block_end = min(block_start + block_size, samples)
+		split = block_start + int((1 - lstm.VALIDATION_SPLIT) * (block_end - block_start))
+		train = lstm.WindowSequence(features, lstm.SEQUENCE_LENGTH, block_size, block_start, split, shuffle=True)[0]
+		validation = lstm.WindowSequence(features, lstm.SEQUENCE_LENGTH, block_size, split, block_end)[0]
+		model.fit(*train, batch_size=batch_size, validation_data=validation, epochs=epochs, verbose=0)
+		steps += -(-len(train[0]) // batch_size) * epochs
+	return steps
+
+# tf.data pipeline: one fit over all sequences, validating on the last 20% of them
+def train_dataset(lstm, model, features, shuffle_buffer, batch_size, epochs):
+	samples = len(features) - lstm.SEQUENCE_LENGTH
+	split = int((1 - lstm.VALIDATION_SPLIT) * samples)
+	train = lstm.window_dataset(features, lstm.SEQUENCE_LENGTH, batch_size, 0, split, shuffle_buffer)
+	validation = lstm.window_dataset(features, lstm.SEQUENCE_LENGTH, batch_size, split, samples, cache=True)
+	model.fit(train, validation_data=validation, epochs=epochs, verbose=0)
+	return -(-split // batch_size) * epochs
+
+# Predictions/sec of a model on the first sequences of a feature array (after a warm-up run), and the predictions
+def predict_rate(lstm, model, features, count):
+	sequences = lstm.WindowSequence(features, lstm.SEQUENCE_LENGTH, count)[0][0]
+	model.predict(sequences, batch_size=lstm.PREDICT_BATCH_SIZE, verbose=0)
+	start = timer()
+	predictions = model.predict(sequences, batch_size=lstm.PREDICT_BATCH_SIZE, verbose=0)
+	return len(sequences) / (timer() - start), predictions
+
+# Batches/sec of an input pipeline without a model
+def input_rate(batches):
+	start = timer()
+	count = sum(1 for _ in batches)
+	return count / (timer() - start)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the LSTM training input pipelines.")
+	parser.add_argument("--data", type=str, default=None, help="Preprocessed Parquet file to train on (default: a synthetic random walk)")
+	parser.add_argument("--ticks", type=int, default=50_000, help="Number of ticks to train on")
+	parser.add_argument("--block-size", type=int, default=10_000, help="Sequences per fit call of the previous schedule (lstm-release.py used 100000)")
+	parser.add_argument("--batch-size", type=int, default=32, help="Sequences per training batch")
+	parser.add_argument("--shuffle-buffer", type=int, default=100_000, help="Shuffle buffer of the tf.data pipeline")
+	parser.add_argument("--epochs", type=int, default=1, help="Epochs per fit")
+	parser.add_argument("--predictions", type=int, default=20_000, help="Number of predictions per inference precision")
+	parser.add_argument("--device", type=str, choices=["auto", "cpu", "gpu"], default="auto", help="Device to run on")
+	parser.add_argument("--intra-op-threads", type=int, default=0, help="Threads used within an operation (default: chosen by TensorFlow)")
+	parser.add_argument("--inter-op-threads", type=int, default=0, help="Operations run in parallel (default: chosen by TensorFlow)")
+	parser.add_argument("--lstm-impl", type=str, choices=["auto", "cudnn", "generic"], default="auto", help="LSTM implementation")
+
+	args = parser.parse_args()
+
+	lstm = load_lstm()
+	lstm.configure_device(args.device, args.intra_op_threads, args.inter_op_threads)
+	features = load_features(lstm, args.data, args.ticks)
+	samples = len(features) - lstm.SEQUENCE_LENGTH
+	print(f"{len(features):,} ticks, {samples:,} sequences, {os.cpu_count()} CPUs, GPUs: {len(tf.config.list_physical_devices('GPU'))}")
+
+	print("\nInput pipeline only")
+	sequence = lstm.WindowSequence(features, lstm.SEQUENCE_LENGTH, args.batch_size, shuffle=True)
+	print(f"  Sequence:  {input_rate(sequence[i] for i in range(len(sequence))):,.0f} batches/s")
+	dataset = lstm.window_dataset(features, lstm.SEQUENCE_LENGTH, args.batch_size, shuffle_buffer=args.shuffle_buffer)
+	print(f"  tf.data:   {input_rate(dataset):,.0f} batches/s")
+
+	print("\nTraining")
+	for name, train in [
+		("blocks", lambda model: train_blocks(lstm, model, features, args.block_size, args.batch_size, args.epochs)),
+		("tf.data", lambda model: train_dataset(lstm, model, features, args.shuffle_buffer, args.batch_size, args.epochs))
+	]:
+		model = lstm.build_model(lstm_impl=args.lstm_impl)
+		start = timer()
+		steps = train(model)
+		elapsed = timer() - start
+		print(f"  {name:<8} {steps:,} steps in {elapsed:.1f}s, {steps / elapsed:,.1f} steps/s")
+
+	print("\nInference")
+	baseline = None
+	for precision in lstm.INFERENCE_PRECISIONS:
+		rate, predictions = predict_rate(lstm, lstm.inference_model(model, lstm.SEQUENCE_LENGTH, args.lstm_impl, precision), features, args.predictions)
+		baseline = predictions if baseline is None else baseline
+		print(f"  {precision:<8} {rate:,.0f} predictions/s, max difference to float32 {np.abs(predictions - baseline).max():.2e}")
@@ -0,0 +1,79 @@
+# Bulk-load backends for writing pyarrow tables to MySQL.
+# Rows are rendered to SQL literals column by column with pyarrow compute, so no Python tuples are built per row.
+
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pv
+
+# Default number of rows per multi-row INSERT statement
+ROWS_PER_STATEMENT = 10_000
+
+# Render a column as SQL literals, NaN and null values become the given null marker
+def column_to_text(column, null_marker):
+	if pa.types.is_boolean(column.type):
+		column = pc.cast(column, pa.int8())
+	elif pa.types.is_floating(column.type):
+		column = pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+
+	return pc.fill_null(pc.cast(column, pa.string()), null_marker)
+
+# Insert a table with multi-row INSERT statements of rows_per_statement rows each
+# An ON DUPLICATE KEY UPDATE clause can be given to merge the rows into existing ones
+def insert_multirow(db_cursor, table_name, table, rows_per_statement=ROWS_PER_STATEMENT, on_duplicate=None):
+	if table.num_rows == 0:
+		return
+
+	columns = ", ".join(table.column_names)
+	rows = pc.binary_join_element_wise(*[column_to_text(column, "NULL") for column in table.columns], ",").combine_chunks()
+
+	# Group the rows into statements without leaving pyarrow
+	offsets = pa.array(list(range(0, len(rows), rows_per_statement)) + [len(rows)], type=pa.int32())
+	statements = pc.binary_join(pa.ListArray.from_arrays(offsets, rows), "),(")
+
+	upsert = f" ON DUPLICATE KEY UPDATE {on_duplicate}" if on_duplicate else ""
+	for values in statements:
+		db_cursor.execute(f"INSERT INTO {table_name} ({columns}) VALUES ({values}){upsert}")
+
+# Load a table with LOAD DATA LOCAL INFILE from a temporary CSV file
+# NOTE: The connection must be opened with local infile enabled (allow_local_infile=True for mysql.connector, local_infile=True for pymysql)
+def load_data_infile(db_cursor, table_name, table, rows_per_statement=None):
+	if table.num_rows == 0:
+		return
+
+	text_table = pa.table([column_to_text(column, "\\N") for column in table.columns], names=table.column_names)
+
+	fd, path = tempfile.mkstemp(suffix=".csv")
+	os.close(fd)
+	try:
+		pv.write_csv(text_table, path, write_options=pv.WriteOptions(include_header=False, quoting_style="none"))
+
+		columns = ", ".join(table.column_names)
+		db_cursor.execute(f"LOAD DATA LOCAL INFILE '{path.replace(os.sep, '/')}' INTO TABLE {table_name} FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n' ({columns})")
+	finally:
+		os.remove(path)
+
+# Available bulk-load backends
+LOAD_METHODS = {
+	"infile": load_data_infile,
+	"insert": insert_multirow
+}
+
+# Write a table with the chosen backend, falling back to multi-row INSERT if LOAD DATA is rejected by the server or client
+# Returns the method that was used, so callers can skip LOAD DATA for the following tables
+# Upserts (on_duplicate) always use multi-row INSERT, as LOAD DATA can only ignore or replace duplicate rows
+def bulk_load(db_cursor, table_name, table, method="insert", rows_per_statement=ROWS_PER_STATEMENT, on_duplicate=None):
+	if on_duplicate:
+		insert_multirow(db_cursor, table_name, table, rows_per_statement, on_duplicate)
+		return method
+
+	if method == "infile":
+		try:
+			load_data_infile(db_cursor, table_name, table)
+			return method
+		except Exception as e:
+			print(f"LOAD DATA LOCAL INFILE failed for {table_name}, falling back to multi-row INSERT: {e}")
+
+	insert_multirow(db_cursor, table_name, table, rows_per_statement)
+	return "insert"
@@ -4,240 +4,874 @@
 
 import os
 import sys
-from io import BytesIO
+import hashlib
 from zipfile import ZipFile
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 from pyarrow import csv as pv
 from pathlib import Path
 import mysql.connector
 import argparse
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from threading import Thread
+from functools import partial
+from bulk_load import LOAD_METHODS, ROWS_PER_STATEMENT, bulk_load
+from tick_store import TickStoreWriter, iter_tick_batches, write_ticks
+from schema import CANDLE_ORIGIN_NS, CANDLE_UPSERT, archive_months, create_indexes, create_tables, ensure_month_partitions, migrate_tables, table_layout
+import instrumentation
 
-def list_files_in_directory(directory):
+def list_files_in_directory(directory, extension='.zip'):
 
 	csv_files = []
 	
 	for root, _, files in os.walk(directory):
 		for file in files:
-			if file.endswith('.zip'):
+			if file.endswith(extension):
 				csv_files.append(os.path.join(root, file))
 				
 	return csv_files
 
-def convert_to_nanosecond_precision_float(timestamp):
-	# Convert the timestamp to a string to count its digits
-	timestamp_str = str(timestamp)
-	
-	# Determine the number of digits in the integer part of the timestamp
-	num_digits = len(timestamp_str.split('.')[0])
-	
-	if num_digits == 19:
-		# Already in nanoseconds as an integer, convert to float
-		return float(timestamp) / 1e9
-	elif num_digits == 16:
-		# Microseconds to nanoseconds: divide by 10^3 and then convert to float
-		return float(timestamp) / 1e6
-	elif num_digits == 13:
-		# Milliseconds to nanoseconds: divide by 10^6 and then convert to float
-		return float(timestamp) / 1e3
-	elif num_digits == 10:
-		# Seconds to nanoseconds: convert to float
-		return float(timestamp)
-	else:
-		raise ValueError("Unsupported timestamp precision. Expected 10, 13, 16, or 19 digits for seconds, milliseconds, microseconds, or nanoseconds.")
+# Nanosecond multipliers for the supported timestamp precisions, keyed by the number of digits in the timestamp
+TIMESTAMP_MULTIPLIERS = {
+	19: 1,  # Nanoseconds
+	16: 10**3,  # Microseconds
+	13: 10**6,  # Milliseconds
+	10: 10**9  # Seconds
+}
 
-def convert_to_nanosecond_precision_int(timestamp):
-	# Convert the timestamp to a string to count its digits
-	timestamp_str = str(timestamp)
-	
-	# Determine the number of digits in the integer part of the timestamp
-	num_digits = len(timestamp_str.split('.')[0])
+NANOSECONDS_PER_SECOND = 10**9
+
+# Powers of ten used to count the digits of int64 timestamps without converting them to strings
+POWERS_OF_TEN = 10 ** np.arange(19, dtype=np.int64)
+
+# Lookup table from digit count to nanosecond multiplier (0 marks an unsupported precision)
+MULTIPLIER_LOOKUP = np.zeros(20, dtype=np.int64)
+for num_digits, multiplier in TIMESTAMP_MULTIPLIERS.items():
+	MULTIPLIER_LOOKUP[num_digits] = multiplier
+
+def count_digits(values):
+	# Number of powers of ten that are less than or equal to each value, i.e. the number of digits of a positive integer
+	return np.searchsorted(POWERS_OF_TEN, values, side='right')
+
+def detect_timestamp_precision(timestamps):
+	# Detect the precision once per column from its smallest and largest values
+	num_digits = count_digits(np.array([timestamps.min(), timestamps.max()], dtype=np.int64))
 	
-	if num_digits == 19:
-		# Already in nanoseconds as an integer
-		return int(timestamp)
-	elif num_digits == 16:
-		# Microseconds to nanoseconds: multiply by 10^3
-		return int(timestamp * 10**3)
-	elif num_digits == 13:
-		# Milliseconds to nanoseconds: multiply by 10^6
-		return int(timestamp * 10**6)
-	elif num_digits == 10:
-		# Seconds to nanoseconds: multiply by 10^9
-		return int(timestamp * 10**9)
+	if num_digits[0] == num_digits[1]:
+		multiplier = MULTIPLIER_LOOKUP[num_digits[0]]
 	else:
-		raise ValueError("Unsupported timestamp precision. Expected 10, 13, 16, or 19 digits for seconds, milliseconds, microseconds, or nanoseconds.")
-
-def convert_tick_data_to_ohlc(df):
-	# Convert 'time' column to datetime
-	df['datetime'] = pd.to_datetime(df['time'], unit='ns')
+		# Mixed precisions in one column, fall back to a per-element lookup
+		multiplier = MULTIPLIER_LOOKUP[count_digits(timestamps)]
 	
-	# Set the datetime as the index
-	df.set_index('datetime', inplace=True)
+	if np.any(multiplier == 0):
+		raise ValueError("Unsupported timestamp precision. Expected 10, 13, 16, or 19 digits for seconds, milliseconds, microseconds, or nanoseconds.")
 	
-	# Drop the unnecessary 'side' column and 'time' column
-	df.drop(['trade_id', 'side', 'time'], axis=1, inplace=True)
+	return multiplier
 
-	# Create a 1-minute OHLCV dataframe
-	ohlc_1min = df.resample('min').agg({
-		'price': ['first', 'max', 'min', 'last'],
-		'volume': 'sum'
-	})
+def normalize_timestamps(timestamps):
+	# Convert a column of Unix timestamps to float seconds and int64 nanoseconds in a single vectorized pass
+	timestamps = np.asarray(timestamps, dtype=np.int64)
 	
-	ohlc_1min.columns = ['open', 'high', 'low', 'close', 'volume']
-	ohlc_1min['start_time'] = (ohlc_1min.index - pd.Timedelta(seconds=60) + pd.Timedelta(nanoseconds=1)).astype('int64')
-	ohlc_1min['end_time'] = ohlc_1min.index.astype('int64')
+	if len(timestamps) == 0:
+		return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
 	
-	# Define higher timeframes and their corresponding resampling rules
-	timeframes = {
-		'2min': 2,
-		'3min': 3,
-		'5min': 5,
-		'15min': 15,
-		'30min': 30,
-		'h': 60,
-		'4h': 240,
-		'D': 1440,
-		'7D': 10080
-	}
+	multiplier = detect_timestamp_precision(timestamps)
 	
-	ohlc_dataframes = {'1min': ohlc_1min}
+	time_ns = timestamps * multiplier
+	time_s = timestamps.astype(np.float64) / (NANOSECONDS_PER_SECOND // multiplier)
 	
-	for rule, multiplier in timeframes.items():
-		ohlc_prev_df = ohlc_dataframes[f'{multiplier // timeframes[rule]}min']
-		
-		# Resample the previous timeframe to the current one
-		ohlc_df = ohlc_prev_df.resample(rule).agg({
-			'open': 'first',
-			'high': 'max',
-			'low': 'min',
-			'close': 'last',
-			'volume': 'sum'
-		}).dropna()
-		
-		ohlc_df['start_time'] = (ohlc_df.index - pd.Timedelta(minutes=multiplier) + pd.Timedelta(nanoseconds=1)).astype('int64')
-		ohlc_df['end_time'] = ohlc_df.index.astype('int64')
-		
-		ohlc_dataframes[rule] = ohlc_df
+	return time_s, time_ns
+
+def seconds_to_nanoseconds(time_s):
+	# Recover int64 nanoseconds from float seconds (e.g. read back from the tick store), exact for up to microsecond precision
+	return np.round(np.asarray(time_s, dtype=np.float64) * 10**6).astype(np.int64) * 10**3
+
+# Candle timeframes and their lengths in minutes, each one is stored in its own {table}_{timeframe} table
+TIMEFRAME_MINUTES = {
+	'1min': 1,
+	'2min': 2,
+	'3min': 3,
+	'5min': 5,
+	'15min': 15,
+	'30min': 30,
+	'h': 60,
+	'4h': 240,
+	'D': 1440,
+	'7D': 10080
+}
+TIMEFRAMES = list(TIMEFRAME_MINUTES)
+
+MINUTE_NS = 60 * NANOSECONDS_PER_SECOND
+DAY_NS = 1440 * MINUTE_NS
+
+# Start index of each run of equal keys in a sorted array
+def group_starts(keys):
+	return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+# Per-value cost of a plain Python loop relative to one vectorized step over the groups, used to pick the cheaper summation
+KAHAN_LOOP_RATIO = 50
+
+# Compensated (Kahan) sum of each group, adding the values in order like the pandas resample sum does
+def kahan_reduceat(values, starts):
+	if len(starts) == 0:
+		return np.zeros(0)
+
+	sizes = np.diff(np.r_[starts, len(values)])
+
+	# Visit the groups from largest to smallest, so the groups that still have values left are always a prefix
+	order = np.argsort(-sizes, kind='stable')
+	sorted_starts = starts[order]
+	sorted_sizes = sizes[order]
+
+	# A few long groups (e.g. daily bars from 1-minute bars) are cheaper to sum one value at a time than one offset at a time
+	if len(values) < KAHAN_LOOP_RATIO * sorted_sizes[0]:
+		sums = []
+		for start, size in zip(starts.tolist(), sizes.tolist()):
+			total = compensation = 0.0
+			for value in values[start:start + size].tolist():
+				y = value - compensation
+				t = total + y
+				compensation = (t - total) - y
+				total = t
+			sums.append(total)
+		return np.array(sums)
+
+	totals = np.zeros(len(starts))
+	compensation = np.zeros(len(starts))
+	active = len(starts)
+
+	for offset in range(sorted_sizes[0]):
+		while sorted_sizes[active - 1] <= offset:
+			active -= 1
+
+		y = values[sorted_starts[:active] + offset] - compensation[:active]
+		t = totals[:active] + y
+		compensation[:active] = (t - totals[:active]) - y
+		totals[:active] = t
+
+	sums = np.empty_like(totals)
+	sums[order] = totals
+	return sums
+
+# Build a candle dataframe indexed by the left edge of each bar, with the same columns as the database tables
+def ohlc_dataframe(bar_times, minutes, columns):
+	columns = {**columns, 'start_time': bar_times - minutes * MINUTE_NS + 1, 'end_time': bar_times}
+	return pd.DataFrame(columns, index=pd.DatetimeIndex(bar_times.astype('datetime64[ns]'), name='datetime'))
+
+# Aggregate tick data into OHLCV candles for all timeframes in one vectorized pass over int64 nanosecond timestamps
+# Bars are aligned to the given origin, or to midnight of the first trading day if there is none
+# If trade ids are given, the first and last trade id and the number of trades of every bar are added so partial bars can be merged later
+def convert_tick_data_to_ohlc(time_ns, price, volume, trade_id=None, origin=None):
+	time_ns = np.asarray(time_ns, dtype=np.int64)
+	price = np.asarray(price, dtype=np.float64)
+	volume = np.asarray(volume, dtype=np.float64)
+	if trade_id is not None:
+		trade_id = np.asarray(trade_id, dtype=np.int64)
+
+	if len(time_ns) == 0:
+		columns = {column: np.empty(0) for column in ['open', 'high', 'low', 'close', 'volume']}
+		if trade_id is not None:
+			columns.update({column: np.empty(0, dtype=np.int64) for column in ['first_trade_id', 'last_trade_id', 'trade_count']})
+		return {tf: ohlc_dataframe(np.empty(0, dtype=np.int64), minutes, columns) for tf, minutes in TIMEFRAME_MINUTES.items()}
+
+	# Trades are expected in time order, sort them (keeping the trade order within a timestamp) if they are not
+	if np.any(time_ns[1:] < time_ns[:-1]):
+		order = np.argsort(time_ns, kind='stable')
+		time_ns, price, volume = time_ns[order], price[order], volume[order]
+		if trade_id is not None:
+			trade_id = trade_id[order]
+
+	if origin is None:
+		origin = time_ns[0] // DAY_NS * DAY_NS
+	minute = (time_ns - origin) // MINUTE_NS
+
+	# 1-minute bars from the ticks
+	starts = group_starts(minute)
+	ends = np.r_[starts[1:], len(minute)] - 1
+	bar_minute = minute[starts]
+	bar_open = price[starts]
+	bar_high = np.maximum.reduceat(price, starts)
+	bar_low = np.minimum.reduceat(price, starts)
+	bar_close = price[ends]
+
+	# The 1-minute series is continuous, minutes without trades have no prices and zero volume
+	dense_minute = np.arange(bar_minute[0], bar_minute[-1] + 1)
+	dense_volume = np.zeros(len(dense_minute))
+	dense_volume[bar_minute - bar_minute[0]] = kahan_reduceat(volume, starts)
+
+	ohlc_dataframes = {}
+
+	for rule, multiplier in TIMEFRAME_MINUTES.items():
+		if multiplier == 1:
+			columns = {}
+			for name, values in (('open', bar_open), ('high', bar_high), ('low', bar_low), ('close', bar_close)):
+				columns[name] = np.full(len(dense_minute), np.nan)
+				columns[name][bar_minute - bar_minute[0]] = values
+			columns['volume'] = dense_volume
+
+			if trade_id is not None:
+				for name, values in (('first_trade_id', trade_id[starts]), ('last_trade_id', trade_id[ends])):
+					dense_ids = np.zeros(len(dense_minute), dtype=np.int64)
+					dense_ids[bar_minute - bar_minute[0]] = values
+					columns[name] = pd.arrays.IntegerArray(dense_ids, columns['open'] != columns['open'])
+				columns['trade_count'] = np.zeros(len(dense_minute), dtype=np.int64)
+				columns['trade_count'][bar_minute - bar_minute[0]] = ends - starts + 1
+
+			ohlc_dataframes[rule] = ohlc_dataframe(origin + dense_minute * MINUTE_NS, multiplier, columns)
+			continue
+
+		# Higher timeframes are reduced from the 1-minute bars, bars without any trades are left out
+		bar_key = bar_minute // multiplier
+		bar_starts = group_starts(bar_key)
+		bar_ends = np.r_[bar_starts[1:], len(bar_key)] - 1
+
+		dense_key = dense_minute // multiplier
+		dense_starts = group_starts(dense_key)
+
+		columns = {
+			'open': bar_open[bar_starts],
+			'high': np.maximum.reduceat(bar_high, bar_starts),
+			'low': np.minimum.reduceat(bar_low, bar_starts),
+			'close': bar_close[bar_ends],
+			'volume': kahan_reduceat(dense_volume, dense_starts)[np.isin(dense_key[dense_starts], bar_key[bar_starts], assume_unique=True)]
+		}
+
+		if trade_id is not None:
+			columns['first_trade_id'] = trade_id[starts][bar_starts]
+			columns['last_trade_id'] = trade_id[ends][bar_ends]
+			columns['trade_count'] = np.add.reduceat(ends - starts + 1, bar_starts)
+
+		ohlc_dataframes[rule] = ohlc_dataframe(origin + bar_key[bar_starts] * multiplier * MINUTE_NS, multiplier, columns)
 
 	return ohlc_dataframes
 
-def import_csv(zip_files, db_connector, db_cursor):
+# Merge bars that share a start time into one bar: first open, max high, min low, last close (by trade id) and summed volume
+def merge_bars(bars):
+	if not bars.index.has_duplicates:
+		return bars
+
+	grouped = bars.groupby(level=0, sort=True)
+	merged = pd.DataFrame({
+		'open': bars.sort_values('first_trade_id', kind='stable', na_position='last').groupby(level=0, sort=True)['open'].first(),
+		'high': grouped['high'].max(),
+		'low': grouped['low'].min(),
+		'close': bars.sort_values('last_trade_id', kind='stable', na_position='first').groupby(level=0, sort=True)['close'].last(),
+		'volume': grouped['volume'].sum(),
+		'start_time': grouped['start_time'].first(),
+		'end_time': grouped['end_time'].first(),
+		'first_trade_id': grouped['first_trade_id'].min(),
+		'last_trade_id': grouped['last_trade_id'].max(),
+		'trade_count': grouped['trade_count'].sum()
+	})
+	merged.index.name = bars.index.name
+	return merged
+
+# Stateful candle builder that carries the last, possibly still open, bar of every timeframe between updates
+# Bars that are still open are only returned once they are closed by a later update, or when flushing
+class CandleRollup:
+	def __init__(self):
+		self.open_bars = {}
+
+		# Start of the last 1-minute bar, used to keep the 1-minute series continuous across updates
+		self.last_minute = None
+
+	def update(self, ohlc_df_list, flush=False):
+		closed_bars = {}
+
+		for tf, bars in ohlc_df_list.items():
+			carried = self.open_bars.pop(tf, None)
+
+			# Fill the minutes without trades between consecutive updates (archives are daily, longer gaps are left open)
+			if tf == '1min' and self.last_minute is not None and len(bars):
+				gap = np.arange(self.last_minute + MINUTE_NS, bars['end_time'].iloc[0], MINUTE_NS, dtype=np.int64)
+				if 0 < len(gap) < 1440:
+					empty = {column: np.full(len(gap), np.nan) for column in ['open', 'high', 'low', 'close']}
+					empty['volume'] = np.zeros(len(gap))
+					empty['trade_count'] = np.zeros(len(gap), dtype=np.int64)
+					empty.update({column: pd.array([None] * len(gap), dtype='Int64') for column in ['first_trade_id', 'last_trade_id']})
+					bars = pd.concat([ohlc_dataframe(gap, 1, empty), bars])
+
+			if carried is not None:
+				bars = merge_bars(pd.concat([carried, bars]).sort_index(kind='stable'))
+
+			if len(bars) and not flush:
+				self.open_bars[tf] = bars.iloc[-1:]
+				bars = bars.iloc[:-1]
+
+			if tf == '1min' and tf in self.open_bars:
+				self.last_minute = int(self.open_bars[tf]['end_time'].iloc[0])
+			elif tf == '1min' and len(bars):
+				self.last_minute = int(bars['end_time'].iloc[-1])
+
+			closed_bars[tf] = bars
+
+		return closed_bars
+
+	def flush(self):
+		return self.update({tf: bars.iloc[:0] for tf, bars in self.open_bars.items()}, flush=True)
+
+# Column names of the Binance trade CSV files (the files themselves have no header)
+CSV_COLUMN_NAMES = ["trade_id", "price", "volume", "quoteQty", "time", "side", "isBestMatch"]
+
+# Columns that are decoded from the CSV files, in table order ("quoteQty" and "isBestMatch" are never materialized)
+TICK_COLUMN_TYPES = {
+	"trade_id": pa.int64(),
+	"price": pa.float64(),
+	"volume": pa.float64(),
+	"time": pa.int64(),
+	"side": pa.bool_()
+}
+TICK_COLUMNS = list(TICK_COLUMN_TYPES)
+TICK_SCHEMA = pa.schema([("trade_id", pa.int64()), ("price", pa.float64()), ("volume", pa.float64()), ("time", pa.float64()), ("side", pa.bool_())])
+
+# Size of the decompressed blocks handed to the incremental CSV reader
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+
+def read_trade_batches(zip_file, block_size=CSV_BLOCK_SIZE):
+	with ZipFile(zip_file, "r") as zf:
+		# Get the path of the csv file
+		csv_file = [f for f in zf.namelist() if f.endswith(".csv")][0]
+		print(f"CSV: {csv_file}")  # DEBUG
+
+		# Stream the csv file straight out of the archive, one decompressed block at a time
+		with zf.open(csv_file) as f:
+			# Some Binance dumps start with a header row, skip it if the first field is not a trade id
+			has_header = not f.peek(64).split(b",", 1)[0].strip().isdigit()
+
+			read_options = pv.ReadOptions(column_names=CSV_COLUMN_NAMES, skip_rows=int(has_header), block_size=block_size)
+			convert_options = pv.ConvertOptions(column_types=TICK_COLUMN_TYPES, include_columns=TICK_COLUMNS)
+
+			with pv.open_csv(f, read_options=read_options, convert_options=convert_options) as reader:
+				for batch in reader:
+					yield batch
+
+# Convert the timestamps of a decoded CSV block, returns the tick batch (float seconds) and the nanosecond timestamps
+def decode_batch(batch):
+	time_s, time_ns = normalize_timestamps(batch.column(3).to_numpy())
+	tick_batch = pa.RecordBatch.from_arrays([batch.column(0), batch.column(1), batch.column(2), pa.array(time_s, type=pa.float64()), batch.column(4)], schema=TICK_SCHEMA)
+	return tick_batch, time_ns
+
+# Approximate size of a trade in the CSV files, used to read tick store files in batches of about one CSV block
+CSV_BYTES_PER_TRADE = 64
+
+# Decoded tick batches and their nanosecond timestamps, from a zip archive or from a tick store file
+def read_decoded_batches(file, block_size=CSV_BLOCK_SIZE):
+	if file.endswith(".parquet"):
+		for batch in iter_tick_batches(file, max(1, block_size // CSV_BYTES_PER_TRADE)):
+			yield pa.RecordBatch.from_arrays(batch.columns, schema=TICK_SCHEMA), seconds_to_nanoseconds(batch.column(3).to_numpy())
+		return
+
+	for batch in read_trade_batches(file, block_size):
+		yield decode_batch(batch)
+
+def read_archive(zip_file, block_size=CSV_BLOCK_SIZE):
+	tick_batches = []
+	time_ns_chunks = []
+
+	# Decode the archive once, converting the timestamps of each block as it arrives
+	for tick_batch, time_ns in read_decoded_batches(zip_file, block_size):
+		tick_batches.append(tick_batch)
+		time_ns_chunks.append(pa.array(time_ns, type=pa.int64()))
+
+	# Tick data keeps the float seconds timestamps, the candle data shares the same columns with nanosecond precision 64-bit int timestamps
+	pa_table = pa.Table.from_batches(tick_batches, schema=TICK_SCHEMA)
+	pa_candle_table = pa_table.set_column(3, "time", pa.chunked_array(time_ns_chunks, type=pa.int64()))
+
+	return pa_table, pa_candle_table
+
+# Symbol of a Binance archive, taken from its file name (e.g. ETHBTC-trades-2022-05-31.zip -> ETHBTC)
+# Tick store files take it from their symbol partition instead (e.g. symbol=ETHBTC/date=2022-05-31/...)
+def archive_symbol(zip_file):
+	partition = os.path.basename(os.path.dirname(os.path.dirname(zip_file)))
+	if partition.startswith("symbol="):
+		return partition.split("=", 1)[1]
+
+	return os.path.basename(zip_file).split("-")[0]
+
+# Name of an archive without its extension, which names its files in the tick store
+def archive_name(zip_file):
+	return os.path.splitext(os.path.basename(zip_file))[0]
+
+# Function to connect to the MySQL database
+def get_db_connection(db_config):
+	return instrumentation.instrument_connection(mysql.connector.connect(**db_config))
+
+# SHA-256 checksum of a file, read in 1 MiB chunks
+def file_checksum(file_path):
+	digest = hashlib.sha256()
+	with open(file_path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+# Decode an archive and aggregate its candles (runs in the decoder processes)
+def process_archive(zip_file, tick_store=None):
+	with instrumentation.span("decode", file=os.path.basename(zip_file)) as decode_span:
+		pa_table, pa_candle_table = read_archive(zip_file)
+		decode_span.add(rows=pa_table.num_rows, bytes_read=os.path.getsize(zip_file))
+
+		# Also store the ticks in the Parquet tick store (from the decoder process, so the writers are not held up)
+		if tick_store:
+			write_ticks(tick_store, archive_symbol(zip_file), archive_name(zip_file), pa_table)
+
+		# Convert the tick data to dataframes for the different timeframes
+		ohlc_df_list = convert_tick_data_to_ohlc(pa_candle_table.column("time").to_numpy(), pa_candle_table.column("price").to_numpy(), pa_candle_table.column("volume").to_numpy(), pa_candle_table.column("trade_id").to_numpy(), CANDLE_ORIGIN_NS)
+
+		return {
+			"file": zip_file,
+			"file_size": os.path.getsize(zip_file),
+			"checksum": file_checksum(zip_file),
+			"ticks": pa_table,
+			"time_ns": pa_candle_table.column("time"),
+			"candles": ohlc_df_list
+		}
+
+# Decode archives in a process pool, yielding the results in the same order as the archives were given
+def decode_archives(zip_files, workers, tick_store=None):
+	if workers <= 1:
+		for file in zip_files:
+			yield process_archive(file, tick_store)
+		return
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.configure, initargs=(instrumentation.log_path(),)) as pool:
+		pending = deque()
+
+		for file in zip_files:
+			pending.append(pool.submit(process_archive, file, tick_store))
+
+			# Keep a bounded number of archives in flight so decoded tables do not pile up in memory
+			if len(pending) >= 2 * workers:
+				yield pending.popleft().result()
+
+		while pending:
+			yield pending.popleft().result()
+
+# Manifest of the imported archives, used to skip completed archives and resume partially imported ones
+MANIFEST_TABLE = "IMPORT_MANIFEST"
+
+def create_manifest_table(db_cursor):
+	db_cursor.execute(f"CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (table_name VARCHAR(64) NOT NULL, file_name VARCHAR(255) NOT NULL, file_size BIGINT, checksum CHAR(64), row_count BIGINT, first_trade_id BIGINT, last_trade_id BIGINT, status VARCHAR(16), imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, PRIMARY KEY (table_name, file_name))")
+
+# Load the manifest entries of a table, keyed by archive file name
+def load_manifest(db_cursor, table_name):
+	db_cursor.execute(f"SELECT file_name, file_size, checksum, row_count, first_trade_id, last_trade_id, status FROM {MANIFEST_TABLE} WHERE table_name = %s", (table_name,))
+	columns = ["file_name", "file_size", "checksum", "row_count", "first_trade_id", "last_trade_id", "status"]
+	return {row[0]: dict(zip(columns, row)) for row in db_cursor.fetchall()}
+
+# Drop the archives that have already been imported completely, unless their checksums are verified and differ
+def pending_archives(zip_files, manifest, verify_checksums=False):
+	pending = []
 
-	pa_table = None
-	pa_candle_table = None
-	column_names = ["trade_id", "price", "volume", "quoteQty", "time", "side", "isBestMatch"]
-	drop_columns = ["quoteQty", "isBestMatch"]
-	
 	for file in zip_files:
-		
-		with ZipFile(file, "r") as zf:
-			# Get the path of the csv file
-			csv_file = [f for f in zf.namelist() if f.endswith(".csv")][0]
-			print(f"CSV: {csv_file}")  # DEBUG
-
-			# Open the csv file as a file-like object that pyarrow can work with and save it to a pyarrow table
-			with zf.open(csv_file) as f:
-				data = BytesIO(f.read())
-
-				pa_table = pv.read_csv(data)  # Save object to table
-				pa_table = pa_table.rename_columns(column_names)  # Rename columns of the table
-				pa_table = pa_table.drop(columns=drop_columns)  # Drop unnecessary columns from the table
-
-				# Convert Unix timestamps to nanosecond precision (float)
-				time_column = pa_table.column("time").to_numpy()
-				new_time_column = [convert_to_nanosecond_precision_float(ts) for ts in time_column]
-				new_time_column = pa.array(new_time_column, type=pa.float64())
-				pa_table = pa_table.set_column(3, "time", new_time_column)
-
-			# Re-read the csv file into another pyarrow table and convert the Unix timestamp to a nanosecond precision 64-bit int
-			with zf.open(csv_file) as f:
-				data = BytesIO(f.read())
-
-				# Create a second table
-				pa_candle_table = pv.read_csv(data)
-				pa_candle_table = pa_candle_table.rename_columns(column_names)
-				pa_candle_table = pa_candle_table.drop(columns=drop_columns)
-
-				time_column = pa_candle_table.column("time").to_numpy()
-				new_time_column = [convert_to_nanosecond_precision_int(ts) for ts in time_column]
-				new_time_column = pa.array(new_time_column, type=pa.int64())
-				pa_candle_table = pa_candle_table.set_column(3, "time", new_time_column)
-
-			# Convert and output summary of dataframes for different timeframes
-			pd_df = pa_candle_table.to_pandas()
-			ohlc_df_list = convert_tick_data_to_ohlc(pd_df)
-			timeframes = ["1min", "2min", "3min", "5min", "15min", "30min", "h", "4h", "D", "7D"]
-			for tf in timeframes:
-				try:
-					ohlc_df_list[tf] = ohlc_df_list[tf].replace(np.nan, None)
-					ohlc_val = list(ohlc_df_list[tf].itertuples(index=False, name=None))
-					ohlc_query = f"CREATE TABLE IF NOT EXISTS {test_table}_{tf} (candle_id INT NOT NULL AUTO_INCREMENT, open FLOAT, high FLOAT, low FLOAT, close FLOAT, volume FLOAT, start_time BIGINT(255), end_time BIGINT(255), PRIMARY KEY (candle_id))"
-					db_cursor.execute(ohlc_query)
-					db_connector.commit()
-					
-					ohlc_query = f"INSERT INTO {test_table}_{tf} (open, high, low, close, volume, start_time, end_time) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-					db_cursor.executemany(ohlc_query, ohlc_val)
-					db_connector.commit()
-				except Exception as e:
-					print(f"An error occurred inserting data into the database for timeframe {tf}: {e}")
-					sys.exit()
-
-			# Write table data to file and to the database in batches
-			for batch in pa_table.to_batches(max_chunksize=500000):
-				try:
-					df_batch = batch.to_pandas()  # Convert the batch of the pyarrow table into a pandas dataframe for insertion into the database
-					val = list(df_batch.itertuples(index=False, name=None))  # "INSERT" requires either tuple, or list of tuples
-					sql_query = f"INSERT INTO {test_table} VALUES (%s, %s, %s, %s, %s)"
-					db_cursor.executemany(sql_query, val)
-					db_connector.commit()
-				except Exception as e:
-					print(f"An error occurred inserting data into the database: {e}")
-					sys.exit()
+		entry = manifest.get(os.path.basename(file))
+
+		if entry is None or entry["status"] != "complete":
+			pending.append(file)
+		elif entry["file_size"] != os.path.getsize(file) or (verify_checksums and entry["checksum"] != file_checksum(file)):
+			print(f"Skipping {os.path.basename(file)}: the archive has changed since it was imported")
+		else:
+			print(f"Skipping {os.path.basename(file)}: already imported")
+
+	return pending
+
+# Mark an archive as being imported in the manifest
+def begin_manifest_entry(db_connector, db_cursor, table_name, file_name, file_size, checksum, first_trade_id):
+	try:
+		db_cursor.execute(f"INSERT INTO {MANIFEST_TABLE} (table_name, file_name, file_size, checksum, row_count, first_trade_id, last_trade_id, status) VALUES (%s, %s, %s, %s, 0, %s, NULL, 'in_progress') ON DUPLICATE KEY UPDATE file_size = VALUES(file_size), checksum = VALUES(checksum), first_trade_id = VALUES(first_trade_id), status = 'in_progress'", (table_name, file_name, file_size, checksum, first_trade_id))
+		db_connector.commit()
+	except Exception as e:
+		raise RuntimeError(f"An error occurred updating the import manifest: {e}")
+
+# Record a written tick batch in the manifest (committed by the caller together with the batch)
+def update_manifest_progress(db_cursor, table_name, file_name, batch):
+	db_cursor.execute(f"UPDATE {MANIFEST_TABLE} SET row_count = row_count + %s, last_trade_id = %s WHERE table_name = %s AND file_name = %s", (batch.num_rows, pc.max(batch.column(0)).as_py(), table_name, file_name))
+
+# Mark an archive as completely imported, committing any pending writes with it
+def complete_manifest_entry(db_connector, db_cursor, table_name, file_name):
+	try:
+		db_cursor.execute(f"UPDATE {MANIFEST_TABLE} SET status = 'complete' WHERE table_name = %s AND file_name = %s", (table_name, file_name))
+		db_connector.commit()
+	except Exception as e:
+		db_connector.rollback()
+		raise RuntimeError(f"An error occurred updating the import manifest: {e}")
+
+# Tick rows in the layout of the tick table, which stores the times as nanosecond integers
+def tick_rows(pa_table, time_ns):
+	return pa_table.set_column(3, "time", time_ns)
+
+# Merge the candle bars of all timeframes into the candle tables
+def write_candles(db_cursor, table_name, ohlc_df_list, load_method, rows_per_statement):
+	for tf in TIMEFRAMES:
+		try:
+			ohlc_table = pa.Table.from_pandas(ohlc_df_list[tf], preserve_index=False)
+			bulk_load(db_cursor, f"{table_name}_{tf}", ohlc_table, load_method, rows_per_statement, on_duplicate=CANDLE_UPSERT)
+		except Exception as e:
+			raise RuntimeError(f"An error occurred inserting data into the database for timeframe {tf}: {e}")
+
+# Write the tick and candle data of one archive to the database, returns the load method to use for the next archive
+# Each tick batch is committed together with the manifest progress, the candles are committed together with the completed status
+def write_archive(db_connector, db_cursor, table_name, archive, rollup, resume_trade_id=None, load_method="infile", rows_per_statement=ROWS_PER_STATEMENT):
+	file_name = os.path.basename(archive["file"])
+	pa_table = tick_rows(archive["ticks"], archive["time_ns"])
+	trade_ids = pa_table.column("trade_id")
+
+	begin_manifest_entry(db_connector, db_cursor, table_name, file_name, archive["file_size"], archive["checksum"], pc.min(trade_ids).as_py())
+
+	# Only append the trades that were not written by a previous, interrupted run, the candles of the trades it wrote are
+	# already stored, so the candles are built from the remaining trades
+	candles = archive["candles"]
+	if resume_trade_id is not None:
+		pa_table = pa_table.filter(pc.greater(trade_ids, resume_trade_id))
+		candles = convert_tick_data_to_ohlc(pa_table.column("time").to_numpy(), pa_table.column("price").to_numpy(), pa_table.column("volume").to_numpy(), pa_table.column("trade_id").to_numpy(), CANDLE_ORIGIN_NS)
+		print(f"Resuming {file_name} after trade {resume_trade_id}")
+
+	# Write table data to the database in batches
+	for batch in pa_table.to_batches(max_chunksize=500000):
+		try:
+			load_method = bulk_load(db_cursor, table_name, pa.Table.from_batches([batch]), load_method, rows_per_statement)
+			update_manifest_progress(db_cursor, table_name, file_name, batch)
+			db_connector.commit()
+		except Exception as e:
+			db_connector.rollback()
+			raise RuntimeError(f"An error occurred inserting data into the database: {e}")
+
+	# Merge the bars that continue bars of earlier archives or runs, and flush the open bars with the archive
+	try:
+		write_candles(db_cursor, table_name, rollup.update(candles, flush=True), load_method, rows_per_statement)
+	except Exception:
+		db_connector.rollback()
+		raise
+
+	complete_manifest_entry(db_connector, db_cursor, table_name, file_name)
+
+	return load_method
+
+# Rough peak memory of the streaming import per byte of CSV block, measured on large archives (mostly the blocks that the CSV reader
+# reads ahead, plus the decoded columns, candle arrays and the SQL text of a batch)
+STREAM_MEMORY_FACTOR = 48
+
+# CSV block size that keeps the streaming imports of all writers within a memory budget in MiB
+def stream_block_size(memory_budget, writers=1):
+	return max(1024 * 1024, memory_budget * 1024 * 1024 // (max(writers, 1) * STREAM_MEMORY_FACTOR))
+
+# Stream one archive to the database one CSV block at a time, so the memory use does not depend on the size of the archive
+# The candle bars of each block are merged into the candle tables in the same transaction as its ticks and the manifest progress,
+# so an interrupted import resumes with candles that match the committed ticks exactly
+# The whole archive is also written to the tick store if one is given (its files are only replaced once the archive is complete)
+def stream_archive(db_connector, db_cursor, table_name, zip_file, rollup, resume_trade_id=None, load_method="infile", rows_per_statement=ROWS_PER_STATEMENT, block_size=CSV_BLOCK_SIZE, tick_store=None):
+	file_name = os.path.basename(zip_file)
+	row_count = 0
+	store_writer = TickStoreWriter(tick_store, archive_symbol(zip_file), archive_name(zip_file)) if tick_store else None
+
+	if resume_trade_id is not None:
+		print(f"Resuming {file_name} after trade {resume_trade_id}")
+
+	try:
+		load_method, row_count = stream_batches(db_connector, db_cursor, table_name, zip_file, rollup, resume_trade_id, load_method, rows_per_statement, block_size, store_writer)
+	except Exception:
+		if store_writer:
+			store_writer.abort()
+		raise
+
+	if store_writer:
+		store_writer.close()
+	complete_manifest_entry(db_connector, db_cursor, table_name, file_name)
+
+	return load_method, row_count
+
+def stream_batches(db_connector, db_cursor, table_name, zip_file, rollup, resume_trade_id, load_method, rows_per_statement, block_size, store_writer):
+	file_name = os.path.basename(zip_file)
+	row_count = 0
+
+	for i, (tick_batch, time_ns) in enumerate(read_decoded_batches(zip_file, block_size)):
+		if store_writer:
+			store_writer.write(tick_batch)
+
+		if i == 0:
+			begin_manifest_entry(db_connector, db_cursor, table_name, file_name, os.path.getsize(zip_file), file_checksum(zip_file), pc.min(tick_batch.column(0)).as_py())
+
+		# Only append the trades that were not written by a previous, interrupted run
+		if resume_trade_id is not None:
+			mask = pc.greater(tick_batch.column(0), resume_trade_id)
+			tick_batch, time_ns = tick_batch.filter(mask), time_ns[mask.to_numpy(zero_copy_only=False)]
+		if tick_batch.num_rows == 0:
+			continue
+
+		ohlc_df_list = convert_tick_data_to_ohlc(time_ns, tick_batch.column(1).to_numpy(), tick_batch.column(2).to_numpy(), tick_batch.column(0).to_numpy(), CANDLE_ORIGIN_NS)
+
+		try:
+			load_method = bulk_load(db_cursor, table_name, tick_rows(pa.Table.from_batches([tick_batch]), pa.array(time_ns)), load_method, rows_per_statement)
+			write_candles(db_cursor, table_name, rollup.update(ohlc_df_list, flush=True), load_method, rows_per_statement)
+			update_manifest_progress(db_cursor, table_name, file_name, tick_batch)
+			db_connector.commit()
+		except Exception as e:
+			db_connector.rollback()
+			raise RuntimeError(f"An error occurred inserting data into the database: {e}")
+
+		row_count += tick_batch.num_rows
+
+	return load_method, row_count
+
+# Stream one archive into the tick store only, returns the number of trades
+def store_archive(zip_file, tick_store, block_size=CSV_BLOCK_SIZE):
+	store_writer = TickStoreWriter(tick_store, archive_symbol(zip_file), archive_name(zip_file))
+	row_count = 0
+
+	with instrumentation.span("store", file=os.path.basename(zip_file)) as store_span:
+		try:
+			for tick_batch, _ in read_decoded_batches(zip_file, block_size):
+				store_writer.write(tick_batch)
+				row_count += tick_batch.num_rows
+		except Exception:
+			store_writer.abort()
+			raise
+
+		store_writer.close()
+		store_span.add(rows=row_count, bytes_read=os.path.getsize(zip_file))
+	return row_count
+
+# Stream the archives into the tick store in a process pool, without a database
+def store_archives(zip_files, tick_store, workers=1, block_size=CSV_BLOCK_SIZE):
+	store = partial(store_archive, tick_store=tick_store, block_size=block_size)
+
+	if workers <= 1:
+		row_counts = map(store, zip_files)
+		for file, row_count in zip(zip_files, row_counts):
+			print(f"Stored {os.path.basename(file)} ({row_count} trades)")
+		return
+
+	with ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.configure, initargs=(instrumentation.log_path(),)) as pool:
+		for file, row_count in zip(zip_files, pool.map(store, zip_files)):
+			print(f"Stored {os.path.basename(file)} ({row_count} trades)")
+
+# Database writer thread, writes the archives from its queue in the order they were queued
+# In streaming mode (block_size set) the queue holds archive paths, which the writer decodes itself one block at a time
+def database_writer(db_config, table_name, manifest, write_queue, errors, load_method, rows_per_statement, block_size=None, tick_store=None):
+	db_connector = None
+	rollups = {}
+
+	while True:
+		item = write_queue.get()
+		if item is None:
+			break
+
+		# Keep draining the queue after an error so the decoder stage is never blocked
+		if errors:
+			continue
+
+		zip_file = item if block_size else item["file"]
+		file_name = os.path.basename(zip_file)
+		try:
+			if db_connector is None:
+				db_connector = get_db_connection(db_config)
+				db_cursor = db_connector.cursor()
+
+			entry = manifest.get(file_name)
+			resume_trade_id = entry["last_trade_id"] if entry is not None else None
+
+			rollup = rollups.setdefault(archive_symbol(zip_file), CandleRollup())
+			with instrumentation.span("write", file=file_name, streaming=bool(block_size), resumed=resume_trade_id is not None) as write_span:
+				if block_size:
+					load_method, row_count = stream_archive(db_connector, db_cursor, table_name, zip_file, rollup, resume_trade_id, load_method, rows_per_statement, block_size, tick_store)
+					write_span.add(bytes_read=os.path.getsize(zip_file))
+				else:
+					load_method = write_archive(db_connector, db_cursor, table_name, item, rollup, resume_trade_id, load_method, rows_per_statement)
+					row_count = item["ticks"].num_rows
+				write_span.add(rows=row_count)
+			print(f"Imported {file_name} ({row_count} trades)")
+		except Exception as e:
+			errors.append(f"{file_name}: {e}")
+
+	if db_connector is not None:
+		db_connector.close()
+
+# Import the archives, either decoding them whole in a process pool or, with a memory budget (MiB), streaming them block by block in the writers
+# The ticks are also written to the Parquet tick store if one is given, without a database config only the tick store is written
+def import_csv(zip_files, db_config, table_name, manifest=None, workers=1, writers=1, queue_size=4, load_method="infile", rows_per_statement=ROWS_PER_STATEMENT, memory_budget=None, tick_store=None):
+	manifest = manifest or {}
+	errors = []
+	block_size = stream_block_size(memory_budget, writers) if memory_budget else None
+
+	if db_config is None:
+		try:
+			store_archives(zip_files, tick_store, workers, stream_block_size(memory_budget, workers) if memory_budget else CSV_BLOCK_SIZE)
+		except Exception as e:
+			print(f"An error occurred writing the tick store: {e}")
+			sys.exit()
+		return
+
+	# Every symbol is always routed to the same writer, so its archives are written in order
+	write_queues = [Queue(maxsize=queue_size) for _ in range(writers)]
+	writer_threads = [Thread(target=database_writer, args=(db_config, table_name, manifest, write_queue, errors, load_method, rows_per_statement, block_size, tick_store)) for write_queue in write_queues]
+	for thread in writer_threads:
+		thread.start()
+
+	symbols = sorted({archive_symbol(file) for file in zip_files})
+	symbol_writers = {symbol: i % writers for i, symbol in enumerate(symbols)}
+
+	try:
+		archives = zip_files if block_size else decode_archives(zip_files, workers, tick_store)
+		for archive in archives:
+			if errors:
+				break
+
+			# Blocks while the writer is busy, which keeps the number of decoded archives in memory bounded
+			write_queues[symbol_writers[archive_symbol(archive if block_size else archive["file"])]].put(archive)
+	finally:
+		for write_queue in write_queues:
+			write_queue.put(None)
+		for thread in writer_threads:
+			thread.join()
+
+	if errors:
+		for error in errors:
+			print(f"An error occurred importing {error}")
+		sys.exit()
 
 if __name__ == "__main__":
 	# Set up argument parser
 	parser = argparse.ArgumentParser(description="Import trade data from CSV files into a MySQL database.")
 	parser.add_argument("--directory", type=str, required=True, help="Directory containing the CSV files")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes decoding archives in parallel")
+	parser.add_argument("--writers", type=int, default=1, help="Number of database writer threads")
+	parser.add_argument("--load-method", type=str, choices=list(LOAD_METHODS), default="infile", help="Bulk-load backend (LOAD DATA LOCAL INFILE falls back to multi-row INSERT if it is not allowed)")
+	parser.add_argument("--rows-per-statement", type=int, default=ROWS_PER_STATEMENT, help="Rows per multi-row INSERT statement")
+	parser.add_argument("--defer-indexes", action="store_true", help="Create the table indexes after the import instead of before it")
+	parser.add_argument("--incremental", action="store_true", help="Keep the existing database, skip archives that were already imported and resume interrupted ones")
+	parser.add_argument("--verify-checksums", action="store_true", help="In incremental mode, also compare the checksums of already imported archives")
+	parser.add_argument("--memory-budget", type=int, default=None, help="Stream the archives block by block within this memory budget in MiB (the archives are then decoded by the writers)")
+	parser.add_argument("--target", type=str, choices=["mysql", "parquet", "both"], default="mysql", help="Write the ticks to MySQL, to the Parquet tick store, or to both")
+	parser.add_argument("--tick-store", type=str, default=None, help="Directory of the Parquet tick store (required for the parquet and both targets)")
+	parser.add_argument("--partition-by-month", action="store_true", help="RANGE partition new tick and candle tables by month")
+	parser.add_argument("--migrate-schema", action="store_true", help="In incremental mode, migrate existing tables of the legacy layout to the compact layout in place")
+	parser.add_argument("--source", type=str, choices=["zip", "tick-store"], default="zip", help="Import Binance zip archives, or the files of a Parquet tick store (e.g. STORE/symbol=ETHBTC) into MySQL")
+	parser.add_argument("--metrics-log", type=str, default=None, help="Append the time, rows, bytes read, peak memory and database time of every stage to this file as JSON lines ('-' for stderr)")
+	parser.add_argument("--profile", type=str, default=None, help="Run under cProfile and write the stats of the main process to this file")
 	
 	args = parser.parse_args()
+
+	if args.target != "mysql" and not args.tick_store:
+		print("--tick-store is required when writing to the tick store")
+		sys.exit()
+	if args.source == "tick-store" and args.target != "mysql":
+		print("A tick store can only be imported into MySQL")
+		sys.exit()
+	if args.migrate_schema and not args.incremental:
+		print("--migrate-schema requires --incremental (otherwise the database is recreated)")
+		sys.exit()
+
+	# Spans left open by an error are written when the script exits
+	instrumentation.configure(args.metrics_log, args.profile)
+	import_span = instrumentation.start_span("import", directory=args.directory, target=args.target, source=args.source)
+
 	directory_to_search = args.directory
-	dir_name = Path(directory_to_search).name
+	# Tables of a tick store symbol partition are named after the symbol (symbol=ETHBTC -> ETHBTC_TICK_DATA)
+	dir_name = Path(directory_to_search).name.split("=")[-1]
 	clear_db_query = "DROP DATABASE IF EXISTS PROJECT_4560"
-	create_db_querys = ["CREATE DATABASE IF NOT EXISTS PROJECT_4560", "USE PROJECT_4560", f"CREATE TABLE {dir_name}_TICK_DATA (trade_id INT, price FLOAT, volume FLOAT, time DOUBLE PRECISION(19,8), side VARCHAR(255))"]
+	create_db_querys = ["CREATE DATABASE IF NOT EXISTS PROJECT_4560", "USE PROJECT_4560"]
 
 	test_database = "PROJECT_4560"
 	test_table = f"{dir_name}_TICK_DATA"
 
-	# Connect to MySQL server
-	db_connector = mysql.connector.connect(host="localhost", user="", password="")
-	db_cursor = db_connector.cursor()
+	# Database connection parameters
+	DB_CONFIG = {
+		"host": "localhost",
+		"user": "",
+		"password": ""
+	}
 
-	# DEBUG: Clear the database if it exists
-	try:
-		db_cursor.execute(clear_db_query)  
-		db_connector.commit()
-	except Exception as e:
-		print(f"An error occurred when preparing the database: {e}")
-		sys.exit()
+	use_database = args.target != "parquet"
+	manifest = {}
 
-	# Create the database if it does not exist
-	for statement in create_db_querys:
+	if use_database:
+		prepare_span = instrumentation.start_span("prepare_database", incremental=args.incremental)
+
+		# Connect to MySQL server
+		db_connector = get_db_connection(DB_CONFIG)
+		db_cursor = db_connector.cursor()
+
+		# DEBUG: Clear the database if it exists (unless only new archives are imported)
+		if not args.incremental:
+			try:
+				db_cursor.execute(clear_db_query)  
+				db_connector.commit()
+			except Exception as e:
+				print(f"An error occurred when preparing the database: {e}")
+				sys.exit()
+
+		# Create the database if it does not exist
+		for statement in create_db_querys:
+			try:
+				if statement == "":
+					continue
+				db_cursor.execute(statement)
+				db_connector.commit()
+			except Exception as e:
+				print(f"An error occurred when preparing the database: {e}")
+				sys.exit()
+
+		# Migrate the tables of earlier versions to the compact layout
+		if args.migrate_schema:
+			try:
+				for table in migrate_tables(db_connector, db_cursor, test_table, TIMEFRAMES, args.partition_by_month):
+					print(f"Migrated {table} to the compact layout")
+			except Exception as e:
+				print(f"An error occurred when migrating the tables: {e}")
+				sys.exit()
+
+		# Create the tick, candle and manifest tables, and load the manifest of previous runs
 		try:
-			if statement == "":
-				continue
-			db_cursor.execute(statement)
+			create_tables(db_cursor, test_table, TIMEFRAMES, args.defer_indexes, args.partition_by_month)
+			create_manifest_table(db_cursor)
 			db_connector.commit()
+			manifest = load_manifest(db_cursor, test_table)
+			layout = table_layout(db_cursor, test_table)
 		except Exception as e:
 			print(f"An error occurred when preparing the database: {e}")
 			sys.exit()
 
-	# Search for compressed CSV files
-	zip_files = list_files_in_directory(directory_to_search)
+		# Only the compact layout is written, the candle tables of the legacy layout have no trade ids to merge the bars by
+		if layout == "legacy":
+			print(f"{test_table} uses the legacy layout, run with --migrate-schema to migrate it to the compact layout before importing")
+			sys.exit(1)
+
+		prepare_span.finish(archives_imported=len(manifest))
+
+	# Search for compressed CSV files (or the files of the tick store)
+	zip_files = list_files_in_directory(directory_to_search, ".parquet" if args.source == "tick-store" else ".zip")
 
 	# Sort list of compressed csv files
 	zip_files.sort()
 
+	# Skip the archives that were imported completely by a previous run
+	zip_files = pending_archives(zip_files, manifest, args.verify_checksums)
+
+	# Add the month partitions of the new archives (only for tables that are partitioned by month)
+	if use_database:
+		try:
+			for table in [test_table] + [f"{test_table}_{tf}" for tf in TIMEFRAMES]:
+				ensure_month_partitions(db_cursor, table, archive_months(zip_files))
+		except Exception as e:
+			print(f"An error occurred when adding the table partitions: {e}")
+			sys.exit()
+
 	# Process CSV files
-	import_csv(zip_files, db_connector, db_cursor)
+	writer_config = {**DB_CONFIG, "database": test_database, "allow_local_infile": args.load_method == "infile"} if use_database else None
+	with instrumentation.span("import_archives", archives=len(zip_files), workers=args.workers, writers=args.writers):
+		import_csv(zip_files, writer_config, test_table, manifest, workers=args.workers, writers=args.writers, load_method=args.load_method, rows_per_statement=args.rows_per_statement, memory_budget=args.memory_budget, tick_store=args.tick_store if args.target != "mysql" else None)
+
+	# Build the indexes once all the data is in place
+	if use_database and args.defer_indexes:
+		try:
+			with instrumentation.span("create_indexes"):
+				create_indexes(db_cursor, test_table)
+				db_connector.commit()
+		except Exception as e:
+			print(f"An error occurred creating the table indexes: {e}")
+			sys.exit()
+
+	import_span.finish()
@@ -0,0 +1,439 @@
+# Long-running inference service for the trained LSTMs.
+# Loads the saved model and scaler of every symbol once and keeps the last 60 ticks of every symbol in memory, seeded from the
+# database or the tick store and updated with new ticks as they arrive. Prediction requests of a symbol that are waiting while
+# its model is busy are answered by one batched model call, and the latency of every request is recorded.
+# Only the symbols a model is loaded for are served.
+# NOTE: MySQL database credentials have been removed for privacy/security reasons. Fill in these values before running this script.
+
+import os
+import re
+import sys
+import json
+import queue
+import signal
+import argparse
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import joblib
+import pymysql
+from tick_store import read_ticks, trade_id_segments
+from schema import time_to_seconds
+from scaling import inverse_scale_column, scale_column
+
+LSTM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lstm-release.py')
+
+HOST = '127.0.0.1'
+PORT = 8500
+
+# Requests that are waiting when the model becomes free are predicted together, up to MAX_BATCH_SIZE windows per call.
+# A batch waits at most MAX_WAIT_MS for more requests after the first one
+MAX_BATCH_SIZE = 256
+MAX_WAIT_MS = 2
+REQUEST_TIMEOUT = 10
+
+# Number of latencies kept for the percentiles
+LATENCY_SAMPLES = 10_000
+
+# Number of new ticks fetched per symbol and poll
+POLL_PAGE_SIZE = 10_000
+
+# Symbols are table prefixes, nothing else is put into a query
+SYMBOL_PATTERN = re.compile(r'[A-Z0-9]+')
+
+# Load the LSTM script as a module (its file name is not a valid module name)
+def load_lstm():
+	sys.path.insert(0, os.path.dirname(LSTM_PATH))
+	spec = importlib.util.spec_from_file_location('lstm_release', LSTM_PATH)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[spec.name] = module
+	spec.loader.exec_module(module)
+	return module
+
+# Turn rows of (price, volume, side, trade_id, time) into a DataFrame of typed columns, from either table layout
+def ticks_from_rows(rows):
+	price, volume, side, trade_id, time = zip(*rows) if rows else ([], [], [], [], [])
+	return pd.DataFrame({
+		'price': np.asarray(price, dtype=np.float64),
+		'volume': np.asarray(volume, dtype=np.float64),
+		'side': np.asarray(side).astype(np.uint8),
+		'trade_id': np.asarray(trade_id, dtype=np.int64),
+		'time': time_to_seconds(time)
+	})
+
+# Tick table of a symbol
+def tick_table(symbol):
+	if not SYMBOL_PATTERN.fullmatch(symbol):
+		raise ValueError(f"Invalid symbol {symbol!r}")
+	return f"{symbol}_TICK_DATA"
+
+# Latest ticks of a symbol, and the ticks after a trade id, from the tick table of the symbol
+# The connection is pinged before every query, so it reconnects after wait_timeout or a restart of the server
+class DatabaseTicks:
+	def __init__(self, db_config):
+		self.connection = pymysql.connect(**db_config)
+		self.lock = threading.Lock()
+
+	def latest(self, symbol, count):
+		with self.lock:
+			self.connection.ping(reconnect=True)
+			with self.connection.cursor() as cursor:
+				cursor.execute(f"SELECT price, volume, side, trade_id, time FROM {tick_table(symbol)} ORDER BY trade_id DESC LIMIT %s", (count,))
+				rows = cursor.fetchall()
+			self.connection.commit()
+		return ticks_from_rows(rows[::-1])
+
+	def after(self, symbol, trade_id, time=None, count=POLL_PAGE_SIZE):
+		with self.lock:
+			self.connection.ping(reconnect=True)
+			with self.connection.cursor() as cursor:
+				cursor.execute(f"SELECT price, volume, side, trade_id, time FROM {tick_table(symbol)} WHERE trade_id > %s ORDER BY trade_id LIMIT %s", (trade_id, count))
+				rows = cursor.fetchall()
+			self.connection.commit()
+		return ticks_from_rows(rows)
+
+# The same from the Parquet tick store, the latest ticks are read from the last row groups of the symbol
+class TickStoreTicks:
+	def __init__(self, store_dir):
+		self.store_dir = store_dir
+
+	def latest(self, symbol, count):
+		segments = trade_id_segments(self.store_dir, symbol)
+		start, rows = None, 0
+		for segment_start, _, segment_rows in reversed(segments):
+			start, rows = segment_start, rows + segment_rows
+			if rows >= count:
+				break
+
+		if start is None:
+			return ticks_from_rows([])
+		return read_ticks(self.store_dir, symbol, start_trade_id=start).to_pandas().iloc[-count:]
+
+	# The time of the last known tick restricts the read to its date partition and the later ones, the trades after it are not older
+	def after(self, symbol, trade_id, time=None, count=POLL_PAGE_SIZE):
+		return read_ticks(self.store_dir, symbol, start_time=time, start_trade_id=trade_id + 1).to_pandas().iloc[:count]
+
+# Rolling window of the last seq_length ticks of every symbol, scaled with the scaler of the symbol
+class TickWindows:
+	def __init__(self, scalers, seq_length):
+		self.scalers = scalers
+		self.seq_length = seq_length
+		self.windows = {}
+		self.lock = threading.Lock()
+
+	def __contains__(self, symbol):
+		return symbol in self.windows
+
+	# Trade id and time of the last tick of every symbol
+	def symbols(self):
+		with self.lock:
+			return {symbol: (window['trade_id'], window['time']) for symbol, window in self.windows.items()}
+
+	# Add ticks (DataFrame with price, volume, time, side and trade_id) in trade id order, skipping ticks that are already in the window
+	# Symbols without any ticks are not kept
+	def add(self, symbol, ticks):
+		if len(ticks) == 0:
+			return len(self.windows[symbol]['ticks']) if symbol in self.windows else 0
+
+		scaler = self.scalers[symbol]
+		features = np.column_stack([
+			scale_column(ticks['price'], scaler, 'price'),
+			scale_column(ticks['volume'], scaler, 'volume'),
+			scale_column(ticks['time'], scaler, 'time'),
+			ticks['side']
+		]).astype(np.float32)
+		trade_ids = np.asarray(ticks['trade_id'], dtype=np.int64)
+		times = np.asarray(ticks['time'], dtype=np.float64)
+
+		with self.lock:
+			window = self.windows.setdefault(symbol, {'ticks': deque(maxlen=self.seq_length), 'trade_id': -1, 'time': None})
+			new = np.flatnonzero(trade_ids > window['trade_id'])
+			window['ticks'].extend(features[new[-self.seq_length:]])
+			if len(new):
+				window['trade_id'] = int(trade_ids[new[-1]])
+				window['time'] = float(times[new[-1]])
+			return len(window['ticks'])
+
+	# Model input of a symbol (seq_length x features) with the trade id and time of its last tick, or None while the window is not full
+	def snapshot(self, symbol):
+		with self.lock:
+			window = self.windows.get(symbol)
+			if window is None or len(window['ticks']) < self.seq_length:
+				return None
+			return np.stack(window['ticks']), window['trade_id'], window['time']
+
+# Latencies of the answered requests and the throughput of the model
+class LatencyStats:
+	def __init__(self):
+		self.latencies = deque(maxlen=LATENCY_SAMPLES)
+		self.predictions = 0
+		self.batches = 0
+		self.started = timer()
+		self.lock = threading.Lock()
+
+	def record(self, latencies):
+		with self.lock:
+			self.latencies.extend(latencies)
+			self.predictions += len(latencies)
+			self.batches += 1
+
+	def summary(self):
+		with self.lock:
+			latencies = np.array(self.latencies) * 1000
+			predictions, batches, elapsed = self.predictions, self.batches, timer() - self.started
+		return {
+			'predictions': predictions,
+			'predictions_per_sec': round(predictions / elapsed, 1),
+			'batches': batches,
+			'mean_batch_size': round(predictions / batches, 2) if batches else 0,
+			'p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+			'p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None,
+			'uptime_sec': round(elapsed, 1)
+		}
+
+# Collects the waiting prediction requests of a model and predicts them with one model call
+class InferenceBatcher:
+	def __init__(self, predict, stats, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+		self.predict = predict
+		self.stats = stats
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait_ms / 1000
+		self.requests = queue.Queue()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	# Future of the scaled prediction for one model input
+	def submit(self, window):
+		future = Future()
+		self.requests.put((window, future, timer()))
+		return future
+
+	def next_batch(self):
+		batch = [self.requests.get()]
+		deadline = timer() + self.max_wait
+		while len(batch) < self.max_batch_size:
+			try:
+				batch.append(self.requests.get(timeout=max(0, deadline - timer())))
+			except queue.Empty:
+				break
+		return batch
+
+	def run(self):
+		while True:
+			batch = self.next_batch()
+			try:
+				predictions = self.predict(np.stack([window for window, _, _ in batch]))
+			except Exception as e:
+				for _, future, _ in batch:
+					future.set_exception(e)
+				continue
+
+			done = timer()
+			for (_, future, _), prediction in zip(batch, predictions):
+				future.set_result(float(prediction))
+			self.stats.record([done - submitted for _, _, submitted in batch])
+
+# Model call on a batch of windows, traced once for any batch size
+def compile_predictor(lstm, model_path, seq_length, lstm_impl='auto', precision='float32'):
+	import tensorflow as tf
+	from tensorflow.keras.models import load_model
+	
+	predictor = lstm.inference_model(load_model(model_path), seq_length, lstm_impl, precision)
+
+	@tf.function(input_signature=[tf.TensorSpec([None, seq_length, len(lstm.FEATURE_COLUMNS)], tf.float32)])
+	def predict(windows):
+		return predictor(windows, training=False)
+
+	return lambda windows: predict(windows).numpy().ravel()
+
+# Prediction service: the tick windows, the batcher of the model of every symbol and the source of the ticks (database or tick store)
+class InferenceService:
+	def __init__(self, windows, batchers, stats, source):
+		self.windows = windows
+		self.batchers = batchers
+		self.stats = stats
+		self.source = source
+
+	def serves(self, symbol):
+		return symbol in self.batchers
+
+	# Seed the window of a symbol with its latest ticks the first time it is requested
+	def ensure_window(self, symbol):
+		if symbol not in self.windows:
+			self.windows.add(symbol, self.source.latest(symbol, self.windows.seq_length))
+
+	# Predicted price of the tick after the last tick of each symbol, or an error per symbol
+	def predict(self, symbols):
+		pending = {}
+		for symbol in symbols:
+			if not self.serves(symbol):
+				pending[symbol] = {'symbol': symbol, 'error': "No model for this symbol"}
+				continue
+
+			# The cause is only logged, database errors are not sent to the client
+			try:
+				self.ensure_window(symbol)
+			except Exception as e:
+				print(f"Loading the ticks of {symbol} failed: {e}")
+				pending[symbol] = {'symbol': symbol, 'error': f"No ticks for {symbol}"}
+				continue
+
+			snapshot = self.windows.snapshot(symbol)
+			if snapshot is None:
+				pending[symbol] = {'symbol': symbol, 'error': f"Fewer than {self.windows.seq_length} ticks for {symbol}"}
+			else:
+				pending[symbol] = (self.batchers[symbol].submit(snapshot[0]), snapshot[1], snapshot[2], timer())
+
+		results = []
+		for symbol, request in pending.items():
+			if isinstance(request, dict):
+				results.append(request)
+				continue
+
+			future, trade_id, time, submitted = request
+			prediction = future.result(timeout=REQUEST_TIMEOUT)
+			results.append({
+				'symbol': symbol,
+				'after_trade_id': trade_id,
+				'after_time': time,
+				'predicted_price': float(inverse_scale_column([prediction], self.windows.scalers[symbol], 'price')[0]),
+				'latency_ms': round((timer() - submitted) * 1000, 3)
+			})
+		return results
+
+	# Fetch the new ticks of all symbols in memory from the source
+	def poll(self, interval):
+		while True:
+			for symbol, (trade_id, time) in self.windows.symbols().items():
+				try:
+					self.windows.add(symbol, self.source.after(symbol, trade_id, time))
+				except Exception as e:
+					print(f"Polling {symbol} failed: {e}")
+			threading.Event().wait(interval)
+
+# HTTP endpoints of the service:
+#   GET /predict?symbol=SYMBOL[&symbol=SYMBOL...]   predicted price of the next tick of each symbol
+#   POST /ticks {"symbol": SYMBOL, "ticks": [{"trade_id", "price", "volume", "time", "side"}, ...]}   new ticks of a symbol
+# Symbols without a model are answered with 404
+#   GET /stats   p50/p99 latency, predictions/sec and batch sizes
+class RequestHandler(BaseHTTPRequestHandler):
+	service = None
+
+	def send_json(self, status, body):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path == '/stats':
+			return self.send_json(200, self.service.stats.summary())
+		if url.path != '/predict':
+			return self.send_json(404, {'error': f"Unknown path {url.path}"})
+
+		symbols = parse_qs(url.query).get('symbol', [])
+		if not symbols:
+			return self.send_json(400, {'error': "Missing symbol"})
+
+		try:
+			results = self.service.predict(symbols)
+		except Exception as e:
+			print(f"Prediction failed: {e}")
+			return self.send_json(500, {'error': "Prediction failed"})
+
+		status = 200 if any('error' not in result for result in results) else 404
+		self.send_json(status, results[0] if len(results) == 1 else results)
+
+	def do_POST(self):
+		if urlparse(self.path).path != '/ticks':
+			return self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+			if not self.service.serves(body['symbol']):
+				return self.send_json(404, {'error': "No model for this symbol"})
+			ticks = pd.DataFrame(body['ticks'], columns=['trade_id', 'price', 'volume', 'time', 'side'])
+			if ticks.isnull().values.any():
+				raise ValueError("Ticks need trade_id, price, volume, time and side")
+			window_size = self.service.windows.add(body['symbol'], ticks.sort_values('trade_id'))
+		except (KeyError, TypeError, ValueError):
+			return self.send_json(400, {'error': "Invalid ticks, they need trade_id, price, volume, time and side"})
+
+		self.send_json(200, {'symbol': body['symbol'], 'window_size': window_size})
+
+	# Requests are not logged one by one, the stats endpoint summarizes them
+	def log_message(self, format, *args):
+		pass
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serve predictions of the trained LSTM model.")
+	parser.add_argument('--host', type=str, default=HOST, help='Address to listen on')
+	parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+	parser.add_argument('--model', type=str, nargs=3, action='append', required=True, metavar=('SYMBOL', 'MODEL_PATH', 'SCALER_PATH'), help='Symbol served with a saved model and the scaler of the data it was trained on (repeat for every symbol)')
+	parser.add_argument('--tick-store', type=str, default=None, help='Read the ticks from this Parquet tick store instead of the database')
+	parser.add_argument('--poll-interval', type=float, default=0, help='Seconds between fetches of new ticks of the symbols in memory (default: 0, only ticks posted to /ticks)')
+	parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE, help='Largest number of requests predicted by one model call')
+	parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS, help='Time a batch waits for more requests after the first one')
+	parser.add_argument('--seed-windows', action='store_true', help='Load the windows of all symbols at startup instead of on their first request')
+	parser.add_argument('--device', type=str, choices=['auto', 'cpu', 'gpu'], default='auto', help='Device to run on')
+	parser.add_argument('--intra-op-threads', type=int, default=0, help='Threads used within an operation (default: chosen by TensorFlow)')
+	parser.add_argument('--inter-op-threads', type=int, default=0, help='Operations run in parallel (default: chosen by TensorFlow)')
+	parser.add_argument('--lstm-impl', type=str, choices=['auto', 'cudnn', 'generic'], default='auto', help='LSTM implementation')
+	parser.add_argument('--inference-precision', type=str, choices=['float32', 'float16', 'bfloat16'], default='float32', help='Precision of the predictions')
+
+	args = parser.parse_args()
+
+	models = {symbol: (model_path, scaler_path) for symbol, model_path, scaler_path in args.model}
+	invalid = [symbol for symbol in models if not SYMBOL_PATTERN.fullmatch(symbol)]
+	if invalid:
+		parser.error(f"Invalid symbols: {', '.join(invalid)} (symbols are table prefixes such as ETHUSDC)")
+
+	# Database connection parameters
+	DB_CONFIG = {
+		'host': 'localhost',
+		'user': '',
+		'password': '',
+		'database': 'PROJECT_4560'
+	}
+
+	lstm = load_lstm()
+	try:
+		lstm.configure_device(args.device, args.intra_op_threads, args.inter_op_threads)
+		scalers = {symbol: joblib.load(scaler_path) for symbol, (_, scaler_path) in models.items()}
+		predictors = {symbol: compile_predictor(lstm, model_path, lstm.SEQUENCE_LENGTH, args.lstm_impl, args.inference_precision) for symbol, (model_path, _) in models.items()}
+		source = TickStoreTicks(args.tick_store) if args.tick_store else DatabaseTicks(DB_CONFIG)
+	except Exception as e:
+		print(f"Could not start the inference service: {e}")
+		sys.exit(1)
+
+	stats = LatencyStats()
+	batchers = {symbol: InferenceBatcher(predict, stats, args.max_batch_size, args.max_wait_ms) for symbol, predict in predictors.items()}
+	service = InferenceService(TickWindows(scalers, lstm.SEQUENCE_LENGTH), batchers, stats, source)
+	if args.seed_windows:
+		for symbol in models:
+			service.ensure_window(symbol)
+	if args.poll_interval > 0:
+		threading.Thread(target=service.poll, args=(args.poll_interval,), daemon=True).start()
+
+	RequestHandler.service = service
+	server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+	print(f"Serving predictions on http://{args.host}:{args.port}")
+	
+	# Stopping the service with SIGTERM also prints the final statistics
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		print(json.dumps(stats.summary()))
@@ -0,0 +1,285 @@
+# Per-stage instrumentation of the scripts.
+# Stages are timed with named spans, which record their wall and CPU time, the rows and bytes they processed, the peak memory
+# of the process and the time of every database statement run while they are open. Finished spans are written as JSON lines,
+# one object per span. The bytes and database time of a span are added to the span it was opened in (its rows are not, as the
+# stages of a script usually process the same rows one after another).
+# Optionally the whole script runs under cProfile, whose stats can be read with pstats or snakeviz.
+
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import cProfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+MIB = 1024 * 1024
+
+# Statements are grouped by their text with the literals replaced by ? and the whitespace collapsed, cut to this length
+STATEMENT_LENGTH = 120
+LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b")
+
+# Number of statements with the longest total time listed per span
+TOP_STATEMENTS = 10
+
+# Log of the finished spans, shared by all threads of the process
+log_state = {'path': None, 'file': None, 'profiler': None, 'script': os.path.basename(sys.argv[0]), 'lock': threading.Lock()}
+
+# Open spans of every thread, innermost last
+span_stack = threading.local()
+
+# Peak resident memory in MiB of the process (or of its terminated child processes), None where it is not available
+def peak_rss_mib(children=False):
+	if resource is None:
+		return None
+
+	peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KiB, macOS bytes
+	return round(peak / (MIB if sys.platform == 'darwin' else 1024), 1)
+
+# Bytes the process (and its terminated child processes) has read with read system calls, None where it is not available
+def io_read_bytes():
+	try:
+		with open('/proc/self/io') as io_file:
+			for line in io_file:
+				if line.startswith('rchar:'):
+					return int(line.split()[1])
+	except OSError:
+		return None
+
+# Write the finished spans as JSON lines to a file ('-' for stderr), and run the script under cProfile if a profile path is given
+# Worker processes call this again with the same log path, every line is written at once so the processes can share the file,
+# and start without the open spans and the profiler of the process they were forked from
+def configure(log_path=None, profile_path=None):
+	if log_state['profiler'] is not None:
+		log_state['profiler'].disable()
+		log_state['profiler'] = None
+	if log_path:
+		log_state['path'] = log_path
+		log_state['file'] = sys.stderr if log_path == '-' else open(log_path, 'a', buffering=1)
+	log_state['script'] = os.path.basename(sys.argv[0])
+	span_stack.spans = []
+	atexit.unregister(finish_open_spans)
+	atexit.register(finish_open_spans)
+
+	if profile_path:
+		profiler = cProfile.Profile()
+		profiler.enable()
+		log_state['profiler'] = profiler
+		atexit.register(write_profile, profiler, profile_path)
+
+# Path of the log, for the worker processes
+def log_path():
+	return log_state['path']
+
+def write_profile(profiler, profile_path):
+	profiler.disable()
+	profiler.dump_stats(profile_path)
+	print(f"Profile written to {profile_path} (python -m pstats {profile_path})")
+
+def emit(event):
+	if log_state['file'] is None:
+		return
+
+	line = json.dumps(event, default=str) + '\n'
+	with log_state['lock']:
+		log_state['file'].write(line)
+		log_state['file'].flush()
+
+def open_spans():
+	if not hasattr(span_stack, 'spans'):
+		span_stack.spans = []
+	return span_stack.spans
+
+# Spans left open when the script exits (e.g. with sys.exit) are still written, innermost first
+def finish_open_spans():
+	for open_span in reversed(list(open_spans())):
+		open_span.finish(exited=True)
+
+# A named stage, opened in the current thread, with extra fields that are written with it
+class Span:
+	def __init__(self, name, parent=None, **fields):
+		self.name = name
+		self.parent = parent
+		self.fields = fields
+		self.rows = 0
+		self.bytes_read = 0
+		self.db_queries = 0
+		self.db_time = 0.0
+		self.statements = {}
+		self.start_time = datetime.now(timezone.utc)
+		self.start = timer()
+		self.cpu_start = time.process_time()
+		self.io_start = io_read_bytes()
+		self.finished = False
+
+	def path(self):
+		return self.name if self.parent is None else f"{self.parent.path()}/{self.name}"
+
+	def add(self, rows=0, bytes_read=0):
+		self.rows += rows
+		self.bytes_read += bytes_read
+
+	def add_query(self, statement, elapsed, count=1, longest=None):
+		self.db_queries += count
+		self.db_time += elapsed
+		totals = self.statements.setdefault(statement, [0, 0.0, 0.0])
+		totals[0] += count
+		totals[1] += elapsed
+		totals[2] = max(totals[2], elapsed if longest is None else longest)
+
+	# Write the span, add its bytes and database time to its parent and close it
+	def finish(self, **fields):
+		if self.finished:
+			return
+		self.finished = True
+
+		spans = open_spans()
+		if self in spans:
+			spans.remove(self)
+
+		if self.parent is not None:
+			self.parent.add(bytes_read=self.bytes_read)
+			for statement, (count, elapsed, longest) in self.statements.items():
+				self.parent.add_query(statement, elapsed, count, longest)
+
+		elapsed = timer() - self.start
+		io_end = io_read_bytes()
+		event = {
+			'event': 'span',
+			'script': log_state['script'],
+			'pid': os.getpid(),
+			'name': self.name,
+			'path': self.path(),
+			'start': self.start_time.isoformat(),
+			'seconds': round(elapsed, 6),
+			'cpu_seconds': round(time.process_time() - self.cpu_start, 6),
+			'rows': self.rows,
+			'rows_per_sec': round(self.rows / elapsed, 1) if elapsed > 0 else None,
+			'bytes_read': self.bytes_read,
+			'io_read_bytes': io_end - self.io_start if io_end is not None and self.io_start is not None else None,
+			'peak_rss_mib': peak_rss_mib(),
+			'children_peak_rss_mib': peak_rss_mib(children=True),
+			'db_queries': self.db_queries,
+			'db_seconds': round(self.db_time, 6)
+		}
+		if self.statements:
+			top = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:TOP_STATEMENTS]
+			event['statements'] = [{'statement': statement, 'count': count, 'seconds': round(elapsed, 6), 'max_seconds': round(longest, 6)} for statement, (count, elapsed, longest) in top]
+		event.update(self.fields)
+		event.update(fields)
+		emit(event)
+
+# Open a span in the current thread, inside the innermost open span of the thread
+def start_span(name, **fields):
+	spans = open_spans()
+	new_span = Span(name, spans[-1] if spans else None, **fields)
+	spans.append(new_span)
+	return new_span
+
+# Span of a with block, an exception is recorded in its error field
+@contextmanager
+def span(name, **fields):
+	new_span = start_span(name, **fields)
+	try:
+		yield new_span
+	except BaseException as e:
+		new_span.finish(error=type(e).__name__)
+		raise
+	new_span.finish()
+
+# Innermost open span of the current thread, or None
+def current_span():
+	spans = open_spans()
+	return spans[-1] if spans else None
+
+# Add rows and bytes to the innermost open span of the current thread
+def add(rows=0, bytes_read=0):
+	open_span = current_span()
+	if open_span is not None:
+		open_span.add(rows, bytes_read)
+
+# Statement text a query is grouped by, only the start of the query is looked at (multi-row INSERTs can be megabytes long)
+# and the rows of a VALUES list are left out
+def statement_key(query):
+	text = str(query)[:4 * STATEMENT_LENGTH]
+	values = text.find(' VALUES ')
+	if values >= 0:
+		text = text[:values] + ' VALUES ...'
+	return ' '.join(LITERAL_PATTERN.sub('?', text).split())[:STATEMENT_LENGTH]
+
+# Cursor that adds the time of every statement (and of fetching its results) to the innermost open span of the thread
+class InstrumentedCursor:
+	def __init__(self, cursor):
+		self.cursor = cursor
+		self.statement = None
+
+	def timed(self, count, function, *args, **kwargs):
+		start = timer()
+		try:
+			return function(*args, **kwargs)
+		finally:
+			open_span = current_span()
+			if open_span is not None and self.statement is not None:
+				open_span.add_query(self.statement, timer() - start, count)
+
+	def execute(self, query, *args, **kwargs):
+		self.statement = statement_key(query)
+		return self.timed(1, self.cursor.execute, query, *args, **kwargs)
+
+	def executemany(self, query, *args, **kwargs):
+		self.statement = statement_key(query)
+		return self.timed(1, self.cursor.executemany, query, *args, **kwargs)
+
+	# Results that are fetched after the statement returned (unbuffered cursors) count as time of the statement
+	def fetchone(self):
+		return self.timed(0, self.cursor.fetchone)
+
+	def fetchmany(self, *args, **kwargs):
+		return self.timed(0, self.cursor.fetchmany, *args, **kwargs)
+
+	def fetchall(self):
+		return self.timed(0, self.cursor.fetchall)
+
+	def __iter__(self):
+		return iter(self.fetchone, None)
+
+	def __enter__(self):
+		self.cursor.__enter__()
+		return self
+
+	def __exit__(self, *exc_info):
+		return self.cursor.__exit__(*exc_info)
+
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+
+# Connection whose cursors are instrumented, everything else is passed through
+class InstrumentedConnection:
+	def __init__(self, connection):
+		self.connection = connection
+
+	def cursor(self, *args, **kwargs):
+		return InstrumentedCursor(self.connection.cursor(*args, **kwargs))
+
+	def __enter__(self):
+		self.connection.__enter__()
+		return self
+
+	def __exit__(self, *exc_info):
+		return self.connection.__exit__(*exc_info)
+
+	def __getattr__(self, name):
+		return getattr(self.connection, name)
+
+def instrument_connection(connection):
+	return InstrumentedConnection(connection)
@@ -3,46 +3,89 @@
 # NOTE: MySQL database credentials have been removed for privacy/security reasons. 
 # NOTE: Fill in these values before running this script.
 
-import pandas as pd
+# TensorFlow and pandas are imported by the stages that use them, so --help and --plan start without them
+
 import numpy as np
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, Dense, Dropout
-from datetime import datetime
+from numpy.lib.stride_tricks import sliding_window_view
+from datetime import datetime, timezone
 import os
+import shutil
 import joblib
 import argparse
 import pymysql
 import sys
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pv
+from scaling import inverse_scale_column
+from bulk_load import LOAD_METHODS, ROWS_PER_STATEMENT, bulk_load
+import instrumentation
 
 # File paths for training and testing data
 TRAINING_FILE_PATH = 'training_data.parquet'
 TESTING_FILE_PATH = 'testing_data.parquet'
 
-# Directory paths for intermediate batch files
-BATCH_DIR_PATH = 'batch_files/'
-os.makedirs(BATCH_DIR_PATH, exist_ok=True)
+# Columns of the model input, and the number of ticks in each input sequence
+FEATURE_COLUMNS = ['price', 'volume', 'time', 'side']
+SEQUENCE_LENGTH = 60
 
-# Output file path for predictions
-PREDICTIONS_FILE_PATH = 'predictions.csv'
+# Training settings: sequences per batch, number of sequences shuffled at a time, the part of the training data
+# held out for validation, and the epochs without improvement of the validation loss before training stops
+BATCH_SIZE = 32
+SHUFFLE_BUFFER = 100_000
+VALIDATION_SPLIT = 0.2
+EPOCHS = 1
+PATIENCE = 2
 
-# File path for the MinMaxScaler
-SCALER_FILE_PATH = 'scaler.pkl'
+# Model with the lowest validation loss so far, saved after every epoch that improves it
+CHECKPOINT_PATH = 'lstm_checkpoint.keras'
+
+# Trained model, incremental runs continue training it
+MODEL_PATH = 'lstm_model.keras'
+
+# Every trained model is recorded in the model instances table with its version and training watermark (last trained tick)
+MODEL_TABLE = 'MODELINSTANCES'
+MODEL_TYPE = 'LSTM'
+MODEL_TABLE_COLUMNS = [
+	('Model_id', 'INT(8) NOT NULL AUTO_INCREMENT PRIMARY KEY'),
+	('Model_type', 'VARCHAR(9) NOT NULL'),
+	('Date_trained', 'VARCHAR(14) NOT NULL'),
+	('Symbol', 'VARCHAR(20)'),
+	('Version', 'INT(8)'),
+	('Last_trade_id', 'BIGINT'),
+	('Last_time', 'DOUBLE'),
+	('Model_path', 'VARCHAR(255)')
+]
 
-INDICES_FILE_PATH = 'test_indices.txt'
+# Devices to run on, and the LSTM implementations: cuDNN kernels on a GPU, or the generic implementation that runs anywhere
+DEVICES = ['auto', 'cpu', 'gpu']
+LSTM_IMPLEMENTATIONS = {'auto': 'auto', 'cudnn': True, 'generic': False}
 
-# Load test indices from file
-def load_test_indices():
-	with open(INDICES_FILE_PATH, 'r') as f:
-		start_index = f.readline()
-		end_index = f.readline()
+# Precisions of the copy of the trained model that makes the predictions (training is always done in float32)
+INFERENCE_PRECISIONS = {'float32': 'float32', 'float16': 'mixed_float16', 'bfloat16': 'mixed_bfloat16'}
+PREDICT_BATCH_SIZE = 1024
 
-	return int(start_index), int(end_index)
+# Number of test sequences cut from the test data at a time
+TEST_BATCH_SIZE = 100_000
+
+# Predictions of every model are kept in the predictions table of the symbol, one row per model and predicted tick
+PREDICTIONS_TABLE_SUFFIX = '_TICK_DATA_predict'
+PREDICTIONS_TABLE_COLUMNS = "Model_id INT NOT NULL, trade_id BIGINT NOT NULL, price DOUBLE, volume DOUBLE, time DOUBLE, side TINYINT, PRIMARY KEY (Model_id, trade_id)"
+PREDICTIONS_WRITE_ROWS = 100_000
+
+# Optional CSV copy of the predictions
+PREDICTIONS_FILE_PATH = 'predictions.csv'
+
+# File path for the MinMaxScaler
+SCALER_FILE_PATH = 'scaler.pkl'
 
 
 # Load the preprocessed data
 def load_data(file_path):
+	import pandas as pd
+	
 	data = pd.read_parquet(file_path)
+	instrumentation.add(rows=len(data), bytes_read=os.path.getsize(file_path))
 	
 	# Check for NaN values
 	if data.isnull().values.any():
@@ -50,56 +93,126 @@ def load_data(file_path):
 	
 	return data
 
-# Create sequences of data for LSTM using vectorized operations in batches and save them immediately to disk
-def create_sequences_in_batches(data, seq_length=60, batch_size=100_000, file_prefix='train'):
-	data_array = data[['price', 'volume', 'time', 'side']].values
+# Turn the preprocessed data into one contiguous array of the model's input columns
+def load_features(data):
+	features = data[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
 	
 	# Check for NaN values in the array
-	if np.isnan(data_array).any():
+	if np.isnan(features).any():
 		raise ValueError("Data array contains NaN values during sequence creation.")
 	
-	num_samples = len(data_array) - seq_length
+	return features
+
+# Sequences of seq_length ticks over a feature array, indexed batch by batch
+# Sequence i is features[i:i + seq_length], a strided view into the array, and its target is the price of tick i + seq_length,
+# so only the sequences of the current batch are ever copied
+class WindowSequence:
+	def __init__(self, features, seq_length=SEQUENCE_LENGTH, batch_size=32, start=0, end=None, shuffle=False):
+		self.windows = sliding_window_view(features, seq_length, axis=0).transpose(0, 2, 1)
+		self.targets = features[seq_length:, 0]
+		end = len(self.targets) if end is None else min(end, len(self.targets))
+		self.indices = np.arange(start, end)
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		if shuffle:
+			np.random.shuffle(self.indices)
+	
+	def __len__(self):
+		return -(-len(self.indices) // self.batch_size)
+	
+	def __getitem__(self, index):
+		batch = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+		return self.windows[batch], self.targets[batch]
+	
+	def on_epoch_end(self):
+		if self.shuffle:
+			np.random.shuffle(self.indices)
+
+# Build a tf.data pipeline of (sequence, target) batches for the sequences start..end of a feature array
+# Each batch is gathered from the feature tensor by a parallel map and prefetched, so the next batches are ready while the model trains
+def window_dataset(features, seq_length=SEQUENCE_LENGTH, batch_size=BATCH_SIZE, start=0, end=None, shuffle_buffer=0, cache=False):
+	import tensorflow as tf
+	
+	end = len(features) - seq_length if end is None else end
+	targets = tf.convert_to_tensor(features[seq_length:, 0])
+	features = tf.convert_to_tensor(features)
+	offsets = tf.range(seq_length, dtype=tf.int64)
+	
+	def gather_batch(indices):
+		return tf.gather(features, indices[:, None] + offsets), tf.gather(targets, indices)
+	
+	dataset = tf.data.Dataset.range(start, end)
+	if shuffle_buffer:
+		dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+	dataset = dataset.batch(batch_size).map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
+	
+	# Cached batches are reused as they are in later epochs, so only unshuffled datasets should be cached
+	if cache:
+		dataset = dataset.cache()
+	return dataset.prefetch(tf.data.AUTOTUNE)
+
+# Select the device and the number of threads, before TensorFlow runs its first operation
+# 0 threads leaves the choice to TensorFlow (intra-op: threads per operation, inter-op: operations run in parallel)
+def configure_device(device='auto', intra_op_threads=0, inter_op_threads=0):
+	import tensorflow as tf
+	
+	if device == 'cpu':
+		tf.config.set_visible_devices([], 'GPU')
+	elif device == 'gpu' and not tf.config.list_physical_devices('GPU'):
+		raise ValueError("No GPU found, use --device cpu to run on the CPU")
+	
+	tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+	tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+# Build and compile the LSTM model
+def build_model(seq_length=SEQUENCE_LENGTH, lstm_impl='auto', precision='float32'):
+	from tensorflow.keras.models import Sequential
+	from tensorflow.keras.layers import LSTM, Dense, Dropout
 	
-	batch_counter = 0
+	use_cudnn = LSTM_IMPLEMENTATIONS[lstm_impl]
+	dtype = INFERENCE_PRECISIONS[precision]
 	
-	for start in range(0, num_samples, batch_size):
-		end = min(start + batch_size, num_samples)
-		X_batch = np.array([data_array[i:i + seq_length] for i in range(start, end)])
-		y_batch = data_array[start + seq_length:end + seq_length, 0]  # Only the price column for target
-		
-		# Check for NaN values in batches
-		if np.isnan(X_batch).any() or np.isnan(y_batch).any():
-			raise ValueError(f"Batch {batch_counter} contains NaN values.")
-		
-		# Save the current batch to disk
-		np.savez_compressed(f"{BATCH_DIR_PATH}/{file_prefix}_batch_0{batch_counter}.npz", X=X_batch, y=y_batch)
-		
-		# Increment batch counter
-		batch_counter += 1
-
-# Load batches from disk with a limit on the number of batches in RAM at a time
-def load_batches(file_prefix, max_batches_in_memory=8):
-	batch_files = sorted([f for f in os.listdir(BATCH_DIR_PATH) if f.startswith(file_prefix)])
+	model = Sequential()
+	model.add(LSTM(units=50, return_sequences=True, input_shape=(seq_length, 4), use_cudnn=use_cudnn, dtype=dtype))  # Corrected input shape to (60, 4)
+	model.add(Dropout(0.2, dtype=dtype))
+	model.add(LSTM(units=50, return_sequences=False, use_cudnn=use_cudnn, dtype=dtype))
+	model.add(Dropout(0.2, dtype=dtype))
+	# The output stays in float32 in every precision
+	model.add(Dense(units=1, dtype='float32'))
 	
-	for i in range(0, len(batch_files), max_batches_in_memory):
-		batch_chunk = batch_files[i:i + max_batches_in_memory]
-		
-		X_batches_chunk = []
-		y_batches_chunk = []
-		
-		for file_name in batch_chunk:
-			with np.load(f"{BATCH_DIR_PATH}/{file_name}") as data:
-				X_batch = data['X']
-				y_batch = data['y']
-				
-				# Check for NaN values in loaded batches
-				if np.isnan(X_batch).any() or np.isnan(y_batch).any():
-					raise ValueError(f"Loaded batch from {file_name} contains NaN values.")
-				
-				X_batches_chunk.append(X_batch)
-				y_batches_chunk.append(y_batch)
-		
-		yield X_batches_chunk, y_batches_chunk
+	# Compile the model
+	model.compile(optimizer='adam', loss='mean_squared_error')
+	return model
+
+# Copy of a trained model with the same weights that computes in a lower precision, float32 uses the model itself
+def inference_model(model, seq_length=SEQUENCE_LENGTH, lstm_impl='auto', precision='float32'):
+	if precision == 'float32':
+		return model
+	
+	copy = build_model(seq_length, lstm_impl, precision)
+	copy.set_weights(model.get_weights())
+	return copy
+
+# Mean squared and mean absolute error, accumulated batch by batch
+class ErrorMetrics:
+	def __init__(self):
+		self.count = 0
+		self.squared_error = 0.0
+		self.absolute_error = 0.0
+	
+	def update(self, actual, predicted):
+		errors = np.asarray(predicted, dtype=np.float64) - actual
+		self.count += len(errors)
+		self.squared_error += float(np.dot(errors, errors))
+		self.absolute_error += float(np.abs(errors).sum())
+	
+	@property
+	def mse(self):
+		return self.squared_error / self.count
+	
+	@property
+	def mae(self):
+		return self.absolute_error / self.count
 
 # Load the MinMaxScaler if it exists
 def load_scaler(scaler_file_path):
@@ -114,220 +227,312 @@ def load_scaler(scaler_file_path):
 	
 # Function to connect to the MySQL database
 def get_db_connection(db_config):
-	return pymysql.connect(**db_config)
+	return instrumentation.instrument_connection(pymysql.connect(**db_config))
+
+# Create the model instances table, or add the watermark columns and the AUTO_INCREMENT key of Model_id to a table of the original schema
+def create_model_table(connection):
+	with connection.cursor() as cursor:
+		columns = ", ".join(f"{name} {definition}" for name, definition in MODEL_TABLE_COLUMNS)
+		cursor.execute(f"CREATE TABLE IF NOT EXISTS {MODEL_TABLE} ({columns})")
+		
+		cursor.execute("SELECT COLUMN_NAME, COLUMN_KEY, EXTRA FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (MODEL_TABLE,))
+		existing_columns = {row[0].lower(): (row[1], row[2].lower()) for row in cursor.fetchall()}
+		for name, definition in MODEL_TABLE_COLUMNS:
+			if name.lower() not in existing_columns:
+				cursor.execute(f"ALTER TABLE {MODEL_TABLE} ADD COLUMN {name} {definition}")
+		
+		column_key, extra = existing_columns['model_id']
+		if column_key != 'PRI':
+			cursor.execute(f"ALTER TABLE {MODEL_TABLE} MODIFY Model_id INT(8) NOT NULL AUTO_INCREMENT PRIMARY KEY")
+		elif 'auto_increment' not in extra:
+			cursor.execute(f"ALTER TABLE {MODEL_TABLE} MODIFY Model_id INT(8) NOT NULL AUTO_INCREMENT")
+	connection.commit()
+
+# Latest model instance of a symbol saved to model_path as (model_id, version, last_trade_id), or None if no model has been recorded
+# Every model file has its own versions and watermark, so runs that save their models to different directories (e.g. the
+# configurations of the training orchestrator) never continue each other's models
+def get_latest_model(connection, table_prefix, model_path):
+	with connection.cursor() as cursor:
+		cursor.execute(f"SELECT Model_id, Version, Last_trade_id FROM {MODEL_TABLE} WHERE Symbol = %s AND Model_type = %s AND Model_path = %s ORDER BY Version DESC LIMIT 1", (table_prefix, MODEL_TYPE, model_path))
+		return cursor.fetchone()
+
+# Record a trained model with its version and training watermark, returns its Model_id
+# The id comes from the AUTO_INCREMENT key, so runs of different symbols that finish at the same time never get the same id
+def record_model_instance(connection, table_prefix, version, last_trade_id, last_time, model_path):
+	date_trained = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+	with connection.cursor() as cursor:
+		query = f"""
+			INSERT INTO {MODEL_TABLE} (Model_type, Date_trained, Symbol, Version, Last_trade_id, Last_time, Model_path)
+			VALUES (%s, %s, %s, %s, %s, %s, %s)
+		"""
+		cursor.execute(query, (MODEL_TYPE, date_trained, table_prefix, version, last_trade_id, last_time, model_path))
+		model_id = cursor.lastrowid
+	connection.commit()
+	return model_id
+
+# Create the predictions table of a symbol
+# Tables of the original layout (the predictions of the last run only, keyed by an AUTO_INCREMENT trade_id) are replaced once
+def create_predictions_table(connection, predict_table):
+	with connection.cursor() as cursor:
+		cursor.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (predict_table,))
+		existing_columns = {row[0].lower() for row in cursor.fetchall()}
+		if existing_columns and 'model_id' not in existing_columns:
+			print(f"Replacing {predict_table} of the original layout")
+			cursor.execute(f"DROP TABLE {predict_table}")
+		
+		cursor.execute(f"CREATE TABLE IF NOT EXISTS {predict_table} ({PREDICTIONS_TABLE_COLUMNS})")
+	connection.commit()
+
+# Write the predictions of a model (pyarrow table) in bulk batches, replacing the model's earlier predictions of the same ticks
+def write_predictions(connection, predict_table, predictions, load_method='infile', rows_per_statement=ROWS_PER_STATEMENT):
+	model_id = predictions.column('Model_id')[0].as_py()
+	trade_ids = predictions.column('trade_id')
+	with connection.cursor() as cursor:
+		cursor.execute(f"DELETE FROM {predict_table} WHERE Model_id = %s AND trade_id BETWEEN %s AND %s", (model_id, trade_ids[0].as_py(), trade_ids[-1].as_py()))
+		for batch in predictions.to_batches(max_chunksize=PREDICTIONS_WRITE_ROWS):
+			load_method = bulk_load(cursor, predict_table, pa.Table.from_batches([batch]), load_method, rows_per_statement)
+	connection.commit()
+
+# First training row of an incremental run: the ticks after the watermark, preceded by replay_window older ticks
+# and the seq_length ticks before them that the first sequence needs. None if there are no new sequences
+def incremental_start(trade_ids, last_trade_id, replay_window=0, seq_length=SEQUENCE_LENGTH):
+	first_new = int(np.searchsorted(trade_ids, last_trade_id, side='right'))
+	if first_new == len(trade_ids):
+		return None
+	
+	start = max(0, first_new - replay_window - seq_length)
+	return start if len(trade_ids) - start > seq_length else None
+
+# Training rows of an incremental run, None if there are no new sequences
+def incremental_training_data(training_data, last_trade_id, replay_window=0, seq_length=SEQUENCE_LENGTH):
+	start = incremental_start(training_data['trade_id'].to_numpy(), last_trade_id, replay_window, seq_length)
+	return None if start is None else training_data.iloc[start:]
+
+# Print what a run would do, from the Parquet metadata (and the model instances table for incremental runs),
+# without loading the data or TensorFlow
+def print_plan(db_config, table_prefix, epochs=EPOCHS, batch_size=BATCH_SIZE, lstm_impl='auto', inference_precision='float32', incremental=False, replay_window=0, load_method='infile', data_dir='.', model_dir='.'):
+	training_file = os.path.join(data_dir, table_prefix + "_" + TRAINING_FILE_PATH)
+	testing_file = os.path.join(data_dir, table_prefix + "_" + TESTING_FILE_PATH)
+	for file_path in [training_file, testing_file, os.path.join(data_dir, SCALER_FILE_PATH)]:
+		if not os.path.exists(file_path):
+			raise ValueError(f"{file_path} not found")
+	
+	training_rows = pq.ParquetFile(training_file).metadata.num_rows
+	testing_rows = pq.ParquetFile(testing_file).metadata.num_rows
+	
+	if incremental:
+		model_path = os.path.abspath(os.path.join(model_dir, MODEL_PATH))
+		connection = get_db_connection(db_config)
+		try:
+			latest_model = get_latest_model(connection, table_prefix, model_path)
+		finally:
+			connection.close()
+		if latest_model is None or not os.path.exists(model_path):
+			raise ValueError(f"No saved model of {table_prefix} in {model_path} to continue training, train a full model first")
+		
+		start = incremental_start(pq.ParquetFile(training_file).read(columns=['trade_id']).column('trade_id').to_numpy(), latest_model[2], replay_window)
+		training_rows = 0 if start is None else training_rows - start
+		print(f"Continuing model version {latest_model[1]} after trade_id {latest_model[2]} (replay window {replay_window})")
+	
+	train_samples = max(0, training_rows - SEQUENCE_LENGTH)
+	split = int((1 - VALIDATION_SPLIT) * train_samples) or train_samples
+	print(f"Training: {training_rows:,} ticks, {split:,} training and {train_samples - split:,} validation sequences, {-(-split // batch_size):,} steps per epoch, up to {epochs} epochs")
+	print(f"Testing: {testing_rows:,} ticks, {max(0, testing_rows - SEQUENCE_LENGTH):,} predictions in batches of {TEST_BATCH_SIZE:,}")
+	print(f"Model: {lstm_impl} LSTM implementation, predictions in {inference_precision} written to {table_prefix}{PREDICTIONS_TABLE_SUFFIX} ({load_method})")
 
 # Main function to train and test the LSTM model
-def main(table_prefix):
+# The model is trained with one fit over all training sequences, keeping the checkpoint with the lowest validation loss
+# Incremental runs continue training the saved model on the ticks after its watermark instead of training a new model
+# The predictions are written to the predictions table under the id of the model that made them
+# With plan only the sizes of the run are printed
+# The preprocessed data and scaler are read from data_dir, the model, checkpoint and predictions file are written to model_dir
+def main(table_prefix, epochs=EPOCHS, batch_size=BATCH_SIZE, shuffle_buffer=SHUFFLE_BUFFER, patience=PATIENCE, cache=False, lstm_impl='auto', inference_precision='float32', incremental=False, replay_window=0, load_method='infile', rows_per_statement=ROWS_PER_STATEMENT, predictions_csv=False, plan=False, data_dir='.', model_dir='.'):
 
 	# Database connection parameters
 	DB_CONFIG = {
 		'host': 'localhost',
 		'user': '',
 		'password': '',
-		'database': 'PROJECT_4560'
+		'database': 'PROJECT_4560',
+		'local_infile': load_method == 'infile'
 	}
 	
+	if plan:
+		return print_plan(DB_CONFIG, table_prefix, epochs, batch_size, lstm_impl, inference_precision, incremental, replay_window, load_method, data_dir, model_dir)
+	
+	scaler_path = os.path.join(data_dir, SCALER_FILE_PATH)
+	model_path = os.path.abspath(os.path.join(model_dir, MODEL_PATH))
+	os.makedirs(model_dir, exist_ok=True)
+	
+	from tensorflow.keras.models import load_model
+	from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
+	
 	# Connect to database
 	connection = get_db_connection(DB_CONFIG)
 
 	# Load data
-	training_data = load_data(table_prefix + "_" + TRAINING_FILE_PATH)
-	testing_data = load_data(table_prefix + "_" + TESTING_FILE_PATH)
-	
-	# Load or create MinMaxScaler
-	if os.path.exists(SCALER_FILE_PATH):
-		scaler = load_scaler(SCALER_FILE_PATH)
+	with instrumentation.span('load_data'):
+		training_data = load_data(os.path.join(data_dir, table_prefix + "_" + TRAINING_FILE_PATH))
+		testing_data = load_data(os.path.join(data_dir, table_prefix + "_" + TESTING_FILE_PATH))
+		
+		# Load or create MinMaxScaler
+		if os.path.exists(scaler_path):
+			scaler = load_scaler(scaler_path)
+		else:
+			raise ValueError(f"Scaler file not found at {scaler_path}")
+	
+	# Sequences are cut from the feature arrays as the batches are needed
+	seq_length = SEQUENCE_LENGTH
+	test_batch_size = TEST_BATCH_SIZE
+	
+	testing_features = load_features(testing_data)
+	
+	# Latest recorded model of the symbol in model_dir, the new model gets the next version
+	create_model_table(connection)
+	latest_model = get_latest_model(connection, table_prefix, model_path)
+	version = latest_model[1] + 1 if latest_model else 1
+	
+	# Build the LSTM model, or load the saved model and only train it on the ticks after its watermark
+	if incremental:
+		if latest_model is None or not os.path.exists(model_path):
+			raise ValueError(f"No saved model of {table_prefix} in {model_path} to continue training, train a full model first")
+		
+		model = load_model(model_path)
+		training_data = incremental_training_data(training_data, latest_model[2], replay_window, seq_length)
+		if training_data is None:
+			print(f"No new sequences after trade_id {latest_model[2]}, model version {latest_model[1]} is up to date")
+		else:
+			print(f"Continuing model version {latest_model[1]} after trade_id {latest_model[2]} ({len(training_data) - seq_length} sequences, replay window {replay_window})")
 	else:
-		raise ValueError(f"Scaler file not found at {SCALER_FILE_PATH}")
-	
-	# Normalize data (ensure consistency with preprocessing)
-	training_scaled = scaler.transform(training_data[['price', 'volume', 'time']])
-	testing_scaled = scaler.transform(testing_data[['price', 'volume', 'time']])
-	
-	# Check for NaN values after scaling
-	if np.isnan(training_scaled).any() or np.isnan(testing_scaled).any():
-		raise ValueError("Scaled data contains NaN values.")
-	
-	# Create sequences in batches and save them immediately to disk
-	seq_length = 60
-	batch_size = 100_000
-	
-	create_sequences_in_batches(training_data, seq_length, batch_size, file_prefix='train')
-	create_sequences_in_batches(testing_data, seq_length, batch_size, file_prefix='test')
-	
-	# Build the LSTM model
-	model = Sequential()
-	model.add(LSTM(units=50, return_sequences=True, input_shape=(seq_length, 4)))  # Corrected input shape to (60, 4)
-	model.add(Dropout(0.2))
-	model.add(LSTM(units=50, return_sequences=False))
-	model.add(Dropout(0.2))
-	model.add(Dense(units=1))
-	
-	# Compile the model
-	model.compile(optimizer='adam', loss='mean_squared_error')
-	
-	# Train the model in batches
-	start_time = datetime.now()
-	for X_train_batches, y_train_batches in load_batches('train'):
-		for i, (X_train_batch, y_train_batch) in enumerate(zip(X_train_batches, y_train_batches)):
-			print(f"Training batch {i + 1}/{len(X_train_batches)}")
-			model.fit(X_train_batch, y_train_batch, epochs=1, batch_size=32, validation_split=0.2)
-	end_time = datetime.now()
-	
-	print(f"Model trained in {end_time - start_time}")
-	
-	# Evaluate the model on test data
-	y_pred_all = []
-	y_test_all = []
-	side_test_all = []
-	time_test_all = []  # Added to store actual timestamps
-	
-	for X_test_batches, y_test_batches in load_batches('test'):
-		for i, (X_test_batch, y_test_batch) in enumerate(zip(X_test_batches, y_test_batches)):
-			print(f"Evaluating batch {i + 1}/{len(X_test_batches)}")
-			y_pred = model.predict(X_test_batch)
-			y_pred_all.extend(y_pred.flatten())
-			y_test_all.extend(y_test_batch)
-			
-			# Extract side and time values from the testing data
-			start_idx = seq_length - 1 + i * batch_size
-			end_idx = min(start_idx + len(y_test_batch), len(testing_data) - 1)
-			print(f"Start index: {start_idx}, End index: {end_idx}")
-			side_values = testing_data['side'].iloc[start_idx:end_idx].values
-			time_values = testing_data['time'].iloc[start_idx:end_idx].values
+		model = build_model(seq_length, lstm_impl)
+	
+	# Train the model, validating on the last 20% of the training sequences
+	if training_data is not None:
+		training_features = load_features(training_data)
+		train_samples = len(training_features) - seq_length
+		split = int((1 - VALIDATION_SPLIT) * train_samples) or train_samples
+		train_dataset = window_dataset(training_features, seq_length, batch_size, 0, split, shuffle_buffer)
+		validation_dataset = window_dataset(training_features, seq_length, batch_size, split, train_samples, cache=cache) if split < train_samples else None
+		callbacks = [
+			ModelCheckpoint(os.path.join(model_dir, CHECKPOINT_PATH), monitor='val_loss', save_best_only=True),
+			EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True)
+		]
+		
+		start_time = datetime.now()
+		with instrumentation.span('train', sequences=split, validation_sequences=train_samples - split, batch_size=batch_size) as train_span:
+			history = model.fit(train_dataset, validation_data=validation_dataset, epochs=epochs, callbacks=callbacks)
+			train_span.add(rows=split * len(history.epoch))
+		end_time = datetime.now()
+		
+		print(f"Model trained in {end_time - start_time}")
+	
+	# Model that makes the predictions
+	predictor = inference_model(model, seq_length, lstm_impl, inference_precision)
+	
+	# Evaluate the model on test data, the predictions of every batch are written into a preallocated array
+	# The data is already scaled by the preprocessing, so only the price column needs to be unscaled (analytically, per batch)
+	test_batches = WindowSequence(testing_features, seq_length, test_batch_size)
+	predicted_price = np.empty(len(testing_features) - seq_length)
+	metrics = ErrorMetrics()
+	
+	with instrumentation.span('evaluate', precision=inference_precision):
+		for i in range(len(test_batches)):
+			X_test_batch, y_test_batch = test_batches[i]
+			print(f"Evaluating batch {i + 1}/{len(test_batches)}")
+			y_pred = predictor.predict(X_test_batch, batch_size=PREDICT_BATCH_SIZE).ravel()
 			
-			side_test_all.extend(side_values)
-			time_test_all.extend(time_values)
-	
-	# Convert lists to numpy arrays
-	y_pred_inv = np.array(y_pred_all).reshape(-1, 1)
-	y_test_inv = np.array(y_test_all).reshape(-1, 1)
-	side_test_inv = np.array(side_test_all).reshape(-1, 1)
-	#time_test_inv = np.array(time_test_all).reshape(-1, 1)  # Convert time to numpy array
-	
-	# Create a temporary DataFrame for inverse transformation
-	temp_test = pd.DataFrame(scaler.inverse_transform(testing_scaled), columns=['price', 'volume', 'time'])
-	
-	# Adjust the indices to match the sequences
-	#print(f"Length of y_pred_all: {len(y_pred_all)}")
-	#print(f"Length of testing_data: {len(testing_data)}")
-	#print(f"Length of temp_test: {len(temp_test)}")
-	
-	y_pred_inv_full = np.zeros((len(y_pred_all), 3))
-	y_pred_inv_full[:, 0] = y_pred_inv.flatten()
-	
-	start_idx = seq_length - 1
-	end_idx = start_idx + len(y_pred_all)
-	#print(f"Adjusted start index: {start_idx}, Adjusted end index: {end_idx}")
-	
-	y_pred_inv_full[:, 1:3] = temp_test.iloc[start_idx:end_idx][['volume', 'time']].values
-	
-	y_test_inv_full = np.zeros((len(y_test_all), 3))
-	y_test_inv_full[:, 0] = y_test_inv.flatten()
-	y_test_inv_full[:, 1:3] = temp_test.iloc[start_idx:end_idx][['volume', 'time']].values
-
-	# Check for NaN values before inverse transformation
-	if np.isnan(y_pred_inv_full).any() or np.isnan(y_test_inv_full).any():
-		raise ValueError("Data contains NaN values before inverse transformation.")
-	
-	# Inverse transform the entire sequences (only price, volume, and time)
-	y_pred_inv_full[:, :3] = scaler.inverse_transform(y_pred_inv_full[:, :3])
-	y_test_inv_full[:, :3] = scaler.inverse_transform(y_test_inv_full[:, :3])
-	
-	# Check for NaN values after inverse transformation
-	if np.isnan(y_pred_inv_full).any() or np.isnan(y_test_inv_full).any():
-		raise ValueError("Data contains NaN values after inverse transformation.")
-	
-	# Calculate performance metrics
-	mse = mean_squared_error(y_test_inv_full[:, 0], y_pred_inv_full[:, 0])
-	mae = mean_absolute_error(y_test_inv_full[:, 0], y_pred_inv_full[:, 0])
-	
-	print(f"Mean Squared Error (MSE): {mse}")
-	print(f"Mean Absolute Error (MAE): {mae}")
-
-	# Load start/end test indices
-	start_index, end_index = load_test_indices()
-
-	# Get time column from database
-	start_index += 61
-	source_table = table_prefix + "_TICK_DATA"
-	with connection.cursor() as cursor:
-		time_query = f"SELECT time FROM {source_table} WHERE trade_id BETWEEN {start_index} AND {end_index}"
-		cursor.execute(time_query)
-		connection.commit()
-
-		result_time = cursor.fetchall()
-		time_column = [row[0] for row in result_time]
-
-	#print(f"Length of y_pred_inv_full[:, 0]: {len(y_pred_inv_full[:, 0])}")
-	#print(f"Length of y_test_inv_full[:, 1]: {len(y_test_inv_full[:, 1])}")
-	#print(f"Length of time_column: {len(time_column)}")
-	#print(f"Length of side_test_inv.flatten(): {len(side_test_inv.flatten())}")
-	
-	# Save predictions to a dataframe
-	results_df = pd.DataFrame({
-		#'actual_price': y_test_inv_full[:, 0],
-		'predicted_price': y_pred_inv_full[:, 0],
-		'volume': y_test_inv_full[:, 1],
-		'time': time_column,  # Use actual timestamps
-		'side': side_test_inv.astype(int).flatten()  # Convert side to int
+			start_idx = i * test_batch_size
+			predicted_price[start_idx:start_idx + len(y_pred)] = inverse_scale_column(y_pred, scaler, 'price')
+			metrics.update(inverse_scale_column(y_test_batch, scaler, 'price'), predicted_price[start_idx:start_idx + len(y_pred)])
+			instrumentation.add(rows=len(y_pred))
+	
+	# Check for NaN values in the predictions
+	if np.isnan(predicted_price).any():
+		raise ValueError("Predictions contain NaN values.")
+	
+	print(f"Mean Squared Error (MSE): {metrics.mse}")
+	print(f"Mean Absolute Error (MAE): {metrics.mae}")
+	
+	# Save the model and its scaler and record it with its training watermark, an up to date incremental model keeps its id
+	# The scaler is saved next to the model, so the data of later incremental runs can be scaled like the data it was trained on
+	if training_data is not None:
+		with instrumentation.span('save_model'):
+			model.save(model_path)
+			model_scaler_path = os.path.join(model_dir, SCALER_FILE_PATH)
+			if os.path.abspath(model_scaler_path) != os.path.abspath(scaler_path):
+				shutil.copyfile(scaler_path, model_scaler_path)
+			last_time = inverse_scale_column(training_data['time'].to_numpy()[-1:], scaler, 'time')[0]
+			last_trade_id = int(training_data['trade_id'].iloc[-1])
+			model_id = record_model_instance(connection, table_prefix, version, last_trade_id, float(last_time), model_path)
+			print(f"Saved model version {version} to {model_path}")
+			latest_model = (model_id, version, last_trade_id)
+	
+	# Predicted ticks with their trade ids, times, volumes and sides, taken from the test data (the target of sequence i is tick seq_length + i)
+	predicted_ticks = testing_data.iloc[seq_length:]
+	predictions = pa.table({
+		'Model_id': pa.array(np.full(len(predicted_price), latest_model[0]), pa.int32()),
+		'trade_id': predicted_ticks['trade_id'].to_numpy(),
+		'price': predicted_price,
+		'volume': inverse_scale_column(predicted_ticks['volume'].to_numpy(), scaler, 'volume'),
+		'time': inverse_scale_column(predicted_ticks['time'].to_numpy(), scaler, 'time'),
+		'side': predicted_ticks['side'].to_numpy().astype(np.int8)
 	})
-
-	# Save dataframe to the database
-	predict_table = table_prefix + "_TICK_DATA_predict"
-	with connection.cursor() as cursor:
-		try:
-			results_df = results_df.replace(np.nan, None)
-			results_val = list(results_df.itertuples(index=False, name=None))
-
-			drop_query = f"DROP TABLE IF EXISTS {predict_table}"
-			cursor.execute(drop_query)
-			connection.commit()
-
-			results_query = f"CREATE TABLE IF NOT EXISTS {predict_table} (trade_id INT NOT NULL AUTO_INCREMENT, price FLOAT, volume FLOAT, time DOUBLE PRECISION(19,8), side INT, PRIMARY KEY (trade_id))"
-			cursor.execute(results_query)
-			connection.commit()
-
-			results_query = f"ALTER TABLE {predict_table} AUTO_INCREMENT={start_index}"
-			cursor.execute(results_query)
-			connection.commit()
-
-			results_query = f"INSERT INTO {predict_table} (price, volume, time, side) VALUES (%s, %s, %s, %s)"
-			cursor.executemany(results_query, results_val)
-			connection.commit()
-		except Exception as e:
-			print(f"An error occurred inserting data into the database: {e}")
-			sys.exit()
-	
-	# DEBUG: Save predictions to a CSV file
-	results_df.to_csv(table_prefix + "_" + PREDICTIONS_FILE_PATH, index=False)
-	print(f"Predictions saved to {table_prefix + "_" + PREDICTIONS_FILE_PATH}")
-	
-	# Optional: Save the model
-	model.save('lstm_model.keras')
-	
-	# Cleanup batch files
-	cleanup_batch_files()
-
-# Function to clean up batch files
-def cleanup_batch_files():
-	for file_name in os.listdir(BATCH_DIR_PATH):
-		if file_name.endswith('.npz'):
-			file_path = os.path.join(BATCH_DIR_PATH, file_name)
-			try:
-				os.remove(file_path)
-				print(f"Deleted batch file: {file_path}")
-			except Exception as e:
-				print(f"Error deleting batch file {file_path}: {e}")
+	
+	# Save the predictions to the database
+	predict_table = table_prefix + PREDICTIONS_TABLE_SUFFIX
+	try:
+		with instrumentation.span('write_predictions', load_method=load_method) as write_span:
+			create_predictions_table(connection, predict_table)
+			write_predictions(connection, predict_table, predictions, load_method, rows_per_statement)
+			write_span.add(rows=predictions.num_rows)
+	except Exception as e:
+		print(f"An error occurred inserting data into the database: {e}")
+		sys.exit(1)
+	print(f"Saved {predictions.num_rows} predictions of model {latest_model[0]} to {predict_table}")
+	
+	if predictions_csv:
+		predictions_file = os.path.join(model_dir, table_prefix + "_" + PREDICTIONS_FILE_PATH)
+		pv.write_csv(predictions, predictions_file)
+		print(f"Predictions saved to {predictions_file}")
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Train LSTM model on preprocessed data.")
 	parser.add_argument('--table-prefix', type=str, required=True, help='Prefix of the table name (e.g., ETHUSDC)')
+	parser.add_argument('--epochs', type=int, default=EPOCHS, help='Maximum number of training epochs')
+	parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Number of sequences per training batch')
+	parser.add_argument('--shuffle-buffer', type=int, default=SHUFFLE_BUFFER, help='Number of training sequences shuffled at a time (0 disables shuffling)')
+	parser.add_argument('--patience', type=int, default=PATIENCE, help='Epochs without improvement of the validation loss before training stops early')
+	parser.add_argument('--cache', action='store_true', help='Keep the validation batches in memory after the first epoch')
+	parser.add_argument('--device', type=str, choices=DEVICES, default='auto', help='Run on the GPU if there is one (auto), or only on the CPU or the GPU')
+	parser.add_argument('--intra-op-threads', type=int, default=0, help='Threads used within an operation (default: chosen by TensorFlow)')
+	parser.add_argument('--inter-op-threads', type=int, default=0, help='Operations run in parallel (default: chosen by TensorFlow)')
+	parser.add_argument('--lstm-impl', type=str, choices=list(LSTM_IMPLEMENTATIONS), default='auto', help='LSTM implementation: cuDNN kernels (GPU only), the generic implementation, or cuDNN when possible (auto)')
+	parser.add_argument('--incremental', action='store_true', help='Continue training the saved model on the ticks after its training watermark instead of training a new model')
+	parser.add_argument('--replay-window', type=int, default=0, help='Number of ticks before the watermark that incremental runs train on again')
+	parser.add_argument('--inference-precision', type=str, choices=list(INFERENCE_PRECISIONS), default='float32', help='Precision of the predictions, float16/bfloat16 are faster on CPUs with AVX-512 FP16/BF16 or AMX')
+	parser.add_argument('--load-method', type=str, choices=list(LOAD_METHODS), default='infile', help='Bulk-load backend of the predictions (LOAD DATA LOCAL INFILE falls back to multi-row INSERT if it is not allowed)')
+	parser.add_argument('--rows-per-statement', type=int, default=ROWS_PER_STATEMENT, help='Rows per multi-row INSERT statement')
+	parser.add_argument('--predictions-csv', action='store_true', help=f'Also write the predictions to TABLE_PREFIX_{PREDICTIONS_FILE_PATH}')
+	parser.add_argument('--plan', '--dry-run', action='store_true', help='Only print the number of ticks, sequences and training steps of the run, without loading TensorFlow')
+	parser.add_argument('--data-dir', type=str, default='.', help=f'Directory of TABLE_PREFIX_{TRAINING_FILE_PATH}, TABLE_PREFIX_{TESTING_FILE_PATH} and {SCALER_FILE_PATH} (default: current directory)')
+	parser.add_argument('--model-dir', type=str, default='.', help=f'Directory of {MODEL_PATH}, its checkpoint and the predictions file (default: current directory)')
+	parser.add_argument('--metrics-log', type=str, default=None, help="Append the time, rows, bytes read, peak memory and database time of every stage to this file as JSON lines ('-' for stderr)")
+	parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and write the stats to this file')
 	
 	args = parser.parse_args()
-
-	start_time = datetime.now()
-	main(args.table_prefix)
-	end_time = datetime.now()
+	
+	instrumentation.configure(args.metrics_log, args.profile)
+	with instrumentation.span('lstm', symbol=args.table_prefix, incremental=args.incremental):
+		try:
+			if not args.plan:
+				with instrumentation.span('configure_device', device=args.device):
+					configure_device(args.device, args.intra_op_threads, args.inter_op_threads)
+		except ValueError as e:
+			print(e)
+			sys.exit(1)
+		
+		start_time = datetime.now()
+		main(args.table_prefix, args.epochs, args.batch_size, args.shuffle_buffer, args.patience, args.cache, args.lstm_impl, args.inference_precision, args.incremental, args.replay_window, args.load_method, args.rows_per_statement, args.predictions_csv, args.plan, args.data_dir, args.model_dir)
+		end_time = datetime.now()
 	
 	print(f"Total execution time: {end_time - start_time}")
@@ -3,93 +3,310 @@
 
 import argparse
 import pymysql
-import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from multiprocessing import Pool, cpu_count
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import pickle
+from tick_store import next_trade_id, read_ticks, trade_id_range, trade_id_segments
+from schema import time_to_seconds
+from scaling import SCALED_COLUMNS, SCALERS, ScalerStatistics, merge_statistics, scale_columns
+import instrumentation
 
 # Directory paths for training and testing data
 TRAINING_DIR_PATH = 'training_data/'
 TESTING_DIR_PATH = 'testing_data/'
 SCALER_PATH = 'scaler.pkl'
 
-# Ensure directories exist
-os.makedirs(TRAINING_DIR_PATH, exist_ok=True)
-os.makedirs(TESTING_DIR_PATH, exist_ok=True)
+# Number of ticks fetched per query, each worker only holds one page of ticks in memory at a time
+PAGE_SIZE = 100_000
+
+# The training and testing ranges are split into about this many tasks per worker, so workers that finish early pick up
+# the remaining ones instead of waiting for the slowest range
+TASKS_PER_WORKER = 8
+
+# Approximate memory used per tick of a page (the fetched rows, the typed DataFrame and the Arrow table written from it),
+# used to fit the page size into --memory-budget
+PAGE_BYTES_PER_TICK = 640
+MIB = 1024 * 1024
+
+# Number of rows per row group of the final files, which are written one row group at a time
+ROW_GROUP_SIZE = 256 * 1024
+
+# Number of trade id buckets counted to balance the tasks of a table without an import manifest
+HISTOGRAM_BUCKETS = 1024
+MANIFEST_TABLE = 'IMPORT_MANIFEST'
 
 # Function to connect to the MySQL database
 def get_db_connection(db_config):
-	return pymysql.connect(**db_config)
+	return instrumentation.instrument_connection(pymysql.connect(**db_config))
 
 # Function to fetch min and max trade_id from the database
 def get_trade_id_range(connection, table_name):
-	try:
-		with connection.cursor() as cursor:
-			query = f"SELECT MIN(trade_id), MAX(trade_id) FROM {table_name}"
-			cursor.execute(query)
-			result = cursor.fetchone()
-			return result[0], result[1]
-	finally:
-		connection.close()
+	with connection.cursor() as cursor:
+		query = f"SELECT MIN(trade_id), MAX(trade_id) FROM {table_name}"
+		cursor.execute(query)
+		result = cursor.fetchone()
+		return result[0], result[1]
 
-# Function to fetch data in chunks based on trade_id range
-def fetch_chunk(connection, table_name, start_trade_id, end_trade_id):
-	try:
-		with connection.cursor() as cursor:
+# Function to fetch the trade_id ranges of a table with their number of ticks, used to balance the tasks
+# The import manifest has one range per imported archive, tables without one are counted in HISTOGRAM_BUCKETS buckets
+def get_trade_id_segments(connection, table_name, start_trade_id, end_trade_id):
+	with connection.cursor() as cursor:
+		try:
+			cursor.execute(f"SELECT first_trade_id, last_trade_id, row_count FROM {MANIFEST_TABLE} WHERE table_name = %s AND status = 'complete'", (table_name,))
+			segments = [row for row in cursor.fetchall() if row[2]]
+		except pymysql.MySQLError:
+			segments = []
+		
+		if not segments:
+			bucket_size = -(-(end_trade_id - start_trade_id + 1) // HISTOGRAM_BUCKETS)
+			query = f"""
+				SELECT MIN(trade_id), MAX(trade_id), COUNT(*)
+				FROM {table_name}
+				GROUP BY (trade_id - %s) DIV %s
+			"""
+			cursor.execute(query, (start_trade_id, bucket_size))
+			segments = cursor.fetchall()
+	
+	return sorted(segments)
+
+# Function to split a trade_id range into tasks of about task_rows ticks each
+# The ticks are assumed to be spread evenly within every segment (start, end, rows), so gaps in the trade ids and busy
+# periods are split by their number of ticks rather than by their width. Together the tasks cover the whole range
+def plan_tasks(segments, start_trade_id, end_trade_id, task_rows):
+	tasks = []
+	task_start = start_trade_id
+	task_ticks = 0
+	for segment_start, segment_end, segment_rows in segments:
+		position = max(segment_start, start_trade_id, task_start)
+		segment_last = min(segment_end, end_trade_id)
+		if position > segment_last or not segment_rows:
+			continue
+		
+		density = segment_rows / (segment_end - segment_start + 1)
+		ticks_left = (segment_last - position + 1) * density
+		while task_ticks + ticks_left >= task_rows:
+			# Last trade id of the task, where it reaches task_rows ticks
+			task_end = min(position + int(np.ceil((task_rows - task_ticks) / density)) - 1, segment_last)
+			tasks.append((task_start, task_end))
+			ticks_left -= (task_end - position + 1) * density
+			position = task_start = task_end + 1
+			task_ticks = 0
+		task_ticks += ticks_left
+	
+	# The remainder becomes the last task, or is added to the previous one if it has no ticks
+	if task_start <= end_trade_id:
+		if task_ticks >= 1 or not tasks:
+			tasks.append((task_start, end_trade_id))
+		else:
+			tasks[-1] = (tasks[-1][0], end_trade_id)
+	
+	return tasks
+
+# Function to estimate the number of ticks of a trade_id range from the segments, assuming they are spread evenly within every segment
+def estimate_rows(segments, start_trade_id, end_trade_id):
+	rows = 0
+	for segment_start, segment_end, segment_rows in segments:
+		overlap = min(segment_end, end_trade_id) - max(segment_start, start_trade_id) + 1
+		if overlap > 0:
+			rows += segment_rows * overlap / (segment_end - segment_start + 1)
+	return int(rows)
+
+# Function to choose the number of ticks per task: enough tasks to keep all workers busy until the end, but no smaller than a page
+def get_task_rows(total_rows, workers, page_size):
+	return max(page_size, -(-total_rows // (workers * TASKS_PER_WORKER)))
+
+# Function to turn a page of rows into a DataFrame of typed columns
+def page_from_rows(rows):
+	# pandas is only imported by the stages that read ticks, so --help and --plan start without it
+	import pandas as pd
+	
+	price, volume, side, trade_id, time = zip(*rows)
+	return pd.DataFrame({
+		'price': np.asarray(price, dtype=np.float64),
+		'volume': np.asarray(volume, dtype=np.float64),
+		# Tables in the legacy layout store the side as text
+		'side': np.asarray(side).astype(np.uint8),
+		'trade_id': np.asarray(trade_id, dtype=np.int64),
+		# Tables in the compact layout store the times as nanoseconds
+		'time': time_to_seconds(time)
+	})
+
+# Function to fetch a trade_id range page by page, each query continues after the last trade_id of the previous page
+# (keyset pagination), so every page is a short range scan of the trade_id index and no result set is held on the server
+def fetch_pages(connection, table_name, start_trade_id, end_trade_id, page_size=PAGE_SIZE):
+	last_trade_id = start_trade_id - 1
+	with connection.cursor() as cursor:
+		while last_trade_id < end_trade_id:
 			query = f"""
 				SELECT price, volume, side, trade_id, time
 				FROM {table_name}
-				WHERE trade_id BETWEEN {start_trade_id} AND {end_trade_id}
+				WHERE trade_id > %s AND trade_id <= %s
+				ORDER BY trade_id
+				LIMIT %s
 			"""
-			cursor.execute(query)
-			columns = [desc[0] for desc in cursor.description]
-			data = cursor.fetchall()
-			return pd.DataFrame(data, columns=columns)
-	finally:
-		connection.close()
+			cursor.execute(query, (last_trade_id, end_trade_id, page_size))
+			rows = cursor.fetchall()
+			if not rows:
+				break
+			
+			page = page_from_rows(rows)
+			last_trade_id = int(page['trade_id'].iloc[-1])
+			yield page
+
+# Function to fetch the same range from the Parquet tick store in pages of page_size trade ids,
+# only reading the partitions and row groups that overlap each page and jumping over gaps in the trade ids
+def fetch_pages_from_tick_store(tick_store, symbol, start_trade_id, end_trade_id, start_time=None, end_time=None, page_size=PAGE_SIZE):
+	page_start = start_trade_id
+	while page_start is not None and page_start <= end_trade_id:
+		page_end = min(page_start + page_size - 1, end_trade_id)
+		table = read_ticks(tick_store, symbol, start_time, end_time, page_start, page_end, columns=['price', 'volume', 'side', 'trade_id', 'time'])
+		
+		if table.num_rows > 0:
+			yield table.to_pandas()
+			page_start = page_end + 1
+		else:
+			page_start = next_trade_id(tick_store, symbol, page_end)
 
-# Function to preprocess a chunk of data using a given scaler
-def preprocess_chunk(chunk, scaler):
+# Function to fetch the pages of a range from the tick store if one is given, otherwise from the database
+def fetch_ticks(connection, table_name, start_trade_id, end_trade_id, tick_store=None, time_range=(None, None), page_size=PAGE_SIZE):
+	if tick_store:
+		return fetch_pages_from_tick_store(tick_store, table_name.removesuffix('_TICK_DATA'), start_trade_id, end_trade_id, *time_range, page_size)
+	return fetch_pages(connection, table_name, start_trade_id, end_trade_id, page_size)
+
+# Function to preprocess a chunk of data (the scaling is applied later, once the statistics of all workers are known)
+def preprocess_chunk(chunk):
 	# Optimize data types
 	chunk['price'] = chunk['price'].astype('float64')
 	chunk['volume'] = chunk['volume'].astype('float64')
 	chunk['side'] = chunk['side'].astype('uint8')
 	chunk['time'] = chunk['time'].astype('float64')
 	
-	# Normalize price, volume, and time using the provided scaler
-	chunk[['price', 'volume', 'time']] = scaler.transform(chunk[['price', 'volume', 'time']])
-	
 	return chunk
 
-# Function to write a DataFrame to Parquet file, appending if it exists
-def write_to_parquet(df, file_path):
-	df.to_parquet(file_path, index=False)
+# Function to process data page by page and write to disk, returns the scaler statistics of the range
+# Every page is appended to the task's Parquet file as it arrives, so the range is never held in memory at once
+def process_data_in_chunks(connection, table_name, start_trade_id, end_trade_id, is_training, task_index, tick_store=None, time_range=(None, None), page_size=PAGE_SIZE, output_dir='.'):
+	# Create a unique file path for each task, numbered in trade_id order
+	if is_training:
+		file_path = os.path.join(output_dir, TRAINING_DIR_PATH, f'training_part_{task_index:05d}.parquet')
+	else:
+		file_path = os.path.join(output_dir, TESTING_DIR_PATH, f'testing_part_{task_index:05d}.parquet')
+	
+	statistics = ScalerStatistics()
+	writer = None
+	try:
+		for page in fetch_ticks(connection, table_name, start_trade_id, end_trade_id, tick_store, time_range, page_size):
+			page = preprocess_chunk(page)
+			statistics.update(page[SCALED_COLUMNS])
+			instrumentation.add(rows=len(page))
+			
+			table = pa.Table.from_pandas(page, preserve_index=False)
+			if writer is None:
+				writer = pq.ParquetWriter(file_path, table.schema)
+			writer.write_table(table)
+	finally:
+		if writer is not None:
+			writer.close()
+	
+	return statistics
+
+# Settings shared by all tasks of a pool worker, and its database connection that is reused for all of them
+worker_state = {}
 
-# Function to process data in chunks and write to disk using a given scaler
-def process_data_in_chunks(connection_params, table_name, start_trade_id, end_trade_id, is_training, worker_id, scaler):
-	connection = get_db_connection(connection_params)
-	chunk = fetch_chunk(connection, table_name, start_trade_id, end_trade_id)
+# Function to set up a pool worker, called once in every worker process
+def init_worker(connection_params, table_name, tick_store, time_range, page_size, output_dir, metrics_log=None):
+	instrumentation.configure(metrics_log)
+	worker_state['table_name'] = table_name
+	worker_state['tick_store'] = tick_store
+	worker_state['time_range'] = time_range
+	worker_state['page_size'] = page_size
+	worker_state['output_dir'] = output_dir
+	worker_state['connection'] = None if tick_store else get_db_connection(connection_params)
+
+# Function to run one task (task_index, is_training, start_trade_id, end_trade_id) in a pool worker
+def run_task(task):
+	task_index, is_training, start_trade_id, end_trade_id = task
+	with instrumentation.span('task', task_index=task_index, training=is_training, start_trade_id=start_trade_id, end_trade_id=end_trade_id):
+		statistics = process_data_in_chunks(worker_state['connection'], worker_state['table_name'], start_trade_id, end_trade_id, is_training, task_index, worker_state['tick_store'], worker_state['time_range'], worker_state['page_size'], worker_state['output_dir'])
+	return is_training, statistics
+
+# Function to print the progress and throughput while the tasks complete, passes the results on
+def report_progress(results, task_count):
+	started = datetime.now()
+	ticks = 0
+	for done, result in enumerate(results, 1):
+		ticks += result[1].count
+		elapsed = (datetime.now() - started).total_seconds()
+		print(f"{done}/{task_count} tasks, {ticks:,} ticks, {ticks / max(elapsed, 1e-9):,.0f} ticks/s")
+		yield result
+
+# Function to remove the worker files of a previous run from a directory
+def clear_parquet_files(directory):
+	for f in os.listdir(directory):
+		if f.endswith('.parquet'):
+			os.remove(os.path.join(directory, f))
+
+# Function to read the task files of a directory in task (trade_id) order, as record batches of up to batch_size rows
+def iter_part_batches(directory, batch_size=ROW_GROUP_SIZE):
+	for f in sorted(f for f in os.listdir(directory) if f.endswith('.parquet')):
+		instrumentation.add(bytes_read=os.path.getsize(os.path.join(directory, f)))
+		yield from pq.ParquetFile(os.path.join(directory, f)).iter_batches(batch_size=batch_size)
+
+# Function to regroup record batches into tables of row_group_size rows (the last one can be smaller)
+def regroup_batches(batches, row_group_size=ROW_GROUP_SIZE):
+	buffered = []
+	rows = 0
+	for batch in batches:
+		buffered.append(batch)
+		rows += batch.num_rows
+		if rows >= row_group_size:
+			table = pa.Table.from_batches(buffered)
+			while table.num_rows >= row_group_size:
+				yield table.slice(0, row_group_size)
+				table = table.slice(row_group_size)
+			buffered = table.to_batches()
+			rows = table.num_rows
 	
-	if not chunk.empty:
-		processed_chunk = preprocess_chunk(chunk, scaler)
-		
-		# Create a unique file path for each worker
-		if is_training:
-			file_path = os.path.join(TRAINING_DIR_PATH, f'training_worker_{worker_id}_{start_trade_id}.parquet')
-		else:
-			file_path = os.path.join(TESTING_DIR_PATH, f'testing_worker_{worker_id}_{start_trade_id}.parquet')
-		
-		write_to_parquet(processed_chunk, file_path)
+	if rows:
+		yield pa.Table.from_batches(buffered)
 
-# Function to merge parquet files in a directory into a single DataFrame
-def merge_parquet_files(directory):
-	return pd.concat([pd.read_parquet(os.path.join(directory, f)) for f in os.listdir(directory) if f.endswith('.parquet')], ignore_index=True)
+# Function to scale the task files of a directory and write them to a single Parquet file in trade_id order
+# The writer is fed one row group at a time, so the data is never held in memory at once
+def write_final_file(directory, file_path, scaler):
+	writer = None
+	try:
+		for table in regroup_batches(iter_part_batches(directory)):
+			df = scale_columns(table.to_pandas(), scaler)
+			instrumentation.add(rows=len(df))
+			table = pa.Table.from_pandas(df, preserve_index=False)
+			if writer is None:
+				writer = pq.ParquetWriter(file_path, table.schema, write_statistics=['trade_id', 'time'])
+			writer.write_table(table)
+	finally:
+		if writer is not None:
+			writer.close()
 
 # Main function to orchestrate the preprocessing
-def main(table_name_prefix):
+# With a tick store the data is read from its Parquet files instead of the database, optionally limited to a time range
+# The scaler is fitted on the statistics of the whole training range, which the workers collect while reading it
+# The ranges are split into many tasks with about the same number of ticks, which one pool of workers picks up as they finish
+# With reuse_scaler the scaler of an earlier run is applied instead, so the data matches a model that is trained incrementally
+# With plan only the tasks are printed, without reading any ticks or writing any files
+# All files are written to output_dir, so runs of different symbols or ranges do not overwrite each other
+def main(table_name_prefix, tick_store=None, start_time=None, end_time=None, page_size=PAGE_SIZE, scaler_kind='minmax', workers=None, memory_budget=None, reuse_scaler=False, plan=False, output_dir='.'):
 	table_name = f"{table_name_prefix}_TICK_DATA"
+	scaler_path = os.path.join(output_dir, SCALER_PATH)
+	training_dir = os.path.join(output_dir, TRAINING_DIR_PATH)
+	testing_dir = os.path.join(output_dir, TESTING_DIR_PATH)
+	time_range = (start_time, end_time)
+	workers = workers or cpu_count()
+	
+	if reuse_scaler and not os.path.exists(scaler_path):
+		raise ValueError(f"No scaler to reuse at {scaler_path}")
 	
 	# Database connection parameters
 	DB_CONFIG = {
@@ -99,79 +316,104 @@ def main(table_name_prefix):
 		'database': 'PROJECT_4560'
 	}
 	
-	# Get trade_id range
-	connection = get_db_connection(DB_CONFIG)
-	start_trade_id, end_trade_id = get_trade_id_range(connection, table_name)
+	# Get trade_id range and the number of ticks in its parts
+	with instrumentation.span('ranges'):
+		if tick_store:
+			start_trade_id, end_trade_id = trade_id_range(tick_store, table_name_prefix, start_time, end_time)
+			if start_trade_id is None:
+				raise ValueError(f"No ticks for {table_name_prefix} in the tick store {tick_store}")
+			segments = trade_id_segments(tick_store, table_name_prefix, start_time, end_time)
+		else:
+			connection = get_db_connection(DB_CONFIG)
+			try:
+				start_trade_id, end_trade_id = get_trade_id_range(connection, table_name)
+				segments = get_trade_id_segments(connection, table_name, start_trade_id, end_trade_id)
+			finally:
+				connection.close()
 	
 	# Calculate 60% and 40% of the data range
 	total_range = end_trade_id - start_trade_id + 1
 	training_end_trade_id = start_trade_id + int(0.6 * total_range) - 1
 	
-	# Number of processes (CPU cores)
-	n_partitions = 8 #cpu_count()
+	# Fit the pages of all workers into the memory budget
+	if memory_budget:
+		page_size = max(1, min(page_size, memory_budget * MIB // (workers * PAGE_BYTES_PER_TICK)))
 	
-	# Define chunk sizes for training and testing
-	training_chunk_size = int((training_end_trade_id - start_trade_id + 1) / n_partitions)
-	testing_chunk_size = int((end_trade_id - training_end_trade_id) / n_partitions)
+	# Split the training and testing ranges into tasks, numbered in trade_id order
+	task_rows = get_task_rows(sum(segment[2] for segment in segments), workers, page_size)
+	ranges = [(True, start, end) for start, end in plan_tasks(segments, start_trade_id, training_end_trade_id, task_rows)]
+	ranges += [(False, start, end) for start, end in plan_tasks(segments, training_end_trade_id + 1, end_trade_id, task_rows)]
+	tasks = [(task_index, is_training, start, end) for task_index, (is_training, start, end) in enumerate(ranges)]
+	print(f"Processing {len(tasks)} tasks of ~{task_rows:,} ticks with {workers} workers (page size {page_size:,})")
 	
-	# Fetch the first chunk to train the scaler
-	initial_chunk = fetch_chunk(get_db_connection(DB_CONFIG), table_name, start_trade_id, start_trade_id + training_chunk_size - 1)
+	if plan:
+		for name, is_training, start, end in [('Training', True, start_trade_id, training_end_trade_id), ('Testing', False, training_end_trade_id + 1, end_trade_id)]:
+			part_tasks = sum(1 for task in tasks if task[1] == is_training)
+			print(f"{name}: trade_id {start} to {end}, ~{estimate_rows(segments, start, end):,} ticks in {part_tasks} tasks")
+		print(f"Pages of all workers: ~{workers * page_size * PAGE_BYTES_PER_TICK / MIB:,.0f} MiB")
+		print(f"Scaler: {'reuse ' + scaler_path if reuse_scaler else scaler_kind}")
+		return
 	
-	if not initial_chunk.empty:
-		# Optimize data types for the initial chunk
-		initial_chunk['price'] = initial_chunk['price'].astype('float64')
-		initial_chunk['volume'] = initial_chunk['volume'].astype('float64')
-		initial_chunk['side'] = initial_chunk['side'].astype('uint8')
-		initial_chunk['time'] = initial_chunk['time'].astype('float64')
-		
-		# Train the scaler on the first chunk
-		scaler = MinMaxScaler()
-		initial_chunk[['price', 'volume', 'time']] = scaler.fit_transform(initial_chunk[['price', 'volume', 'time']])
-		
-		# Save the trained scaler to a file
-		with open(SCALER_PATH, 'wb') as scaler_file:
-			pickle.dump(scaler, scaler_file)
-	
-	# Prepare arguments for the multiprocessing pool for training data
-	args_training = []
-	current_start = start_trade_id
-	for i in range(n_partitions):
-		current_end = min(current_start + training_chunk_size - 1, training_end_trade_id)
-		args_training.append((DB_CONFIG, table_name, current_start, current_end, True, i, scaler))
-		current_start = current_end + 1
-	
-	# Prepare arguments for the multiprocessing pool for testing data
-	args_testing = []
-	current_start = training_end_trade_id + 1
-	for i in range(n_partitions):
-		current_end = min(current_start + testing_chunk_size - 1, end_trade_id)
-		args_testing.append((DB_CONFIG, table_name, current_start, current_end, False, i, scaler))
-		current_start = current_end + 1
-	
-	# Process training data
-	with Pool(processes=n_partitions) as pool:
-		pool.starmap(process_data_in_chunks, args_training)
-	
-	# Process testing data
-	with Pool(processes=n_partitions) as pool:
-		pool.starmap(process_data_in_chunks, args_testing)
-	
-	# Merge all parquet files into a single DataFrame and write to final file
-	training_df = merge_parquet_files(TRAINING_DIR_PATH)
-	testing_df = merge_parquet_files(TESTING_DIR_PATH)
-	
-	training_df.to_parquet('final_training_data.parquet', index=False)
-	testing_df.to_parquet('final_testing_data.parquet', index=False)
+	os.makedirs(training_dir, exist_ok=True)
+	os.makedirs(testing_dir, exist_ok=True)
+	clear_parquet_files(training_dir)
+	clear_parquet_files(testing_dir)
+	
+	# Process training and testing data, every worker keeps its database connection for all its tasks
+	# pandas is imported before the workers are started, so they do not import it again each
+	import pandas
+	training_statistics = []
+	with instrumentation.span('read', tasks=len(tasks), workers=workers), Pool(processes=workers, initializer=init_worker, initargs=(DB_CONFIG, table_name, tick_store, time_range, page_size, output_dir, instrumentation.log_path())) as pool:
+		for is_training, statistics in report_progress(pool.imap_unordered(run_task, tasks), len(tasks)):
+			instrumentation.add(rows=statistics.count)
+			if is_training:
+				training_statistics.append(statistics)
+	
+	# Fit the scaler on the merged statistics of the training workers and save it to a file, or load the earlier one
+	with instrumentation.span('scaler', reuse=reuse_scaler):
+		if reuse_scaler:
+			with open(scaler_path, 'rb') as scaler_file:
+				scaler = pickle.load(scaler_file)
+		else:
+			scaler = merge_statistics(training_statistics).to_scaler(scaler_kind)
+			with open(scaler_path, 'wb') as scaler_file:
+				pickle.dump(scaler, scaler_file)
+	
+	# Normalize price, volume, and time of the task files and write them to the final files in trade_id order
+	with instrumentation.span('write', file='final_training_data.parquet'):
+		write_final_file(training_dir, os.path.join(output_dir, 'final_training_data.parquet'), scaler)
+	with instrumentation.span('write', file='final_testing_data.parquet'):
+		write_final_file(testing_dir, os.path.join(output_dir, 'final_testing_data.parquet'), scaler)
 
 if __name__ == "__main__":
 	# Set up argument parser
 	parser = argparse.ArgumentParser(description="Preprocess trading data from a MySQL database.")
 	parser.add_argument('--table-prefix', type=str, required=True, help='Prefix of the table name (e.g., ETHUSDC)')
+	parser.add_argument('--tick-store', type=str, default=None, help='Read the ticks from this Parquet tick store instead of the database (the table prefix is the symbol)')
+	parser.add_argument('--start-time', type=datetime.fromisoformat, default=None, help='Only use ticks from this UTC date/time on (tick store only, e.g., 2022-05-01)')
+	parser.add_argument('--end-time', type=datetime.fromisoformat, default=None, help='Only use ticks up to this UTC date/time (tick store only)')
+	parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='Number of ticks fetched per query (bounds the memory use of each worker)')
+	parser.add_argument('--scaler', type=str, choices=SCALERS, default='minmax', help='Scaler fitted on the training data (min-max or standardization)')
+	parser.add_argument('--workers', type=int, default=cpu_count(), help='Number of worker processes (default: number of CPU cores)')
+	parser.add_argument('--memory-budget', type=int, default=None, help='Memory budget in MiB for the pages of all workers, lowers the page size to fit')
+	parser.add_argument('--reuse-scaler', action='store_true', help='Scale the data with the scaler of an earlier run instead of fitting a new one (for incremental training)')
+	parser.add_argument('--plan', '--dry-run', action='store_true', help='Only print the trade_id ranges and tasks, without reading any ticks or writing any files')
+	parser.add_argument('--output-dir', type=str, default='.', help='Directory of the task files, final files, and scaler (default: current directory)')
+	parser.add_argument('--metrics-log', type=str, default=None, help="Append the time, rows, bytes read, peak memory and database time of every stage to this file as JSON lines ('-' for stderr)")
+	parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and write the stats of the main process to this file')
 	
 	args = parser.parse_args()
+
+	# Time bounds in Unix seconds, like the time column of the ticks
+	start_bound = args.start_time.replace(tzinfo=timezone.utc).timestamp() if args.start_time else None
+	end_bound = args.end_time.replace(tzinfo=timezone.utc).timestamp() if args.end_time else None
+	if (start_bound or end_bound) and not args.tick_store:
+		parser.error('--start-time and --end-time require --tick-store')
 	
+	instrumentation.configure(args.metrics_log, args.profile)
 	start_time = datetime.now()
-	main(args.table_prefix)
+	with instrumentation.span('preprocess', symbol=args.table_prefix):
+		main(args.table_prefix, args.tick_store, start_bound, end_bound, args.page_size, args.scaler, args.workers, args.memory_budget, args.reuse_scaler, args.plan, args.output_dir)
 	end_time = datetime.now()
 	
 	print(f"Data preprocessed in {end_time - start_time}")
@@ -0,0 +1,108 @@
+# Scaler statistics computed in parallel over parts of the data and merged into one scikit-learn scaler.
+# Every worker accumulates the count, min/max and mean/variance of its pages in the same pass it reads them, so the scaler
+# covers the whole training range without fetching any of it twice.
+# scikit-learn and pandas are only imported when a scaler is fitted or used, so scripts start without them.
+
+import numpy as np
+
+# Columns that are scaled, in the order the scalers expect them
+SCALED_COLUMNS = ['price', 'volume', 'time']
+
+SCALERS = ['minmax', 'standard']
+
+# Running statistics of the scaled columns
+class ScalerStatistics:
+	def __init__(self, n_features=len(SCALED_COLUMNS)):
+		self.count = 0
+		self.minimum = np.full(n_features, np.inf)
+		self.maximum = np.full(n_features, -np.inf)
+		self.mean = np.zeros(n_features)
+		self.m2 = np.zeros(n_features)
+
+	# Add a page of rows (2D array or DataFrame with the scaled columns)
+	def update(self, values):
+		values = np.asarray(values, dtype=np.float64)
+		if len(values) == 0:
+			return
+
+		page = ScalerStatistics(values.shape[1])
+		page.count = len(values)
+		page.minimum = values.min(axis=0)
+		page.maximum = values.max(axis=0)
+		page.mean = values.mean(axis=0)
+		page.m2 = ((values - page.mean) ** 2).sum(axis=0)
+		self.merge(page)
+
+	# Combine with the statistics of another part (Chan et al.'s parallel variance)
+	def merge(self, other):
+		if other.count == 0:
+			return self
+
+		count = self.count + other.count
+		delta = other.mean - self.mean
+
+		self.minimum = np.minimum(self.minimum, other.minimum)
+		self.maximum = np.maximum(self.maximum, other.maximum)
+		self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+		self.mean = self.mean + delta * other.count / count
+		self.count = count
+		return self
+
+	@property
+	def variance(self):
+		return self.m2 / self.count
+
+	# Fitted scikit-learn scaler with the same attributes as one fitted on all the rows at once
+	def to_scaler(self, kind='minmax'):
+		import pandas as pd
+		from sklearn.preprocessing import MinMaxScaler, StandardScaler
+
+		if self.count == 0:
+			raise ValueError("No rows to fit the scaler on")
+
+		if kind == 'minmax':
+			# Fitting on the two extreme rows gives the same ranges as fitting on all of them
+			scaler = MinMaxScaler().fit(pd.DataFrame([self.minimum, self.maximum], columns=SCALED_COLUMNS))
+		elif kind == 'standard':
+			scaler = StandardScaler().fit(pd.DataFrame([self.minimum, self.maximum], columns=SCALED_COLUMNS))
+			scaler.mean_ = self.mean.copy()
+			scaler.var_ = self.variance
+			# Constant columns are left unscaled, like StandardScaler does
+			scaler.scale_ = np.where(self.variance > 0, np.sqrt(self.variance), 1.0)
+		else:
+			raise ValueError(f"Unknown scaler: {kind}")
+
+		scaler.n_samples_seen_ = self.count
+		return scaler
+
+# Merge the statistics of several parts
+def merge_statistics(parts):
+	statistics = ScalerStatistics()
+	for part in parts:
+		statistics.merge(part)
+	return statistics
+
+# Scale the columns of a DataFrame in place
+def scale_columns(df, scaler):
+	df[SCALED_COLUMNS] = scaler.transform(df[SCALED_COLUMNS])
+	return df
+
+# Undo the scaling of a single column (1D array), without the other columns
+def inverse_scale_column(values, scaler, column):
+	from sklearn.preprocessing import MinMaxScaler
+
+	index = SCALED_COLUMNS.index(column)
+	values = np.asarray(values, dtype=np.float64)
+	if isinstance(scaler, MinMaxScaler):
+		return (values - scaler.min_[index]) / scaler.scale_[index]
+	return values * scaler.scale_[index] + scaler.mean_[index]
+
+# Scale a single column (1D array) like the scaler scales it together with the other columns
+def scale_column(values, scaler, column):
+	from sklearn.preprocessing import MinMaxScaler
+
+	index = SCALED_COLUMNS.index(column)
+	values = np.asarray(values, dtype=np.float64)
+	if isinstance(scaler, MinMaxScaler):
+		return values * scaler.scale_[index] + scaler.min_[index]
+	return (values - scaler.mean_[index]) / scaler.scale_[index]
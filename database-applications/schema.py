@@ -0,0 +1,267 @@
+# Schema management for the tick and candle tables.
+# New tables use the compact layout: BIGINT nanosecond times, TINYINT side and DOUBLE prices, clustered on trade_id (ticks)
+# and start_time (candles), optionally RANGE partitioned by month. Tables in the legacy layout can be migrated in place.
+
+import os
+import re
+from datetime import datetime, timezone
+import numpy as np
+
+NANOSECONDS_PER_SECOND = 10**9
+MINUTE_NS = 60 * NANOSECONDS_PER_SECOND
+
+# Fixed alignment of the candles across archives, weekly bars start on Mondays (1970-01-05 00:00 UTC)
+CANDLE_ORIGIN_NS = 4 * 1440 * MINUTE_NS
+
+# Timeframes (and their lengths in minutes) whose legacy bars started on the first day of every archive instead of at the
+# origin, their migrated bars are rebuilt from the ticks
+REALIGNED_TIMEFRAMES = {"7D": 10080}
+
+TICK_COLUMNS = "trade_id BIGINT NOT NULL, price DOUBLE NOT NULL, volume DOUBLE NOT NULL, time BIGINT NOT NULL, side TINYINT NOT NULL"
+CANDLE_COLUMNS = "start_time BIGINT NOT NULL, end_time BIGINT NOT NULL, open DOUBLE, high DOUBLE, low DOUBLE, close DOUBLE, volume DOUBLE, first_trade_id BIGINT, last_trade_id BIGINT, trade_count INT"
+
+# Secondary indexes of the tick table, created either with the table or after the import (--defer-indexes)
+TICK_INDEXES = {"idx_time": "time"}
+
+# Merge a bar into the stored bar with the same start time, in trade id order so archives can be imported in any order
+# Trade ids are consecutive, so the volume and trade count of a bar whose trades fit into the combined trade id range next to
+# the stored ones are added. A bar whose trades do not fit has already been merged, unless it covers all the stored trade ids
+# (e.g. a whole archive after an interrupted streaming import), in which case it replaces them
+# NOTE: MySQL applies the assignments left to right, the trade ids have to be updated last
+CANDLE_TRADES_MERGE = (
+	"CASE WHEN first_trade_id IS NULL OR VALUES(first_trade_id) IS NULL"
+	" OR trade_count + VALUES(trade_count) <= GREATEST(last_trade_id, VALUES(last_trade_id)) - LEAST(first_trade_id, VALUES(first_trade_id)) + 1"
+	" THEN {column} + VALUES({column})"
+	" WHEN VALUES(first_trade_id) <= first_trade_id AND VALUES(last_trade_id) >= last_trade_id THEN VALUES({column})"
+	" ELSE {column} END"
+)
+CANDLE_UPSERT = ", ".join([
+	"open = IF(first_trade_id IS NULL OR VALUES(first_trade_id) < first_trade_id, VALUES(open), open)",
+	"close = IF(last_trade_id IS NULL OR VALUES(last_trade_id) > last_trade_id, VALUES(close), close)",
+	"high = COALESCE(GREATEST(high, VALUES(high)), high, VALUES(high))",
+	"low = COALESCE(LEAST(low, VALUES(low)), low, VALUES(low))",
+	"volume = " + CANDLE_TRADES_MERGE.format(column="volume"),
+	"trade_count = " + CANDLE_TRADES_MERGE.format(column="trade_count"),
+	"first_trade_id = COALESCE(LEAST(first_trade_id, VALUES(first_trade_id)), first_trade_id, VALUES(first_trade_id))",
+	"last_trade_id = COALESCE(GREATEST(last_trade_id, VALUES(last_trade_id)), last_trade_id, VALUES(last_trade_id))"
+])
+
+# Merge for the partial bars of legacy candle tables, which have no trade ids: they are merged in the order they were imported
+LEGACY_CANDLE_MERGE = ", ".join([
+	"open = COALESCE(open, VALUES(open))",
+	"close = COALESCE(VALUES(close), close)",
+	"high = COALESCE(GREATEST(high, VALUES(high)), high, VALUES(high))",
+	"low = COALESCE(LEAST(low, VALUES(low)), low, VALUES(low))",
+	"volume = volume + VALUES(volume)"
+])
+
+# Partition that holds everything after the last month partition
+FUTURE_PARTITION = "p_future"
+
+# Number of trades copied per statement when migrating a tick table
+MIGRATION_CHUNK_SIZE = 1_000_000
+
+# Tick times in float seconds, from either layout (BIGINT nanoseconds in the compact layout, DOUBLE seconds in the legacy one)
+def time_to_seconds(time):
+	time = np.asarray(time)
+	if np.issubdtype(time.dtype, np.integer):
+		return time / NANOSECONDS_PER_SECOND
+
+	return time.astype(np.float64)
+
+def month_partitioning(column):
+	return f" PARTITION BY RANGE ({column}) (PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE)"
+
+def tick_table_ddl(table_name, defer_indexes=False, partition_by_month=False):
+	# The partitioning column has to be part of every unique key
+	key = "PRIMARY KEY (trade_id, time)" if partition_by_month else "PRIMARY KEY (trade_id)"
+	indexes = "" if defer_indexes else "".join(f", INDEX {name} ({column})" for name, column in TICK_INDEXES.items())
+	partitioning = month_partitioning("time") if partition_by_month else ""
+
+	return f"CREATE TABLE IF NOT EXISTS {table_name} ({TICK_COLUMNS}, {key}{indexes}){partitioning}"
+
+def candle_table_ddl(table_name, partition_by_month=False):
+	partitioning = month_partitioning("start_time") if partition_by_month else ""
+	return f"CREATE TABLE IF NOT EXISTS {table_name} ({CANDLE_COLUMNS}, PRIMARY KEY (start_time)){partitioning}"
+
+# Create the tick table and a candle table for each timeframe
+def create_tables(db_cursor, table_name, timeframes, defer_indexes=False, partition_by_month=False):
+	db_cursor.execute(tick_table_ddl(table_name, defer_indexes, partition_by_month))
+	for tf in timeframes:
+		db_cursor.execute(candle_table_ddl(f"{table_name}_{tf}", partition_by_month))
+
+# Add the secondary indexes after the data has been loaded, skipping the ones that already exist
+def create_indexes(db_cursor, table_name):
+	db_cursor.execute(f"SHOW INDEX FROM {table_name}")
+	existing = {row[2] for row in db_cursor.fetchall()}
+
+	missing = [f"ADD INDEX {name} ({column})" for name, column in TICK_INDEXES.items() if name not in existing]
+	if missing:
+		db_cursor.execute(f"ALTER TABLE {table_name} " + ", ".join(missing))
+
+# Column names and types of a table
+def table_columns(db_cursor, table_name):
+	db_cursor.execute(f"SHOW COLUMNS FROM {table_name}")
+	return {row[0]: row[1].decode() if isinstance(row[1], bytes) else row[1] for row in db_cursor.fetchall()}
+
+# Layout of a tick table, "compact" (nanosecond BIGINT times) or "legacy" (DOUBLE seconds)
+def table_layout(db_cursor, table_name):
+	return "compact" if table_columns(db_cursor, table_name)["time"].lower().startswith("bigint") else "legacy"
+
+# Start of a month in Unix nanoseconds
+def month_start_ns(year, month):
+	return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp()) * NANOSECONDS_PER_SECOND
+
+def next_month(year, month):
+	return (year + 1, 1) if month == 12 else (year, month + 1)
+
+# Months of the archives, taken from the dates in their names or tick store partitions (e.g. ETHBTC-trades-2022-05-31.zip)
+def archive_months(files):
+	months = set()
+	for file in files:
+		match = re.search(r"(\d{4})-(\d{2})", os.path.basename(file))
+		if match:
+			months.add((int(match.group(1)), int(match.group(2))))
+
+	return sorted(months)
+
+# Months between two Unix nanosecond times, inclusive
+def months_between(start_ns, end_ns):
+	start = datetime.fromtimestamp(start_ns // NANOSECONDS_PER_SECOND, tz=timezone.utc)
+	end = datetime.fromtimestamp(end_ns // NANOSECONDS_PER_SECOND, tz=timezone.utc)
+
+	months = [(start.year, start.month)]
+	while months[-1] < (end.year, end.month):
+		months.append(next_month(*months[-1]))
+	return months
+
+# Split the future partition of a month-partitioned table so that every month up to the newest of the given months has its own
+# partition, including the months between them and the last existing month partition that have no data yet
+# Months before the last existing month partition are left in the partitions that already cover them
+def ensure_month_partitions(db_cursor, table_name, months):
+	if not months:
+		return
+
+	db_cursor.execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table_name,))
+	partitions = db_cursor.fetchall()
+	if not partitions or partitions[0][0] is None:
+		return
+
+	# The first new partition is the month that starts at the last bound, or the oldest given month of a table without any
+	bounds = [int(description) for _, description in partitions if description != "MAXVALUE"]
+	if bounds:
+		last_bound = datetime.fromtimestamp(max(bounds) // NANOSECONDS_PER_SECOND, tz=timezone.utc)
+		month = (last_bound.year, last_bound.month)
+	else:
+		month = min(months)
+
+	new_partitions = []
+	while month <= max(months):
+		new_partitions.append(f"PARTITION p{month[0]:04d}{month[1]:02d} VALUES LESS THAN ({month_start_ns(*next_month(*month))})")
+		month = next_month(*month)
+
+	if new_partitions:
+		new_partitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+		db_cursor.execute(f"ALTER TABLE {table_name} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({', '.join(new_partitions)})")
+
+# Replace a table with its migrated copy
+def swap_tables(db_cursor, table_name, new_table):
+	db_cursor.execute(f"RENAME TABLE {table_name} TO {table_name}_legacy, {new_table} TO {table_name}")
+	db_cursor.execute(f"DROP TABLE {table_name}_legacy")
+
+# Copy a legacy tick table into the compact layout in trade id ranges, then swap the tables
+# Duplicate trades (the legacy tables have no primary key) are dropped
+def migrate_tick_table(db_connector, db_cursor, table_name, partition_by_month=False, chunk_size=MIGRATION_CHUNK_SIZE):
+	new_table = f"{table_name}_compact"
+	db_cursor.execute(f"DROP TABLE IF EXISTS {new_table}")
+	db_cursor.execute(tick_table_ddl(new_table, defer_indexes=True, partition_by_month=partition_by_month))
+
+	db_cursor.execute(f"SELECT MIN(trade_id), MAX(trade_id), MIN(time), MAX(time) FROM {table_name}")
+	first_trade_id, last_trade_id, first_time, last_time = db_cursor.fetchone()
+
+	if first_trade_id is not None:
+		if partition_by_month:
+			ensure_month_partitions(db_cursor, new_table, months_between(int(first_time * NANOSECONDS_PER_SECOND), int(last_time * NANOSECONDS_PER_SECOND)))
+
+		for start in range(first_trade_id, last_trade_id + 1, chunk_size):
+			end = min(start + chunk_size - 1, last_trade_id)
+			db_cursor.execute(f"INSERT IGNORE INTO {new_table} (trade_id, price, volume, time, side) SELECT trade_id, price, volume, CAST(ROUND(time * 1000000) AS SIGNED) * 1000, IF(side IN ('1', 'True', 'true'), 1, 0) FROM {table_name} WHERE trade_id BETWEEN %s AND %s", (start, end))
+			db_connector.commit()
+			print(f"Migrated {table_name} up to trade {end}")
+
+	create_indexes(db_cursor, new_table)
+	swap_tables(db_cursor, table_name, new_table)
+	db_connector.commit()
+
+# Copy a legacy candle table (AUTO_INCREMENT candle_id) into the compact layout, merging the partial bars of each start time
+def migrate_candle_table(db_connector, db_cursor, table_name, partition_by_month=False):
+	new_table = f"{table_name}_compact"
+	db_cursor.execute(f"DROP TABLE IF EXISTS {new_table}")
+	db_cursor.execute(candle_table_ddl(new_table, partition_by_month))
+
+	# Candle tables created before the rollup have no trade ids, their partial bars are merged in import order instead
+	has_trade_ids = "first_trade_id" in table_columns(db_cursor, table_name)
+	trade_id_columns = "first_trade_id, last_trade_id, trade_count" if has_trade_ids else "NULL, NULL, 0"
+	merge = CANDLE_UPSERT if has_trade_ids else LEGACY_CANDLE_MERGE
+
+	if partition_by_month:
+		db_cursor.execute(f"SELECT MIN(start_time), MAX(start_time) FROM {table_name}")
+		first_start, last_start = db_cursor.fetchone()
+		if first_start is not None:
+			ensure_month_partitions(db_cursor, new_table, months_between(first_start, last_start))
+
+	db_cursor.execute(f"INSERT INTO {new_table} (open, high, low, close, volume, start_time, end_time, first_trade_id, last_trade_id, trade_count) SELECT open, high, low, close, volume, start_time, end_time, {trade_id_columns} FROM {table_name} ORDER BY candle_id ON DUPLICATE KEY UPDATE {merge}")
+	swap_tables(db_cursor, table_name, new_table)
+	db_connector.commit()
+
+# Rebuild a legacy candle table from the migrated tick table with the bars aligned to the origin, then swap the tables
+# Open and close are the prices of the first and last trade id of a bar
+def rebuild_candle_table(db_connector, db_cursor, table_name, tick_table, minutes, partition_by_month=False):
+	new_table = f"{table_name}_compact"
+	bar_ns = minutes * MINUTE_NS
+	db_cursor.execute(f"DROP TABLE IF EXISTS {new_table}")
+	db_cursor.execute(candle_table_ddl(new_table, partition_by_month))
+
+	# Like the bars of the importer, end_time is the start of the period on the origin grid and start_time one bar earlier
+	if partition_by_month:
+		db_cursor.execute(f"SELECT MIN(time), MAX(time) FROM {tick_table}")
+		first_time, last_time = db_cursor.fetchone()
+		if first_time is not None:
+			ensure_month_partitions(db_cursor, new_table, months_between(first_time - bar_ns, last_time))
+
+	db_cursor.execute(f"""
+		INSERT INTO {new_table} (start_time, end_time, open, high, low, close, volume, first_trade_id, last_trade_id, trade_count)
+		SELECT bars.end_time - {bar_ns} + 1, bars.end_time, first_tick.price, bars.high, bars.low, last_tick.price, bars.volume, bars.first_trade_id, bars.last_trade_id, bars.trade_count
+		FROM (
+			SELECT (time - {CANDLE_ORIGIN_NS}) DIV {bar_ns} * {bar_ns} + {CANDLE_ORIGIN_NS} AS end_time, MAX(price) AS high, MIN(price) AS low, SUM(volume) AS volume,
+				MIN(trade_id) AS first_trade_id, MAX(trade_id) AS last_trade_id, COUNT(*) AS trade_count
+			FROM {tick_table}
+			GROUP BY end_time
+		) bars
+		JOIN {tick_table} first_tick ON first_tick.trade_id = bars.first_trade_id
+		JOIN {tick_table} last_tick ON last_tick.trade_id = bars.last_trade_id
+	""")
+	swap_tables(db_cursor, table_name, new_table)
+	db_connector.commit()
+
+# Migrate the tick and candle tables that are still in the legacy layout, returns the names of the migrated tables
+# Candle tables of the realigned timeframes are rebuilt from the ticks, the others are copied
+def migrate_tables(db_connector, db_cursor, table_name, timeframes, partition_by_month=False):
+	db_cursor.execute("SHOW TABLES")
+	existing = {row[0].decode() if isinstance(row[0], bytes) else row[0] for row in db_cursor.fetchall()}
+	migrated = []
+
+	if table_name in existing and table_layout(db_cursor, table_name) == "legacy":
+		migrate_tick_table(db_connector, db_cursor, table_name, partition_by_month)
+		migrated.append(table_name)
+
+	for tf in timeframes:
+		candle_table = f"{table_name}_{tf}"
+		if candle_table in existing and "candle_id" in table_columns(db_cursor, candle_table):
+			if tf in REALIGNED_TIMEFRAMES and table_name in existing:
+				rebuild_candle_table(db_connector, db_cursor, candle_table, table_name, REALIGNED_TIMEFRAMES[tf], partition_by_month)
+			else:
+				migrate_candle_table(db_connector, db_cursor, candle_table, partition_by_month)
+			migrated.append(candle_table)
+
+	return migrated
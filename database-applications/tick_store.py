@@ -0,0 +1,165 @@
+# Partitioned Parquet tick store.
+# Ticks are stored as {store}/symbol={SYMBOL}/date={YYYY-MM-DD}/{archive}.parquet, zstd compressed and sorted by time,
+# with row group statistics on trade_id and time so range reads only touch the partitions and row groups they need.
+# pyarrow.dataset (which imports pandas) is only imported by the functions that read the store.
+
+import os
+import operator
+from functools import reduce
+from datetime import datetime, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Columns of the tick store files, the same as the tick tables in MySQL (time in float seconds)
+TICK_COLUMNS = ["trade_id", "price", "volume", "time", "side"]
+
+# Hive partitioning of the tick store
+PARTITION_SCHEMA = pa.schema([("symbol", pa.string()), ("date", pa.string())])
+
+COMPRESSION = "zstd"
+STATISTICS_COLUMNS = ["trade_id", "time"]
+ROW_GROUP_SIZE = 256 * 1024
+
+SECONDS_PER_DAY = 86400
+
+# UTC date of a Unix timestamp in seconds, as used in the date partitions
+def date_string(timestamp):
+	return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%d")
+
+# Path of the file that holds the ticks of one archive for one date
+def partition_path(store_dir, symbol, date, name):
+	return os.path.join(store_dir, f"symbol={symbol}", f"date={date}", f"{name}.parquet")
+
+# Writes the ticks of one archive to the date partitions of its symbol
+# Files are written under a hidden temporary name and only moved into place on close, so readers never see partial files
+# and importing an archive again replaces its files
+class TickStoreWriter:
+	def __init__(self, store_dir, symbol, name):
+		self.store_dir = store_dir
+		self.symbol = symbol
+		self.name = name
+		self.writers = {}
+
+	def write(self, table):
+		if table.num_rows == 0:
+			return
+		if isinstance(table, pa.RecordBatch):
+			table = pa.Table.from_batches([table])
+
+		table = table.take(pc.sort_indices(table, [("time", "ascending"), ("trade_id", "ascending")]))
+		days = np.floor(table.column("time").to_numpy() / SECONDS_PER_DAY).astype(np.int64)
+
+		# Tables are sorted by time, so every date is one contiguous slice
+		bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+		for start, end in zip(bounds[:-1], bounds[1:]):
+			date = date_string(days[start] * SECONDS_PER_DAY)
+			self.writer(date, table.schema).write_table(table.slice(start, end - start), row_group_size=ROW_GROUP_SIZE)
+
+	def writer(self, date, schema):
+		if date not in self.writers:
+			path = partition_path(self.store_dir, self.symbol, date, self.name)
+			temp_path = os.path.join(os.path.dirname(path), f".{self.name}.parquet.tmp")
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+
+			writer = pq.ParquetWriter(temp_path, schema, compression=COMPRESSION, write_statistics=STATISTICS_COLUMNS)
+			self.writers[date] = (writer, temp_path, path)
+
+		return self.writers[date][0]
+
+	def close(self):
+		for writer, temp_path, path in self.writers.values():
+			writer.close()
+			os.replace(temp_path, path)
+		self.writers = {}
+
+	def abort(self):
+		for writer, temp_path, _ in self.writers.values():
+			writer.close()
+			os.remove(temp_path)
+		self.writers = {}
+
+# Write a whole table of ticks as one archive
+def write_ticks(store_dir, symbol, name, table):
+	writer = TickStoreWriter(store_dir, symbol, name)
+	try:
+		writer.write(table)
+	except Exception:
+		writer.abort()
+		raise
+	writer.close()
+
+# Read the ticks of one tick store file in batches of about batch_size rows
+def iter_tick_batches(file_path, batch_size):
+	return pq.ParquetFile(file_path).iter_batches(batch_size=batch_size, columns=TICK_COLUMNS)
+
+def open_tick_store(store_dir):
+	import pyarrow.dataset as ds
+	return ds.dataset(store_dir, format="parquet", partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"))
+
+# Filter expression for a symbol and (inclusive) time and trade id ranges, times in Unix seconds
+# Time bounds also restrict the date partitions, so files outside the range are never opened
+def tick_filter(symbol=None, start_time=None, end_time=None, start_trade_id=None, end_trade_id=None):
+	import pyarrow.dataset as ds
+
+	conditions = []
+
+	if symbol is not None:
+		conditions.append(ds.field("symbol") == symbol)
+	if start_time is not None:
+		conditions += [ds.field("date") >= date_string(start_time), ds.field("time") >= start_time]
+	if end_time is not None:
+		conditions += [ds.field("date") <= date_string(end_time), ds.field("time") <= end_time]
+	if start_trade_id is not None:
+		conditions.append(ds.field("trade_id") >= start_trade_id)
+	if end_trade_id is not None:
+		conditions.append(ds.field("trade_id") <= end_trade_id)
+
+	return reduce(operator.and_, conditions) if conditions else None
+
+# Read the ticks of a symbol in trade id order, optionally restricted to time and trade id ranges
+def read_ticks(store_dir, symbol, start_time=None, end_time=None, start_trade_id=None, end_trade_id=None, columns=None):
+	columns = columns or TICK_COLUMNS
+	read_columns = columns if "trade_id" in columns else ["trade_id"] + columns
+
+	table = open_tick_store(store_dir).to_table(columns=read_columns, filter=tick_filter(symbol, start_time, end_time, start_trade_id, end_trade_id))
+	return table.sort_by("trade_id").select(columns)
+
+# Smallest and largest trade id of a symbol, optionally within a time range
+# Without a time range the row group statistics are enough and no data is read
+def trade_id_range(store_dir, symbol, start_time=None, end_time=None):
+	if start_time is not None or end_time is not None:
+		result = pc.min_max(read_ticks(store_dir, symbol, start_time, end_time, columns=["trade_id"]).column("trade_id"))
+		return result["min"].as_py(), result["max"].as_py()
+
+	minimum = maximum = None
+	for fragment in open_tick_store(store_dir).get_fragments(filter=tick_filter(symbol)):
+		for row_group in fragment.row_groups:
+			statistics = row_group.statistics["trade_id"]
+			minimum = statistics["min"] if minimum is None else min(minimum, statistics["min"])
+			maximum = statistics["max"] if maximum is None else max(maximum, statistics["max"])
+
+	return minimum, maximum
+
+# Smallest trade id of a symbol after the given one, from the row group statistics (used to skip gaps in the trade ids)
+def next_trade_id(store_dir, symbol, after):
+	candidates = []
+	for fragment in open_tick_store(store_dir).get_fragments(filter=tick_filter(symbol)):
+		for row_group in fragment.row_groups:
+			statistics = row_group.statistics["trade_id"]
+			if statistics["max"] > after:
+				candidates.append(max(statistics["min"], after + 1))
+
+	return min(candidates, default=None)
+
+# Trade id range and number of rows of every row group of a symbol, from the row group statistics
+# (used to split a trade id range into parts with about the same number of ticks, time bounds only select the date partitions)
+def trade_id_segments(store_dir, symbol, start_time=None, end_time=None):
+	segments = []
+	for fragment in open_tick_store(store_dir).get_fragments(filter=tick_filter(symbol, start_time, end_time)):
+		for row_group in fragment.row_groups:
+			statistics = row_group.statistics["trade_id"]
+			segments.append((statistics["min"], statistics["max"], row_group.num_rows))
+
+	return sorted(segments)
@@ -0,0 +1,382 @@
+# Orchestrator of the preprocessing and LSTM training of several symbols.
+# Runs preprocess-release.py and lstm-release.py for every symbol and hyperparameter configuration as separate processes,
+# starting as many at once as the CPU and memory limits allow. The preprocessed data of a symbol is cached on disk, keyed by the
+# symbol, its trade_id range, the time range and the scaler, so sweeps over the same data only preprocess it once.
+# Incremental configurations get their data scaled with the scaler saved next to their model.
+# NOTE: MySQL database credentials have been removed for privacy/security reasons. Fill in these values before running this script.
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+import pymysql
+from tick_store import trade_id_range, trade_id_segments
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PREPROCESS_PATH = os.path.join(SCRIPT_DIR, 'preprocess-release.py')
+LSTM_PATH = os.path.join(SCRIPT_DIR, 'lstm-release.py')
+
+SYMBOLS = ['ETHUSDC', 'ETHUSDT', 'ETHBTC', 'BTCUSDT', 'BTCUSDC']
+
+CACHE_DIR = 'feature_cache'
+RUNS_DIR = 'runs'
+CACHE_FILE = 'cache.json'
+KEEP_CACHE_ENTRIES = 2
+
+# Files of the preprocessing, and the names the LSTM script reads them by
+PREPROCESS_PART_DIRS = ['training_data', 'testing_data']
+PREPROCESS_FILES = {'final_training_data.parquet': '{symbol}_training_data.parquet', 'final_testing_data.parquet': '{symbol}_testing_data.parquet'}
+
+# Estimated memory use in MiB of a preprocessing worker and of a training run, used to decide how many run at once
+PREPROCESS_WORKER_MEMORY = 512
+TRAIN_MEMORY = 2048
+
+# Seconds between checks of the running jobs
+POLL_INTERVAL = 0.5
+
+# Configuration options that go to the preprocessing instead of the training
+PREPROCESS_OPTIONS = ['scaler']
+
+# Options the orchestrator sets itself
+RESERVED_OPTIONS = ['table_prefix', 'data_dir', 'model_dir', 'plan', 'metrics_log', 'reuse_scaler']
+
+# Scaler that lstm-release.py saves next to the model, and that the preprocessing reads from its output directory
+SCALER_FILE = 'scaler.pkl'
+
+# One process of the schedule, started when its dependencies are done and its CPUs and memory are free
+# Jobs with the same lock (the training runs of a symbol, which write to the predictions table of the symbol) never run at once
+# on_start runs before the process is started, and the job fails without starting it if on_start fails
+class Job:
+	def __init__(self, name, command, cpus, memory, log_path, depends=(), lock=None, size=0, on_start=None, on_success=None):
+		self.name = name
+		self.command = command
+		self.cpus = cpus
+		self.memory = memory
+		self.log_path = log_path
+		self.depends = list(depends)
+		self.lock = lock
+		self.size = size
+		self.on_start = on_start
+		self.on_success = on_success
+		self.status = 'pending'
+		self.process = None
+		self.log_file = None
+		self.start_time = None
+		self.elapsed = None
+
+	def start(self):
+		if self.on_start:
+			try:
+				self.on_start()
+			except OSError as e:
+				print(f"{self.name}: {e}")
+				self.status = 'failed'
+				return
+
+		os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+		self.log_file = open(self.log_path, 'w')
+		self.start_time = timer()
+		self.process = subprocess.Popen(self.command, stdout=self.log_file, stderr=subprocess.STDOUT)
+		self.status = 'running'
+
+	# Check whether the process has exited, and record the outcome if it has
+	def poll(self):
+		if self.process.poll() is None:
+			return False
+
+		self.elapsed = timer() - self.start_time
+		self.log_file.close()
+		self.status = 'done' if self.process.returncode == 0 else 'failed'
+		if self.status == 'done' and self.on_success:
+			try:
+				self.on_success()
+			except (OSError, ValueError) as e:
+				print(f"{self.name}: {e}")
+				self.status = 'failed'
+		return True
+
+# Function to connect to the database
+def get_db_connection(db_config):
+	return pymysql.connect(**db_config)
+
+# Function to get the trade_id range of a symbol and its approximate number of ticks, from the row group statistics of the
+# tick store or from its table in the database (where the size of the range is used, counting the rows would scan the table)
+def get_trade_id_range(db_config, symbol, tick_store=None, start_time=None, end_time=None):
+	if tick_store:
+		start_trade_id, end_trade_id = trade_id_range(tick_store, symbol, start_time, end_time)
+		return start_trade_id, end_trade_id, sum(segment[2] for segment in trade_id_segments(tick_store, symbol, start_time, end_time))
+
+	connection = get_db_connection(db_config)
+	try:
+		with connection.cursor() as cursor:
+			cursor.execute(f"SELECT MIN(trade_id), MAX(trade_id) FROM {symbol}_TICK_DATA")
+			start_trade_id, end_trade_id = cursor.fetchone()
+	finally:
+		connection.close()
+	return start_trade_id, end_trade_id, None if start_trade_id is None else end_trade_id - start_trade_id + 1
+
+# Load the hyperparameter configurations, a JSON list of objects of lstm-release.py (and preprocessing) options
+# Every configuration gets a name, which is the directory of its models
+def load_configs(file_path):
+	if file_path is None:
+		return [{'name': 'default'}]
+
+	with open(file_path) as config_file:
+		configs = json.load(config_file)
+	if not isinstance(configs, list) or not all(isinstance(config, dict) for config in configs):
+		raise ValueError(f"{file_path} must contain a list of objects")
+
+	names = set()
+	for index, config in enumerate(configs):
+		config.setdefault('name', f"config{index}")
+		reserved = [option for option in RESERVED_OPTIONS if option in config]
+		if reserved:
+			raise ValueError(f"Configuration {config['name']} sets {', '.join(reserved)}, which the orchestrator sets itself")
+		if config['name'] in names:
+			raise ValueError(f"Configuration name {config['name']} is used twice")
+		names.add(config['name'])
+	return configs
+
+# Command line options of a configuration, True adds a flag and False or None leaves the option out
+def command_options(options):
+	arguments = []
+	for option, value in options.items():
+		flag = '--' + option.replace('_', '-')
+		if value is True:
+			arguments.append(flag)
+		elif value is not None and value is not False:
+			arguments += [flag, str(value)]
+	return arguments
+
+# Key of the preprocessed data of a symbol, and the directory of its cache entry
+def cache_entry(cache_dir, symbol, source, trade_ids, start_time, end_time, scaler):
+	key = {
+		'symbol': symbol,
+		'source': source,
+		'trade_ids': [int(trade_ids[0]), int(trade_ids[1])],
+		'start_time': start_time,
+		'end_time': end_time,
+		'scaler': scaler
+	}
+	digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+	return key, os.path.join(cache_dir, symbol, digest)
+
+# A cache entry is complete once its key file is written, which happens after all of its data
+def is_cached(entry_dir):
+	return os.path.exists(os.path.join(entry_dir, CACHE_FILE))
+
+# Digest of the scaler saved next to a model, which keys the data scaled with it
+def scaler_digest(scaler_path):
+	with open(scaler_path, 'rb') as scaler_file:
+		return hashlib.sha256(scaler_file.read()).hexdigest()[:16]
+
+# Put the scaler of a model into a new cache entry, for the preprocessing to reuse
+def seed_cache_entry(entry_dir, scaler_path):
+	os.makedirs(entry_dir, exist_ok=True)
+	shutil.copyfile(scaler_path, os.path.join(entry_dir, SCALER_FILE))
+
+# Turn the output of a preprocessing run into a cache entry: the final files get the names the LSTM script reads,
+# the task files are removed, and the key is written last
+def finish_cache_entry(entry_dir, symbol, key):
+	for source, target in PREPROCESS_FILES.items():
+		os.replace(os.path.join(entry_dir, source), os.path.join(entry_dir, target.format(symbol=symbol)))
+	for part_dir in PREPROCESS_PART_DIRS:
+		shutil.rmtree(os.path.join(entry_dir, part_dir), ignore_errors=True)
+
+	key = dict(key, created=datetime.now(timezone.utc).isoformat())
+	with open(os.path.join(entry_dir, CACHE_FILE), 'w') as cache_file:
+		json.dump(key, cache_file, indent=2)
+
+# Remove all but the keep newest complete entries of a symbol, and any incomplete ones of earlier runs
+def prune_cache(symbol_dir, keep, in_use):
+	if not os.path.isdir(symbol_dir):
+		return
+
+	entries = [os.path.join(symbol_dir, name) for name in os.listdir(symbol_dir)]
+	complete = sorted((entry for entry in entries if is_cached(entry)), key=lambda entry: os.path.getmtime(os.path.join(entry, CACHE_FILE)), reverse=True)
+	for entry in entries:
+		if entry not in in_use and (entry not in complete or complete.index(entry) >= keep):
+			shutil.rmtree(entry, ignore_errors=True)
+
+# Build the jobs of all symbols and configurations, the preprocessing of an uncached key comes before the training runs that use it
+# The data of an incremental configuration is scaled with the scaler of its model instead of a newly fitted one,
+# configurations without a saved model and scaler to continue are skipped
+def plan_jobs(db_config, symbols, configs, args):
+	source = 'tick_store:' + os.path.abspath(args.tick_store) if args.tick_store else 'mysql:' + db_config['database']
+	start_bound = args.start_time.replace(tzinfo=timezone.utc).timestamp() if args.start_time else None
+	end_bound = args.end_time.replace(tzinfo=timezone.utc).timestamp() if args.end_time else None
+	log_dir = os.path.join(args.runs_dir, 'logs')
+
+	jobs = []
+	entries = {}
+	for symbol in symbols:
+		start_trade_id, end_trade_id, size = get_trade_id_range(db_config, symbol, args.tick_store, start_bound, end_bound)
+		if start_trade_id is None:
+			print(f"{symbol}: no ticks, skipped")
+			continue
+		trade_ids = (start_trade_id, end_trade_id)
+
+		for config in configs:
+			model_dir = os.path.abspath(os.path.join(args.runs_dir, symbol, config['name']))
+			preprocess_options = {option: config[option] for option in PREPROCESS_OPTIONS if option in config}
+			model_scaler = None
+			if config.get('incremental'):
+				model_scaler = os.path.join(model_dir, SCALER_FILE)
+				if not os.path.exists(model_scaler):
+					print(f"{symbol} {config['name']}: no scaler of a saved model at {model_scaler} to continue training with, skipped")
+					continue
+				preprocess_options = {'reuse_scaler': True}
+			scaler = 'reuse:' + scaler_digest(model_scaler) if model_scaler else preprocess_options.get('scaler', 'minmax')
+			key, entry_dir = cache_entry(args.cache_dir, symbol, source, trade_ids, args.start_time and args.start_time.isoformat(), args.end_time and args.end_time.isoformat(), scaler)
+
+			# One preprocessing job per cache entry, shared by all configurations that use it
+			if entry_dir not in entries:
+				preprocess_job = None
+				if not is_cached(entry_dir):
+					command = [sys.executable, PREPROCESS_PATH, '--table-prefix', symbol, '--output-dir', os.path.abspath(entry_dir), '--workers', str(args.preprocess_workers)]
+					command += command_options(preprocess_options)
+					if args.tick_store:
+						command += ['--tick-store', os.path.abspath(args.tick_store)]
+					if args.start_time:
+						command += ['--start-time', args.start_time.isoformat()]
+					if args.end_time:
+						command += ['--end-time', args.end_time.isoformat()]
+					if args.metrics_log:
+						command += ['--metrics-log', os.path.abspath(args.metrics_log)]
+					preprocess_job = Job(f"preprocess {symbol} {os.path.basename(entry_dir)}", command, args.preprocess_workers, args.preprocess_workers * PREPROCESS_WORKER_MEMORY,
+						os.path.join(log_dir, f"preprocess-{symbol}-{os.path.basename(entry_dir)}.log"), size=size,
+						on_start=(lambda entry_dir=entry_dir, model_scaler=model_scaler: seed_cache_entry(entry_dir, model_scaler)) if model_scaler else None,
+						on_success=lambda entry_dir=entry_dir, symbol=symbol, key=key: finish_cache_entry(entry_dir, symbol, key))
+					jobs.append(preprocess_job)
+				entries[entry_dir] = preprocess_job
+
+			# Training run of the configuration, with its own model directory
+			train_options = {option: value for option, value in config.items() if option not in PREPROCESS_OPTIONS and option != 'name'}
+			train_options.setdefault('intra_op_threads', args.train_threads)
+			train_options.setdefault('inter_op_threads', 1)
+			command = [sys.executable, LSTM_PATH, '--table-prefix', symbol, '--data-dir', os.path.abspath(entry_dir), '--model-dir', model_dir]
+			command += command_options(train_options)
+			if args.metrics_log:
+				command += ['--metrics-log', os.path.abspath(args.metrics_log)]
+			depends = [entries[entry_dir]] if entries[entry_dir] else []
+			jobs.append(Job(f"train {symbol} {config['name']}", command, int(train_options['intra_op_threads']) or args.train_threads, args.train_memory,
+				os.path.join(log_dir, f"train-{symbol}-{config['name']}.log"), depends, lock=symbol, size=size))
+
+	# Largest symbols first, preprocessing before training, so the longest jobs do not start last
+	jobs.sort(key=lambda job: (job.name.startswith('train'), -job.size))
+	return jobs, entries
+
+# Run the jobs, starting every job whose dependencies are done as soon as its CPUs and memory are free
+# A job that needs more than the limits is started once nothing else runs. Jobs are not started after the time limit
+def run_jobs(jobs, cpus, memory=None, time_limit=None):
+	pending = list(jobs)
+	running = []
+	start = timer()
+
+	while pending or running:
+		for job in list(pending):
+			if any(dependency.status in ('failed', 'skipped') for dependency in job.depends) or (time_limit and timer() - start > time_limit):
+				job.status = 'skipped'
+				pending.remove(job)
+				print(f"Skipped {job.name}")
+
+		for job in list(pending):
+			used_cpus = sum(other.cpus for other in running)
+			used_memory = sum(other.memory for other in running)
+			if any(dependency.status != 'done' for dependency in job.depends) or any(other.lock is not None and other.lock == job.lock for other in running):
+				continue
+			if running and (used_cpus + job.cpus > cpus or (memory and used_memory + job.memory > memory)):
+				continue
+
+			job.start()
+			pending.remove(job)
+			if job.status == 'failed':
+				continue
+			running.append(job)
+			print(f"[{timer() - start:8.1f}s] Started {job.name} ({job.cpus} CPUs, {job.memory:,} MiB)")
+
+		time.sleep(POLL_INTERVAL)
+		for job in list(running):
+			if job.poll():
+				running.remove(job)
+				print(f"[{timer() - start:8.1f}s] {job.name} {job.status} in {job.elapsed:.1f}s (log: {job.log_path})")
+
+	return timer() - start
+
+# Physical memory of the machine in MiB, or None if it is not known
+def physical_memory():
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+	except (AttributeError, ValueError, OSError):
+		return None
+
+# Main function to preprocess and train all symbols and configurations
+# With plan only the jobs and cache entries are printed
+def main(symbols, configs, args):
+
+	# Database connection parameters
+	DB_CONFIG = {
+		'host': 'localhost',
+		'user': '',
+		'password': '',
+		'database': 'PROJECT_4560'
+	}
+
+	jobs, entries = plan_jobs(DB_CONFIG, symbols, configs, args)
+	cached = sum(1 for job in entries.values() if job is None)
+	print(f"{len(entries)} preprocessed data sets ({cached} cached), {sum(1 for job in jobs if job.name.startswith('train'))} training runs")
+	print(f"Limits: {args.cpus} CPUs, {f'{args.memory:,} MiB' if args.memory else 'no memory limit'}")
+
+	if args.plan:
+		for job in jobs:
+			print(f"  {job.name:<40} {job.cpus} CPUs, {job.memory:,} MiB, ~{job.size:,} ticks{' after ' + ', '.join(dependency.name for dependency in job.depends) if job.depends else ''}")
+		return True
+
+	elapsed = run_jobs(jobs, args.cpus, args.memory, args.time_limit and args.time_limit * 3600)
+
+	for symbol in symbols:
+		prune_cache(os.path.join(args.cache_dir, symbol), args.keep_cache, set(entries))
+
+	print(f"\nFinished in {elapsed:.1f}s")
+	for job in jobs:
+		print(f"  {job.name:<40} {job.status:<8} {f'{job.elapsed:.1f}s' if job.elapsed is not None else ''}")
+	return all(job.status == 'done' for job in jobs)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Preprocess and train the LSTM for several symbols and hyperparameter configurations in parallel.")
+	parser.add_argument('--symbols', type=str, nargs='+', default=SYMBOLS, help='Symbols (table prefixes) to train')
+	parser.add_argument('--configs', type=str, default=None, help='JSON file with a list of configurations of lstm-release.py options, e.g. [{"name": "small", "epochs": 5, "batch_size": 32}]; a "scaler" option goes to the preprocessing')
+	parser.add_argument('--tick-store', type=str, default=None, help='Preprocess the ticks from this Parquet tick store instead of the database')
+	parser.add_argument('--start-time', type=datetime.fromisoformat, default=None, help='Only use ticks from this UTC date/time on (tick store only)')
+	parser.add_argument('--end-time', type=datetime.fromisoformat, default=None, help='Only use ticks up to this UTC date/time (tick store only)')
+	parser.add_argument('--cpus', type=int, default=os.cpu_count(), help='CPUs used by all jobs together (default: number of CPU cores)')
+	parser.add_argument('--memory', type=int, default=physical_memory(), help='Estimated memory in MiB used by all jobs together (default: physical memory)')
+	parser.add_argument('--preprocess-workers', type=int, default=2, help='Worker processes of every preprocessing job')
+	parser.add_argument('--train-threads', type=int, default=1, help='Threads of every training job, unless its configuration sets intra_op_threads')
+	parser.add_argument('--train-memory', type=int, default=TRAIN_MEMORY, help='Estimated memory in MiB of a training job')
+	parser.add_argument('--time-limit', type=float, default=None, help='Hours after which no more jobs are started (e.g. the length of the nightly window)')
+	parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Directory of the cached preprocessed data')
+	parser.add_argument('--keep-cache', type=int, default=KEEP_CACHE_ENTRIES, help='Cached data sets kept per symbol (the newest ones, besides those of this run)')
+	parser.add_argument('--runs-dir', type=str, default=RUNS_DIR, help='Directory of the models (RUNS_DIR/SYMBOL/CONFIG) and the job logs')
+	parser.add_argument('--plan', '--dry-run', action='store_true', help='Only print the jobs and which data is cached, without running anything')
+	parser.add_argument('--metrics-log', type=str, default=None, help='Append the stage metrics of all jobs to this file as JSON lines')
+
+	args = parser.parse_args()
+
+	if (args.start_time or args.end_time) and not args.tick_store:
+		parser.error('--start-time and --end-time require --tick-store')
+
+	try:
+		configs = load_configs(args.configs)
+	except (OSError, ValueError) as e:
+		print(e)
+		sys.exit(1)
+
+	if not main(args.symbols, configs, args):
+		sys.exit(1)